@@ -1,10 +1,18 @@
+import hashlib
+import json
 import logging
+import math
+import struct
+import sys
+import uuid
+import zlib
+from array import array
 
 from django.contrib.gis.geos import GEOSGeometry
 from django.utils.translation import ugettext as _
-from django.contrib.gis.geos import LineString
 from django.conf import settings
-from django.db import connection
+from django.core.cache import caches
+from django.db import connection, transaction, ProgrammingError
 
 import pygal
 from pygal.style import LightSolarizedStyle
@@ -12,8 +20,15 @@ from pygal.style import LightSolarizedStyle
 
 logger = logging.getLogger(__name__)
 
+DEM_VERSION_CACHE_KEY = 'altimetry_dem_version'
+
+BINARY_AREA_MAGIC = b'GTD1'
+BINARY_AREA_CONTENT_TYPE = 'application/octet-stream'
+
 
 class AltimetryHelper(object):
+    _dem_overviews = None  # (DEM version, DEM overviews), see dem_info()
+
     @classmethod
     def elevation_profile(cls, geometry3d, precision=None, offset=0):
         """Extract elevation profile from a 3D geometry.
@@ -22,31 +37,55 @@ class AltimetryHelper(object):
         """
         precision = precision or settings.ALTIMETRIC_PROFILE_PRECISION
 
+        # Reproject all vertices at once
+        geom3dapi = geometry3d.transform(settings.API_SRID, clone=True)
+
         if geometry3d.geom_type == 'MultiLineString':
             profile = []
-            for subcoords in geometry3d.coords:
-                subline = LineString(subcoords, srid=geometry3d.srid)
-                offset += subline.length
-                subprofile = AltimetryHelper.elevation_profile(subline, precision, offset)
-                profile.extend(subprofile)
+            for subcoords, subcoordsapi in zip(geometry3d.coords, geom3dapi.coords):
+                distances = cls._cumulative_distances(subcoords)
+                offset += distances[-1]
+                profile.extend(cls._join_profile(distances, subcoordsapi, offset))
             return profile
 
-        # Add measure to 2D version of geometry3d
-        # Get distance from origin for each vertex
-        sql = """
-        WITH line2d AS (SELECT ST_force_2D('%(ewkt)s'::geometry) AS geom),
-             line_measure AS (SELECT ST_Addmeasure(geom, 0, ST_length(geom)) AS geom FROM line2d),
-             points2dm AS (SELECT (ST_DumpPoints(geom)).geom AS point FROM line_measure)
-        SELECT (%(offset)s + ST_M(point)) FROM points2dm;
-        """ % {'offset': offset, 'ewkt': geometry3d.ewkt}
-        cursor = connection.cursor()
-        cursor.execute(sql)
-        pointsm = cursor.fetchall()
+        distances = cls._cumulative_distances(geometry3d.coords)
+        assert len(distances) == len(geom3dapi.coords), 'Cannot map distance to xyz'
+        return cls._join_profile(distances, geom3dapi.coords, offset)
+
+    @classmethod
+    def profile_cache_key(cls, geometry3d, precision=None):
+        """Cache key of the elevation profile of a 3D geometry.
+        Since it changes with the geometry, profiles do not have to be
+        invalidated when geometries are modified (by triggers).
+        """
+        precision = precision or settings.ALTIMETRIC_PROFILE_PRECISION
+        digest = hashlib.sha1('%s-%s' % (geometry3d.hexewkb, precision)).hexdigest()
+        return 'altimetry_profile_%s' % digest
+
+    @classmethod
+    def cached_elevation_profile(cls, geometry3d, precision=None):
+        """Same as ``elevation_profile()``, stored in the ``fat`` cache.
+        """
+        cache = caches['fat']
+        key = cls.profile_cache_key(geometry3d, precision)
+        profile = cache.get(key)
+        if profile is None:
+            profile = cls.elevation_profile(geometry3d, precision)
+            cache.set(key, profile)
+        return profile
+
+    @classmethod
+    def _cumulative_distances(cls, coords):
+        """Distance (2D) from origin of each vertex of a line"""
+        distances = [0.0]
+        for a, b in zip(coords[:-1], coords[1:]):
+            distances.append(distances[-1] + math.hypot(b[0] - a[0], b[1] - a[1]))
+        return distances
+
+    @classmethod
+    def _join_profile(cls, distances, coords, offset):
         # Join (offset+distance, x, y, z) together
-        geom3dapi = geometry3d.transform(settings.API_SRID, clone=True)
-        assert len(pointsm) == len(geom3dapi.coords), 'Cannot map distance to xyz'
-        dxyz = [pointsm[i] + v for i, v in enumerate(geom3dapi.coords)]
-        return dxyz
+        return [(offset + distance,) + tuple(v) for distance, v in zip(distances, coords)]
 
     @classmethod
     def altimetry_limits(cls, profile):
@@ -61,13 +100,17 @@ class AltimetryHelper(object):
         return ceil_elevation, floor_elevation
 
     @classmethod
-    def profile_svg(cls, profile):
+    def _profile_chart(cls, profile):
         """
-        Plot the altimetric graph in SVG using PyGal.
+        Altimetric graph using PyGal, shared by SVG and PNG outputs.
         Most of the job done here is dedicated to preparing
         nice labels scales.
         """
-        ceil_elevation, floor_elevation = cls.altimetry_limits(profile)
+        if profile:
+            ceil_elevation, floor_elevation = cls.altimetry_limits(profile)
+        else:
+            # Chart shows ``no_data_text``
+            ceil_elevation, floor_elevation = settings.ALTIMETRIC_PROFILE_MIN_YSCALE, 0
         config = dict(show_legend=False,
                       print_values=False,
                       show_dots=False,
@@ -95,7 +138,22 @@ class AltimetryHelper(object):
         line_chart.range = [floor_elevation, ceil_elevation]
         line_chart.no_data_text = _(u"Altimetry data not available")
         line_chart.add('', [(int(v[0]), int(v[3])) for v in profile])
-        return line_chart.render()
+        return line_chart
+
+    @classmethod
+    def profile_svg(cls, profile):
+        """
+        Plot the altimetric graph in SVG using PyGal.
+        """
+        return cls._profile_chart(profile).render()
+
+    @classmethod
+    def profile_png(cls, profile, path):
+        """
+        Plot the altimetric graph in PNG using PyGal (rasterized by CairoSVG),
+        and save it at ``path``.
+        """
+        cls._profile_chart(profile).render_to_png(path)
 
     @classmethod
     def _nice_extent(cls, geom):
@@ -119,6 +177,61 @@ class AltimetryHelper(object):
                                   int(ycenter + height / 2.0))
         return (xmin, ymin, xmax, ymax)
 
+    @classmethod
+    def dem_version(cls):
+        """Identifier of the DEM, changed when it is reloaded (see
+        ``dem_changed``). ``None`` if the ``fat`` cache is disabled.
+        """
+        cache = caches['fat']
+        version = cache.get(DEM_VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(DEM_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(DEM_VERSION_CACHE_KEY)
+        return version
+
+    @classmethod
+    def dem_info(cls):
+        """DEM availability, and its overviews (see ``loaddem --overviews``) as
+        ``(table, pixel size)`` from the coarsest. Availability is checked
+        each time, overviews are cached by process until the DEM is reloaded
+        (see ``dem_changed``), if the ``fat`` cache is enabled.
+        """
+        cursor = connection.cursor()
+        cursor.execute("SELECT ft_dem_available()")
+        if not cursor.fetchone()[0]:
+            return (False, [])
+
+        version = cls.dem_version()
+        if version is not None and cls._dem_overviews is not None and cls._dem_overviews[0] == version:
+            return (True, cls._dem_overviews[1])
+        cursor.execute("""
+            SELECT o.o_table_name, abs(c.scale_x) * o.overview_factor
+            FROM raster_overviews AS o
+                 JOIN raster_columns AS c ON (c.r_table_name = o.r_table_name)
+            WHERE o.r_table_name = 'mnt' AND c.scale_x IS NOT NULL
+            ORDER BY o.overview_factor DESC
+        """)
+        overviews = cursor.fetchall()
+        if version is not None:
+            cls._dem_overviews = (version, overviews)
+        return (True, overviews)
+
+    @classmethod
+    def dem_changed(cls):
+        """Invalidates DEM overviews cached by all processes (see ``dem_info``)"""
+        cls._dem_overviews = None
+        caches['fat'].set(DEM_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+    @classmethod
+    def _dem_table(cls, overviews, precision):
+        """Coarsest DEM overview whose pixels are not larger than ``precision``,
+        or the DEM itself.
+        """
+        for table, pixel_size in overviews:
+            if pixel_size <= precision:
+                return connection.ops.quote_name(table)
+        return 'mnt'
+
     @classmethod
     def elevation_area(cls, geom):
         xmin, ymin, xmax, ymax = cls._nice_extent(geom)
@@ -130,75 +243,82 @@ class AltimetryHelper(object):
             precision = int(width / max_resolution)
         if height / precision > 10000:
             precision = int(width / max_resolution)
-        cursor = connection.cursor()
-        cursor.execute("SELECT 1 FROM information_schema.tables WHERE table_name='mnt'")
-        if cursor.rowcount == 0:
+        available, overviews = cls.dem_info()
+        if not available:
             logger.warn("No DEM present")
             return {}
+        cursor = connection.cursor()
 
+        # Sampling grid: one point every ``precision`` meters from (xmin, ymin)
+        resolution_w = (xmax - xmin) // precision + 1
+        resolution_h = (ymax - ymin) // precision + 1
+        xlast = xmin + (resolution_w - 1) * precision
+        ylast = ymin + (resolution_h - 1) * precision
+
+        # DEM (or its coarsest overview fine enough) is clipped once around the grid,
+        # and resampled on it (a pixel centered on each point of the grid).
         sql = """
-            -- Author: Celian Garcia
-            WITH columns AS (
-                    SELECT generate_series({xmin}::int, {xmax}::int, {precision}) AS x
-                ),
-                lines AS (
-                    SELECT generate_series({ymin}::int, {ymax}::int, {precision}) AS y
+            WITH grid AS (
+                    SELECT ST_MakeEmptyRaster(%(width)s, %(height)s, %(ulx)s, %(uly)s,
+                                              %(precision)s, -%(precision)s, 0, 0, %(srid)s) AS rast
                 ),
-                resolution AS (
-                    SELECT x, y
-                    FROM (SELECT COUNT(x) AS x FROM columns) AS col,
-                         (SELECT COUNT(y) AS y FROM lines)   AS lin
+                clipped AS (
+                    SELECT ST_Union(ST_Clip(mnt.rast, ST_Expand(ST_Envelope(grid.rast), %(precision)s))) AS rast
+                    FROM {table} AS mnt, grid
+                    WHERE ST_Intersects(mnt.rast, ST_Expand(ST_Envelope(grid.rast), %(precision)s))
                 ),
-                points2d AS (
-                    SELECT row_number() OVER () AS id,
-                           ST_SetSRID(ST_MakePoint(x, y), {srid}) AS geom,
-                           ST_Transform(ST_SetSRID(ST_MakePoint(x, y), {srid}), 4326) AS geomll
-                    FROM lines, columns
+                resampled AS (
+                    SELECT ST_Resample(clipped.rast, grid.rast, 'NearestNeighbour') AS rast
+                    FROM clipped, grid
                 ),
-                draped AS (
-                    SELECT id, ST_Value(mnt.rast, p.geom)::int AS altitude
-                    FROM mnt, points2d AS p
-                    WHERE ST_Intersects(mnt.rast, p.geom)
-                ),
-                all_draped AS (
-                    SELECT geomll, geom, altitude
-                    FROM points2d LEFT JOIN draped ON (points2d.id = draped.id)
-                    ORDER BY points2d.id
-                ),
-                extent_latlng AS (
-                    SELECT ST_Envelope(ST_Union(geom)) AS extent,
-                           MIN(altitude) AS min_z,
-                           MAX(altitude) AS max_z,
-                           AVG(altitude) AS center_z
-                    FROM all_draped
+                extent AS (
+                    SELECT ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xlast)s, %(ylast)s, %(srid)s) AS geom
                 )
-            SELECT extent,
-                   ST_transform(extent, 4326),
-                   center_z,
-                   min_z,
-                   max_z,
-                   resolution.x AS resolution_w,
-                   resolution.y AS resolution_h,
-                   altitude
-            FROM extent_latlng, resolution, all_draped;
-        """.format(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax,
-                   srid=settings.SRID, precision=precision)
-        cursor.execute(sql)
-        result = cursor.fetchall()
-        first = result[0]
-        envelop_native, envelop, center_z, min_z, max_z, resolution_w, resolution_h, a = first
+            SELECT extent.geom,
+                   ST_Transform(extent.geom, 4326),
+                   ST_UpperLeftX(resampled.rast),
+                   ST_UpperLeftY(resampled.rast),
+                   ST_DumpValues(resampled.rast, 1)::int[]
+            FROM extent, resampled;
+        """
+        params = {'width': resolution_w, 'height': resolution_h,
+                  'ulx': xmin - precision / 2.0, 'uly': ylast + precision / 2.0,
+                  'xmin': xmin, 'ymin': ymin, 'xlast': xlast, 'ylast': ylast,
+                  'precision': precision, 'srid': settings.SRID}
+        try:
+            with transaction.atomic():
+                cursor.execute(sql.format(table=cls._dem_table(overviews, precision)), params)
+        except ProgrammingError:
+            # DEM (or its overviews) dropped since its infos were cached
+            cls.dem_changed()
+            available, overviews = cls.dem_info()
+            if not available:
+                logger.warn("No DEM present")
+                return {}
+            cursor.execute(sql.format(table=cls._dem_table(overviews, precision)), params)
+        envelop_native, envelop, ulx, uly, values = cursor.fetchone()
         envelop = GEOSGeometry(envelop, srid=4326)
         envelop_native = GEOSGeometry(envelop_native, srid=settings.SRID)
 
-        altitudes = []
-        row = []
-        for i, record in enumerate(result):
-            if i > 0 and i % resolution_w == 0:
-                altitudes.append(row)
-                row = []
-            elevation = (record[7] or 0.0) - min_z
-            row.append(elevation)
-        altitudes.append(row)
+        # Map DEM values on the grid, from south to north. Resampled raster is
+        # aligned on the grid, but may not cover it entirely.
+        values = values or []
+        column_offset = int(round((ulx - xmin) / precision + 0.5)) if values else 0
+        row_offset = int(round((ylast - uly) / precision + 0.5)) if values else 0
+        grid = []
+        for j in range(resolution_h):
+            i = resolution_h - 1 - j - row_offset
+            line = values[i] if 0 <= i < len(values) else []
+            grid.append([line[k - column_offset] if 0 <= k - column_offset < len(line) else None
+                         for k in range(resolution_w)])
+
+        draped = [altitude for row in grid for altitude in row if altitude is not None]
+        if not draped:
+            logger.warn("No DEM data in area")
+            return {}
+        min_z, max_z = min(draped), max(draped)
+        center_z = sum(draped) / float(len(draped))
+        altitudes = [[(altitude or 0.0) - min_z for altitude in row] for row in grid]
 
         area = {
             'center': {
@@ -244,3 +364,27 @@ class AltimetryHelper(object):
             'altitudes': altitudes
         }
         return area
+
+    @classmethod
+    def elevation_area_binary(cls, area, compression=None):
+        """
+        Compact encoding of an elevation area (as returned by ``elevation_area``).
+        Everything is little-endian:
+
+        * magic ``GTD1``, header length (uint32)
+        * header: the area as JSON, without altitudes, with their ``encoding``
+        * altitudes above minimum (int16 array, in meters), row by row from
+          south to north, compressed with zlib if ``compression`` is ``'zlib'``
+        """
+        if compression not in (None, 'zlib'):
+            raise ValueError("Unknown compression %s" % compression)
+        header = dict(area)
+        altitudes = array('h', [int(round(altitude)) for row in header.pop('altitudes', []) for altitude in row])
+        if sys.byteorder == 'big':
+            altitudes.byteswap()
+        payload = altitudes.tostring()
+        if compression == 'zlib':
+            payload = zlib.compress(payload)
+        header['encoding'] = {'type': 'int16', 'compression': compression}
+        header = json.dumps(header).encode('utf-8')
+        return struct.pack('<4sI', BINARY_AREA_MAGIC, len(header)) + header + payload
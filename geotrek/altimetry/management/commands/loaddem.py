@@ -2,8 +2,34 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
 from django.conf import settings
 import os.path
+import re
 from subprocess import call, PIPE
 import tempfile
+import time
+
+from geotrek.altimetry.helpers import AltimetryHelper
+
+
+class CopyData(object):
+    """File-like object streaming the data of a ``COPY ... FROM stdin``
+    statement out of raster2pgsql output lines, up to its end marker.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.count = 0
+        self.done = False
+
+    def read(self, size=-1):
+        if self.done:
+            return ''
+        line = next(self.lines, '\\.\n')
+        if line.rstrip('\r\n') == '\\.':
+            self.done = True
+            return ''
+        self.count += 1
+        return line
+
+    readline = read
 
 
 class Command(BaseCommand):
@@ -15,10 +41,21 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('dem_path')
         parser.add_argument('--replace', action='store_true', default=False, help='Replace existing DEM if any.')
+        parser.add_argument('--tile-size', dest='tile_size', default='100x100',
+                            help='Size of raster tiles, in pixels (WIDTHxHEIGHT), default 100x100.')
+        parser.add_argument('--overviews', dest='overviews', default='',
+                            help='Overview factors to build for coarse queries (ex: 4,16), default none.')
 
     def handle(self, *args, **options):
         verbose = options['verbosity'] != 0
 
+        tile_size = options['tile_size']
+        if not re.match(r'^\d+x\d+$', tile_size):
+            raise CommandError('Tile size should be given as WIDTHxHEIGHT (ex: 100x100).')
+        overviews = options['overviews']
+        if overviews and not re.match(r'^\d+(,\d+)*$', overviews):
+            raise CommandError('Overviews should be given as comma separated factors (ex: 4,16).')
+
         try:
             from osgeo import gdal, ogr, osr
         except ImportError:
@@ -101,11 +138,15 @@ class Command(BaseCommand):
 
         # What to do with existing DEM (if any)
         if dem_exists and replace:
-            # Drop table
+            # Drop table, and its overviews
             cur = connection.cursor()
+            cur.execute('SELECT o_table_name FROM raster_overviews WHERE r_table_name = \'mnt\'')
+            for (overview, ) in cur.fetchall():
+                cur.execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(overview))
             sql = 'DROP TABLE mnt'
             cur.execute(sql)
             cur.close()
+            AltimetryHelper.dem_changed()
         elif dem_exists and not replace:
             raise CommandError('DEM file exists, use --replace to overwrite')
 
@@ -116,6 +157,8 @@ class Command(BaseCommand):
         # so far. Therefore, we relay parameters to standard commands using
         # subprocesses.
 
+        start = time.time()
+
         # Step 1: process raster (clip, project)
         new_dem = tempfile.NamedTemporaryFile()
         cmd = 'gdalwarp -t_srs EPSG:%d -te %f %f %f %f %s %s %s' % (settings.SRID,
@@ -142,9 +185,11 @@ class Command(BaseCommand):
         if verbose:
             self.stdout.write('DEM successfully clipped/projected.\n')
 
-        # Step 2: Convert to PostGISRaster format
+        # Step 2: Convert to PostGISRaster format, with COPY statements
         output = tempfile.NamedTemporaryFile()  # SQL code for raster creation
-        cmd = 'raster2pgsql -c -C -I -M -t 100x100 %s mnt %s' % (
+        cmd = 'raster2pgsql -c -C -I -M -t %s -Y %s %s mnt %s' % (
+            tile_size,
+            '-l %s' % overviews if overviews else '',
             new_dem.name,
             '' if verbose else '2>/dev/null'
         )
@@ -161,23 +206,40 @@ class Command(BaseCommand):
             msg = 'Caught %s: %s' % (e.__class__.__name__, e,)
             raise CommandError(msg)
         finally:
+            size = os.path.getsize(new_dem.name) if os.path.exists(new_dem.name) else 0
             new_dem.close()
         if verbose:
             self.stdout.write('DEM successfully converted to SQL.\n')
 
-        # Step 3: Dump SQL code into database
+        # Step 3: Dump SQL code into database, streaming tiles with COPY
         if verbose:
             self.stdout.write('\n-- Loading DEM into database -----------\n')
-        cur = connection.cursor()
-        output.file.seek(0)
-        for sql_line in output.file:
-            cur.execute(sql_line)
-        cur.close()
+        tiles = self.load_sql(output.file)
         output.close()
+        AltimetryHelper.dem_changed()
         if verbose:
+            duration = time.time() - start
             self.stdout.write('DEM successfully loaded.\n')
+            self.stdout.write('{} tiles, {:.1f} MB in {:.1f}s ({:.1f} MB/s)\n'.format(
+                tiles, size / 1048576.0, duration, size / 1048576.0 / duration if duration else 0))
         return
 
+    def load_sql(self, output):
+        """Replays raster2pgsql output, and returns the number of tiles loaded"""
+        tiles = 0
+        cur = connection.cursor()
+        output.seek(0)
+        lines = iter(output.readline, '')
+        for sql_line in lines:
+            if sql_line.startswith('COPY '):
+                data = CopyData(lines)
+                cur.copy_expert(sql_line, data)
+                tiles += data.count
+            elif sql_line.strip():
+                cur.execute(sql_line)
+        cur.close()
+        return tiles
+
     def call_command_system(self, cmd, **kwargs):
         return_code = call(cmd, **kwargs)
         return return_code
@@ -1,21 +1,49 @@
 import logging
+import multiprocessing
+import os
+import tempfile
+import time
 
+from django.apps import apps
 from django.conf import settings
 from django.core.urlresolvers import NoReverseMatch
+from django.db import connections
+from django.utils import translation
+from mapentity.helpers import convertit_download, smart_urljoin
 
 from geotrek.common.management.commands.prepare_map_images import Command as PrepareImageCommand
 
+from geotrek.altimetry.helpers import AltimetryHelper
 from geotrek.altimetry.models import AltimetryMixin
+from geotrek.altimetry.views import HttpSVGResponse
 
 
 logger = logging.getLogger(__name__)
 
 
+def prepare_elevation_chart(task):
+    """Renders one chart, given as ``(model label, pk, language)``, in a worker process"""
+    label, pk, language = task
+    instance = apps.get_model(label).objects.get(pk=pk)
+    refreshed = instance.prepare_elevation_chart(language)
+    if not refreshed:
+        logger.info('%s profile up-to-date.' % instance.get_elevation_chart_path(language))
+    return refreshed
+
+
 class Command(PrepareImageCommand):
     help = "Generates all altimetric profiles"
 
     start_model_msg = "Generate all elevation charts model %s"
 
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--jobs', '-j', action='store', dest='jobs', type=int, default=1,
+                            help='Number of parallel processes, default 1')
+        parser.add_argument('--benchmark', action='store', dest='benchmark', type=int, default=0,
+                            help='Compare rendering time of N charts with their conversion from SVG by convertit '
+                                 '(requested from --url), without saving them')
+
     def get_models(self):
         with_profiles = []
         models = super(Command, self).get_models()
@@ -31,9 +59,60 @@ class Command(PrepareImageCommand):
                 pass
         return with_profiles
 
-    def handle_instance(self, instance):
-        rooturl = self.options.get('url', self.DEFAULT_URL)
-        for language, name in settings.MAPENTITY_CONFIG['TRANSLATED_LANGUAGES']:
-            refreshed = instance.prepare_elevation_chart(language, rooturl)
-            if not refreshed:
-                logger.info('%s profile up-to-date.' % instance.get_elevation_chart_path(language))
+    def handle(self, *args, **options):
+        self.options = options
+        languages = [language for language, name in settings.MAPENTITY_CONFIG['TRANSLATED_LANGUAGES']]
+        tasks = []
+        for model in self.get_models():
+            logger.info(self.start_model_msg % model._meta.verbose_name)
+            for pk in self.get_instances(model).values_list('pk', flat=True):
+                tasks.extend((model._meta.label, pk, language) for language in languages)
+
+        if options['benchmark']:
+            self.benchmark(tasks[:options['benchmark']])
+            return
+
+        basefolder = os.path.join(settings.MEDIA_ROOT, 'profiles')
+        if not os.path.exists(basefolder):
+            os.mkdir(basefolder)
+
+        start = time.time()
+        if options['jobs'] > 1:
+            # Worker processes must not share the database connection
+            connections.close_all()
+            pool = multiprocessing.Pool(options['jobs'])
+            try:
+                refreshed = sum(pool.imap_unordered(prepare_elevation_chart, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            refreshed = sum(prepare_elevation_chart(task) for task in tasks)
+        duration = time.time() - start
+        if options['verbosity'] > 0:
+            self.stdout.write("{} charts rendered, {} up-to-date, in {:.1f}s ({:.1f} charts/s)".format(
+                refreshed, len(tasks) - refreshed, duration, len(tasks) / duration if duration else 0))
+
+    def benchmark(self, tasks):
+        rooturl = self.options.get('url') or self.DEFAULT_URL
+        handle, path = tempfile.mkstemp(suffix='.png')
+        os.close(handle)
+        rendering, conversion = 0.0, 0.0
+        try:
+            for label, pk, language in tasks:
+                instance = apps.get_model(label).objects.get(pk=pk)
+                with translation.override(language):
+                    start = time.time()
+                    AltimetryHelper.profile_png(instance.get_elevation_profile(), path)
+                    rendering += time.time() - start
+                    start = time.time()
+                    convertit_download(smart_urljoin(rooturl, instance.get_elevation_chart_url()), path,
+                                       from_type=HttpSVGResponse.content_type, to_type='image/png',
+                                       headers={'Accept-Language': language})
+                    conversion += time.time() - start
+        finally:
+            os.remove(path)
+        count = len(tasks) or 1
+        self.stdout.write("{} charts: rendered in {:.3f}s per chart, converted by convertit in {:.3f}s per chart "
+                          "({:.1f}x)".format(len(tasks), rendering / count, conversion / count,
+                                             conversion / rendering if rendering else 0))
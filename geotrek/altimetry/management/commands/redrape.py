@@ -0,0 +1,110 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from geotrek.core.models import Path, Topology
+
+
+# Phases, in order: elevation of topologies is computed from their paths one
+PHASES = (
+    ('paths', 'redrape_troncons'),
+    ('topologies', 'redrape_evenements'),
+)
+
+
+def redrape_batch(task):
+    """Recomputes elevation of a batch, given as ``(function, ids)``,
+    in its own transaction (possibly in a worker process).
+    """
+    function, ids = task
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT {}(%s::integer[])'.format(function), [ids])
+        updated = cursor.fetchone()[0]
+    return ids[0], ids[-1], len(ids), updated
+
+
+class Command(BaseCommand):
+    help = 'Recompute 3D geometries and elevation of all paths and topologies (e.g. after loaddem --replace)\n'
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=500,
+                            help='Number of objects per batch, default 500')
+        parser.add_argument('--jobs', '-j', action='store', dest='jobs', type=int, default=1,
+                            help='Number of parallel processes, default 1')
+        parser.add_argument('--resume', action='store_true', dest='resume', default=False,
+                            help='Skip batches done by a previous interrupted run')
+        parser.add_argument('--state-file', action='store', dest='state_file',
+                            default=os.path.join(tempfile.gettempdir(), 'geotrek_redrape.json'),
+                            help='File where progress is saved for --resume')
+
+    def progress(self, message, *args):
+        if self.verbosity > 0:
+            self.stdout.write(message.format(*args))
+
+    def phase(self, name, start):
+        self.progress(u"{} done in {:.1f}s", name, time.time() - start)
+        return time.time()
+
+    def load_state(self, filename, resume):
+        """Ranges of ids (by phase) done by previous run"""
+        if not resume or not os.path.exists(filename):
+            return {phase: [] for phase, function in PHASES}
+        with open(filename) as f:
+            return json.load(f)
+
+    def save_state(self, filename, state):
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(filename + '.tmp', filename)
+
+    def get_ids(self, phase):
+        if phase == 'paths':
+            qs = Path.include_invisible.all()
+        else:
+            qs = Topology.objects.existing()
+        return list(qs.order_by('pk').values_list('pk', flat=True))
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity')
+        batch_size = options['batch_size']
+        jobs = options['jobs']
+        state_file = options['state_file']
+        if batch_size < 1:
+            raise CommandError('Batch size must be positive')
+        if jobs < 1:
+            raise CommandError('Number of jobs must be positive')
+
+        state = self.load_state(state_file, options['resume'])
+        self.save_state(state_file, state)
+        pool = None
+        if jobs > 1:
+            # Worker processes must not share the database connection
+            connections.close_all()
+            pool = multiprocessing.Pool(jobs)
+        try:
+            for phase, function in PHASES:
+                start = time.time()
+                done = state[phase]
+                ids = [pk for pk in self.get_ids(phase)
+                       if not any(first <= pk <= last for first, last in done)]
+                tasks = [(function, ids[i:i + batch_size]) for i in range(0, len(ids), batch_size)]
+                results = pool.imap_unordered(redrape_batch, tasks) if pool else (redrape_batch(task) for task in tasks)
+                processed = updated = 0
+                for first, last, size, count in results:
+                    done.append((first, last))
+                    self.save_state(state_file, state)
+                    processed += size
+                    updated += count
+                    self.progress(u"{}/{} {} processed", processed, len(ids), phase)
+                self.phase(u"Elevation of {} {}".format(updated, phase), start)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        os.unlink(state_file)
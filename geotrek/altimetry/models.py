@@ -2,10 +2,11 @@ import os
 
 from django.conf import settings
 from django.contrib.gis.db import models
+from django.utils import translation
 from django.utils.translation import get_language, ugettext_lazy as _
 from django.urls import reverse
 
-from mapentity.helpers import is_file_newer, convertit_download, smart_urljoin
+from mapentity.helpers import is_file_newer
 from .helpers import AltimetryHelper
 
 
@@ -48,7 +49,15 @@ class AltimetryMixin(models.Model):
         return self
 
     def get_elevation_profile(self):
-        return AltimetryHelper.elevation_profile(self.geom_3d)
+        if self.geom_3d is None:
+            return []
+        # Shared by JSON, SVG and PNG outputs, computed once per geometry
+        key = AltimetryHelper.profile_cache_key(self.geom_3d)
+        cached = getattr(self, '_elevation_profile', None)
+        if cached is None or cached[0] != key:
+            cached = (key, AltimetryHelper.cached_elevation_profile(self.geom_3d))
+            self._elevation_profile = cached
+        return cached[1]
 
     def get_elevation_area(self):
         return AltimetryHelper.elevation_area(self.geom)
@@ -77,19 +86,14 @@ class AltimetryMixin(models.Model):
             os.mkdir(basefolder)
         return os.path.join(basefolder, '%s-%s-%s.png' % (self._meta.model_name, self.pk, language))
 
-    def prepare_elevation_chart(self, language, rooturl):
-        """Converts SVG elevation URI to PNG on disk.
+    def prepare_elevation_chart(self, language, rooturl=None):
+        """Renders elevation chart as PNG on disk.
+        ``rooturl`` is not used anymore, since chart is not converted from SVG.
         """
-        from .views import HttpSVGResponse
         path = self.get_elevation_chart_path(language)
         # Do nothing if image is up-to-date
         if is_file_newer(path, self.date_update):
             return False
-        # Download converted chart as png using convertit
-        source = smart_urljoin(rooturl, self.get_elevation_chart_url())
-        convertit_download(source,
-                           path,
-                           from_type=HttpSVGResponse.content_type,
-                           to_type='image/png',
-                           headers={'Accept-Language': language})
+        with translation.override(language):
+            AltimetryHelper.profile_png(self.get_elevation_profile(), path)
         return True
@@ -2,3 +2,9 @@
 DROP FUNCTION IF EXISTS public.ft_drape_line(geometry, integer) CASCADE;
 DROP FUNCTION IF EXISTS public.add_point_elevation(geometry) CASCADE;
 DROP FUNCTION IF EXISTS public.ft_elevation_infos(geometry) CASCADE;
+
+-- Former signatures, before optional arguments were added
+DROP FUNCTION IF EXISTS geotrek.ft_smooth_line(geometry, integer) CASCADE;
+DROP FUNCTION IF EXISTS geotrek.ft_drape_line(geometry, integer) CASCADE;
+DROP FUNCTION IF EXISTS geotrek.ft_elevation_infos(geometry, float) CASCADE;
+DROP FUNCTION IF EXISTS geotrek.add_point_elevation(geometry) CASCADE;
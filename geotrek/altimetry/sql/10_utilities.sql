@@ -12,6 +12,12 @@ CREATE TYPE elevation_infos AS (
     negative_gain integer
 );
 
+-- DEM availability: lookup in catalog, much cheaper than raster_columns view
+CREATE OR REPLACE FUNCTION geotrek.ft_dem_available() RETURNS boolean AS $$
+    SELECT EXISTS(SELECT 1 FROM pg_catalog.pg_class
+                  WHERE relname = 'mnt' AND relkind = 'r' AND pg_table_is_visible(oid));
+$$ LANGUAGE sql STABLE;
+
 CREATE OR REPLACE FUNCTION geotrek.ft_smooth_line(geom geometry)
   RETURNS SETOF geometry AS $$
 DECLARE
@@ -45,7 +51,8 @@ $$ LANGUAGE plpgsql;
 
 CREATE OR REPLACE FUNCTION geotrek.ft_smooth_line(
     linegeom geometry,
-    step integer)
+    step integer,
+    set_based boolean DEFAULT {{ALTIMETRIC_SET_BASED_SQL}})
   RETURNS SETOF geometry AS $$
 -- function moving average on altitude lines with specified step
 
@@ -64,6 +71,17 @@ BEGIN
         RETURN QUERY SELECT * FROM ft_smooth_line(linegeom);
     END IF;
 
+    IF set_based THEN
+        -- Average of the elevation of points within step, as a window
+        RETURN QUERY
+            SELECT ST_SetSRID(ST_MakePoint(ST_X(dp.geom), ST_Y(dp.geom),
+                                           (avg(ST_Z(dp.geom)) OVER w)::integer), ST_SRID(linegeom))
+            FROM ST_DumpPoints(linegeom) AS dp
+            WINDOW w AS (ORDER BY dp.path ROWS BETWEEN step PRECEDING AND step FOLLOWING)
+            ORDER BY dp.path;
+        RETURN;
+    END IF;
+
     FOR element in SELECT (ST_DumpPoints(linegeom)).geom LOOP
 		points := array_append(points, element);
     END LOOP;
@@ -94,22 +112,48 @@ END;
 
 $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE FUNCTION geotrek.ft_drape_line(linegeom geometry, step integer)
+CREATE OR REPLACE FUNCTION geotrek.ft_drape_line(linegeom geometry, step integer,
+                                                 set_based boolean DEFAULT {{ALTIMETRIC_SET_BASED_SQL}})
     RETURNS SETOF geometry AS $$
 DECLARE
     points geometry[];
-result geometry[];
+    result geometry[];
+    -- Checked once for all points
+    dem_available boolean := ft_dem_available();
 BEGIN
     -- Use sampling steps for draping geometry on DEM
     -- http://blog.mathieu-leplatre.info/drape-lines-on-a-dem-with-postgis.html
     -- But make sure to keep original points so 2D geometry and length is preserved
     -- Step is the maximal distance between two points
 
-    IF ST_ZMin(linegeom) < 0 OR ST_ZMax(linegeom) > 0 THEN
+    IF ST_Zmflag(linegeom) >= 2 THEN
         -- Already 3D, do not need to drape.
-        -- (Use-case is when assembling paths geometries to build topologies)
+        -- (Use-case is when assembling paths geometries to build topologies:
+        -- their elevation is taken from paths, even if null, and never sampled again)
         RETURN QUERY SELECT (ST_DumpPoints(ST_Force3D(linegeom))).geom AS geom;
 
+    ELSIF set_based AND dem_available THEN
+        RETURN QUERY
+            WITH -- Same points as below
+                 r1 AS (SELECT ST_PointN(linegeom, generate_series(1, ST_NPoints(linegeom)-1)) as p1,
+                               ST_PointN(linegeom, generate_series(2, ST_NPoints(linegeom))) as p2,
+                               generate_series(2, ST_NPoints(linegeom)) = ST_NPoints(linegeom) as is_last),
+                 r2 AS (SELECT p1, p2, is_last, trunc(ST_Distance(p1, p2) / step)::integer + 1 AS n FROM r1),
+                 r3 AS (SELECT p1, p2, generate_series(0, CASE WHEN is_last THEN n ELSE n - 1 END)/n::double precision AS f FROM r2),
+                 r4 AS (SELECT row_number() OVER () AS i,
+                               ST_SetSRID(ST_MakePoint(ST_X(p1) + (ST_X(p2) - ST_X(p1)) * f,
+                                                       ST_Y(p1) + (ST_Y(p2) - ST_Y(p1)) * f), ST_SRID(p1)) as p
+                        FROM r3)
+            -- Get elevation of all points in the same query (as add_point_elevation() does)
+            SELECT ST_SetSRID(ST_MakePoint(ST_X(r4.p), ST_Y(r4.p),
+                                           CASE WHEN v.found THEN v.ele ELSE 0 END), ST_SRID(r4.p))
+            FROM r4
+            LEFT JOIN LATERAL (SELECT true AS found, ST_Value(rast, 1, r4.p)::integer AS ele
+                               FROM mnt
+                               WHERE ST_Intersects(rast, r4.p)
+                               LIMIT 1) AS v ON true
+            ORDER BY r4.i;
+
     ELSE
         RETURN QUERY
             WITH -- Get endings of each segment of the line
@@ -126,7 +170,7 @@ BEGIN
                                ST_SRID(p1) AS srid FROM r3),
                  -- Set SRID of new points
                  r5 AS (SELECT ST_SetSRID(p, srid) as p FROM r4)
-            SELECT add_point_elevation(p) FROM r5;
+            SELECT add_point_elevation(p, dem_available) FROM r5;
 
     END IF;
 END;
@@ -134,7 +178,8 @@ $$ LANGUAGE plpgsql;
 
 
 
-CREATE OR REPLACE FUNCTION geotrek.add_point_elevation(geom geometry) RETURNS geometry AS $$
+CREATE OR REPLACE FUNCTION geotrek.add_point_elevation(geom geometry, dem_available boolean DEFAULT NULL)
+    RETURNS geometry AS $$
 DECLARE
     ele integer;
     geom3d geometry;
@@ -144,9 +189,8 @@ BEGIN
         RETURN geom;
     END IF;
 
-    -- Ensure we have a DEM
-    PERFORM * FROM raster_columns WHERE r_table_name = 'mnt';
-    IF FOUND THEN
+    -- Ensure we have a DEM (unless already checked by caller)
+    IF coalesce(dem_available, ft_dem_available()) THEN
         SELECT ST_Value(rast, 1, geom)::integer INTO ele
         FROM mnt
         WHERE ST_Intersects(rast, geom);
@@ -173,8 +217,7 @@ DECLARE
     result elevation_infos;
 BEGIN
     -- Skip if no DEM (speed-up tests)
-    PERFORM * FROM raster_columns WHERE r_table_name = 'mnt';
-    IF NOT FOUND THEN
+    IF NOT ft_dem_available() THEN
         SELECT ST_Force3DZ(geom), 0.0, 0, 0, 0, 0 INTO result;
         RETURN result;
     END IF;
@@ -228,7 +271,9 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE FUNCTION geotrek.ft_elevation_infos(geom geometry, epsilon float) RETURNS elevation_infos AS $$
+CREATE OR REPLACE FUNCTION geotrek.ft_elevation_infos(geom geometry, epsilon float,
+                                                      set_based boolean DEFAULT {{ALTIMETRIC_SET_BASED_SQL}})
+    RETURNS elevation_infos AS $$
 DECLARE
     num_points integer;
     current geometry;
@@ -239,8 +284,7 @@ DECLARE
     previous_geom geometry;
 BEGIN
     -- Skip if no DEM (speed-up tests)
-    PERFORM * FROM raster_columns WHERE r_table_name = 'mnt';
-    IF NOT FOUND THEN
+    IF NOT ft_dem_available() THEN
         SELECT ST_Force3DZ(geom), 0.0, 0, 0, 0, 0 INTO result;
         RETURN result;
     END IF;
@@ -267,43 +311,64 @@ BEGIN
 
     -- Now geom is LineString only.
 
-
-    result.positive_gain := 0;
-    result.negative_gain := 0;
-    points3d := ARRAY[]::geometry[];
-    points3d_smoothed := ARRAY[]::geometry[];
-    points3d_simplified := ARRAY[]::geometry[];
-
-    FOR current IN SELECT * FROM ft_drape_line(geom, {{ALTIMETRIC_PROFILE_PRECISION}}) LOOP
-        -- Create the 3d points
-        points3d := array_append(points3d, current);
-    END LOOP;
-
-    -- smoothing line
-    FOR current IN SELECT * FROM ft_smooth_line(St_MakeLine(points3d), {{ALTIMETRIC_PROFILE_AVERAGE}}) LOOP
-        -- Create the 3d points
-        points3d_smoothed := array_append(points3d_smoothed, current);
-    END LOOP;
-
-    -- simplify gain calculs
-
-    previous_geom := NULL;
-
-    -- Compute gain using simplification
-    -- see http://www.postgis.org/docs/ST_Simplify.html
-    --     https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
-    FOR current IN SELECT (ST_DUMPPOINTS(ST_MAKELINE(points3d_smoothed))).geom
-    LOOP
-        -- Add positive only if current - previous_geom > 0
-	result.positive_gain := result.positive_gain + greatest(ST_Z(current) - coalesce(ST_Z(previous_geom),
-								ST_Z(current)), 0);
-	-- Add negative only if current - previous_geom < 0
-	result.negative_gain := result.negative_gain + least(ST_Z(current) - coalesce(ST_Z(previous_geom),
-							     ST_Z(current)), 0);
-	previous_geom := current;
-    END LOOP;
-
-    result.draped := ST_SetSRID(ST_MakeLine(points3d_smoothed), ST_SRID(geom));
+    IF set_based THEN
+        -- Drape, smooth, and sum elevation differences of successive points
+        WITH draped AS (
+                SELECT row_number() OVER () AS i, p
+                FROM ft_drape_line(geom, {{ALTIMETRIC_PROFILE_PRECISION}}, true) AS p
+            ),
+            smoothed AS (
+                SELECT row_number() OVER () AS i, p
+                FROM ft_smooth_line((SELECT ST_MakeLine(p ORDER BY i) FROM draped),
+                                    {{ALTIMETRIC_PROFILE_AVERAGE}}, true) AS p
+            ),
+            differences AS (
+                SELECT i, p, ST_Z(p) - lag(ST_Z(p)) OVER (ORDER BY i) AS difference
+                FROM smoothed
+            )
+        SELECT ST_SetSRID(ST_MakeLine(p ORDER BY i), ST_SRID(geom)),
+               coalesce(sum(greatest(difference, 0)), 0),
+               coalesce(sum(least(difference, 0)), 0)
+        INTO result.draped, result.positive_gain, result.negative_gain
+        FROM differences;
+    ELSE
+        result.positive_gain := 0;
+        result.negative_gain := 0;
+        points3d := ARRAY[]::geometry[];
+        points3d_smoothed := ARRAY[]::geometry[];
+        points3d_simplified := ARRAY[]::geometry[];
+
+        FOR current IN SELECT * FROM ft_drape_line(geom, {{ALTIMETRIC_PROFILE_PRECISION}}, false) LOOP
+            -- Create the 3d points
+            points3d := array_append(points3d, current);
+        END LOOP;
+
+        -- smoothing line
+        FOR current IN SELECT * FROM ft_smooth_line(St_MakeLine(points3d), {{ALTIMETRIC_PROFILE_AVERAGE}}, false) LOOP
+            -- Create the 3d points
+            points3d_smoothed := array_append(points3d_smoothed, current);
+        END LOOP;
+
+        -- simplify gain calculs
+
+        previous_geom := NULL;
+
+        -- Compute gain using simplification
+        -- see http://www.postgis.org/docs/ST_Simplify.html
+        --     https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
+        FOR current IN SELECT (ST_DUMPPOINTS(ST_MAKELINE(points3d_smoothed))).geom
+        LOOP
+            -- Add positive only if current - previous_geom > 0
+            result.positive_gain := result.positive_gain + greatest(ST_Z(current) - coalesce(ST_Z(previous_geom),
+                                                                    ST_Z(current)), 0);
+            -- Add negative only if current - previous_geom < 0
+            result.negative_gain := result.negative_gain + least(ST_Z(current) - coalesce(ST_Z(previous_geom),
+                                                                 ST_Z(current)), 0);
+            previous_geom := current;
+        END LOOP;
+
+        result.draped := ST_SetSRID(ST_MakeLine(points3d_smoothed), ST_SRID(geom));
+    END IF;
 
     -- Compute elevation using (higher resolution)
     result.min_elevation := ST_ZMin(result.draped)::integer;
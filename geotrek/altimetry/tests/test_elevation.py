@@ -6,13 +6,19 @@ from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.test.utils import override_settings
 
+from geotrek.common.tests.benchmark import benchmark, duration, report
 from geotrek.core.models import Path
 from geotrek.core.factories import TopologyFactory
 from geotrek.altimetry.helpers import AltimetryHelper
 
+import json
 import os
+import struct
 import sys
+import tempfile
+import zlib
 import mock
+from PIL import Image
 from StringIO import StringIO
 
 
@@ -52,6 +58,29 @@ class ElevationTest(TestCase):
         self.assertEqual(profile[5][3], 20.0)
         self.assertEqual(profile[6][3], 22.0)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                               'fat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_elevation_profile_computed_once(self):
+        with mock.patch.object(AltimetryHelper, 'elevation_profile',
+                               wraps=AltimetryHelper.elevation_profile) as compute:
+            self.path.get_elevation_profile()
+            self.path.get_elevation_limits()
+            self.path.get_elevation_profile_svg()
+            self.assertEqual(compute.call_count, 1)
+            self.path.geom = LineString((78, 117), (3, 27))
+            self.path.save()
+            self.path.get_elevation_profile()
+            self.assertEqual(compute.call_count, 2)
+
+    def test_elevation_profile_png(self):
+        handle, filename = tempfile.mkstemp(suffix='.png')
+        os.close(handle)
+        self.addCleanup(os.remove, filename)
+        AltimetryHelper.profile_png(self.path.get_elevation_profile(), filename)
+        image = Image.open(filename)
+        self.assertEqual(image.format, 'PNG')
+        self.assertEqual(image.size, (settings.ALTIMETRIC_PROFILE_WIDTH, settings.ALTIMETRIC_PROFILE_HEIGHT))
+
     def test_elevation_limits(self):
         limits = self.path.get_elevation_limits()
         self.assertEqual(limits[0], 1106)
@@ -69,6 +98,26 @@ class ElevationTest(TestCase):
         self.assertEqual(topo.max_elevation, 17)
         self.assertEqual(len(topo.geom_3d.coords), 5)
 
+    def test_redrape_after_dem_change(self):
+        topo = TopologyFactory.create(no_path=True)
+        topo.add_path(self.path, start=0.2, end=0.8)
+        topo.save()
+        cur = connections[DEFAULT_DB_ALIAS].cursor()
+        cur.execute("UPDATE mnt SET rast = ST_MapAlgebra(rast, 1, NULL, '[rast] + 100')")
+        handle, state_file = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        output = StringIO()
+        call_command('redrape', batch_size=1, state_file=state_file, stdout=output)
+        self.assertIn('Elevation of 1 paths done', output.getvalue())
+        self.assertFalse(os.path.exists(state_file))
+        path = Path.objects.get(pk=self.path.pk)
+        self.assertEqual(path.min_elevation, 106)
+        self.assertEqual(path.max_elevation, 122)
+        self.assertEqual(path.ascent, 16)
+        topo.reload()
+        self.assertEqual(topo.min_elevation, 110)
+        self.assertEqual(topo.max_elevation, 117)
+
     def test_elevation_topology_point(self):
         topo = TopologyFactory.create(no_path=True)
         topo.add_path(self.path, start=0.6, end=0.6)
@@ -89,6 +138,17 @@ class ElevationTest(TestCase):
         self.assertEqual(topo.min_elevation, 15)
         self.assertEqual(topo.max_elevation, 15)
 
+    def test_elevation_topology_from_paths(self):
+        # Path elevation is not sampled again for its topologies, even if flat
+        cur = connections[DEFAULT_DB_ALIAS].cursor()
+        cur.execute('UPDATE l_t_troncon SET geom_3d = ST_Force3DZ(geom) WHERE id = %s', [self.path.pk])
+        topo = TopologyFactory.create(no_path=True)
+        topo.add_path(self.path, start=0.2, end=0.8)
+        topo.save()
+        self.assertEqual(topo.min_elevation, 0)
+        self.assertEqual(topo.max_elevation, 0)
+        self.assertEqual(topo.ascent, 0)
+
     def test_elevation_topology_outside_dem(self):
         outside_path = Path.objects.create(geom=LineString((200, 200), (300, 300)))
         topo = TopologyFactory.create(no_path=True)
@@ -110,6 +170,51 @@ class ElevationProfileTest(TestCase):
         profile = AltimetryHelper.elevation_profile(geom)
         self.assertEqual(len(profile), 4)
 
+    def test_elevation_profile_distances(self):
+        geom = LineString((0, 0, 8), (3, 4, 10), (3, 10, 12), srid=settings.SRID)
+        with self.assertNumQueries(0):
+            profile = AltimetryHelper.elevation_profile(geom)
+        self.assertEqual([v[0] for v in profile], [0.0, 5.0, 11.0])
+        self.assertEqual([v[3] for v in profile], [8, 10, 12])
+        geomapi = geom.transform(settings.API_SRID, clone=True)
+        self.assertEqual([v[1:] for v in profile], list(geomapi.coords))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                               'fat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_elevation_profile_cached(self):
+        geom = LineString((1.5, 2.5, 8), (2.5, 2.5, 10), srid=settings.SRID)
+        with mock.patch.object(AltimetryHelper, 'elevation_profile',
+                               wraps=AltimetryHelper.elevation_profile) as compute:
+            profile = AltimetryHelper.cached_elevation_profile(geom)
+            self.assertEqual(AltimetryHelper.cached_elevation_profile(geom.clone()), profile)
+            self.assertEqual(compute.call_count, 1)
+            # Modified geometry or precision
+            AltimetryHelper.cached_elevation_profile(LineString((1.5, 2.5, 8), (2.5, 2.5, 12), srid=settings.SRID))
+            AltimetryHelper.cached_elevation_profile(geom, precision=10)
+            self.assertEqual(compute.call_count, 3)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                               'fat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_dem_info_overviews_cached(self):
+        self.assertEqual(AltimetryHelper.dem_info(), (False, []))
+        cur = connections[DEFAULT_DB_ALIAS].cursor()
+        cur.execute('CREATE TABLE mnt (rid serial primary key, rast raster)')
+        self.assertEqual(AltimetryHelper.dem_info(), (True, []))
+        # Only availability is checked
+        with self.assertNumQueries(1):
+            self.assertEqual(AltimetryHelper.dem_info(), (True, []))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                               'fat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_elevation_area_after_dem_dropped(self):
+        cur = connections[DEFAULT_DB_ALIAS].cursor()
+        cur.execute('CREATE TABLE mnt (rid serial primary key, rast raster)')
+        self.assertEqual(AltimetryHelper.dem_info(), (True, []))
+        cur.execute('DROP TABLE mnt')
+        geom = LineString((100, 370), (1100, 370), srid=settings.SRID)
+        self.assertEqual(AltimetryHelper.elevation_area(geom), {})
+        self.assertEqual(AltimetryHelper.dem_info(), (False, []))
+
     def test_elevation_svg_output(self):
         geom = LineString((1.5, 2.5, 8), (2.5, 2.5, 10),
                           srid=settings.SRID)
@@ -203,6 +308,19 @@ class ElevationAreaTest(TestCase):
         self.assertEqual(extent['altitudes']['max'], 45)
         self.assertEqual(extent['altitudes']['min'], 0)
 
+    def test_area_binary_encoding(self):
+        content = AltimetryHelper.elevation_area_binary(self.area, compression='zlib')
+        magic, length = struct.unpack('<4sI', content[:8])
+        self.assertEqual(magic, 'GTD1')
+        header = json.loads(content[8:8 + length])
+        self.assertEqual(header['resolution'], self.area['resolution'])
+        self.assertEqual(header['encoding'], {'type': 'int16', 'compression': 'zlib'})
+        self.assertNotIn('altitudes', header)
+        payload = zlib.decompress(content[8 + length:])
+        altitudes = struct.unpack('<%dh' % (53 * 33), payload)
+        self.assertEqual(list(altitudes[:53]), self.area['altitudes'][0])
+        self.assertEqual(list(altitudes[-53:]), self.area['altitudes'][-1])
+
 
 class LengthTest(TestCase):
 
@@ -229,6 +347,74 @@ class LengthTest(TestCase):
         self.assertEqual(round(self.path.length, 9), 83.127128724)
 
 
+class SetBasedMixin(object):
+    def setUp(self):
+        # Create a simple fake DEM
+        conn = connections[DEFAULT_DB_ALIAS]
+        self.cur = conn.cursor()
+        self.cur.execute('CREATE TABLE mnt (rid serial primary key, rast raster)')
+        self.cur.execute('INSERT INTO mnt (rast) VALUES (ST_MakeEmptyRaster(100, 125, 0, 125, 25, -25, 0, 0, %s))', [settings.SRID])
+        self.cur.execute('UPDATE mnt SET rast = ST_AddBand(rast, \'16BSI\')')
+        demvalues = [[0, 0, 3, 5], [2, 2, 10, 15], [5, 15, 20, 25], [20, 25, 30, 35], [30, 35, 40, 45]]
+        for y in range(0, 5):
+            for x in range(0, 4):
+                self.cur.execute('UPDATE mnt SET rast = ST_SetValue(rast, %s, %s, %s::float)', [x + 1, y + 1, demvalues[y][x]])
+        self.geom = self.zigzag(1000)
+
+    def zigzag(self, vertices):
+        """Line zigzaging over the DEM"""
+        return LineString([((i * 37) % 100 + 0.5, (i * 53) % 125 + 0.5) for i in range(vertices)], srid=settings.SRID)
+
+    def both(self, sql):
+        results = []
+        for set_based in (True, False):
+            self.cur.execute(sql, {'geom': self.geom.ewkt, 'set_based': set_based})
+            results.append(self.cur.fetchall())
+        return results
+
+    drape_line = ("SELECT ST_AsEWKT(ST_MakeLine(p)) "
+                  "FROM ft_drape_line(%(geom)s::geometry, 25, %(set_based)s) AS p")
+    smooth_line = ("SELECT ST_AsEWKT(ST_MakeLine(p)) "
+                   "FROM ft_smooth_line(ST_MakeLine(ARRAY(SELECT ft_drape_line(%(geom)s::geometry, 25))), "
+                   "2, %(set_based)s) AS p")
+    elevation_infos = ("SELECT ST_AsEWKT(draped), slope, min_elevation, max_elevation, "
+                       "positive_gain, negative_gain "
+                       "FROM ft_elevation_infos(%(geom)s::geometry, 1, %(set_based)s)")
+
+
+class SetBasedTest(SetBasedMixin, TestCase):
+    """Set-based and iterative implementations give the same results"""
+
+    def test_drape_line(self):
+        set_based, loop = self.both(self.drape_line)
+        self.assertEqual(set_based, loop)
+
+    def test_smooth_line(self):
+        set_based, loop = self.both(self.smooth_line)
+        self.assertEqual(set_based, loop)
+
+    def test_elevation_infos(self):
+        set_based, loop = self.both(self.elevation_infos)
+        self.assertEqual(set_based, loop)
+        self.assertTrue(set_based[0][4] > 0)
+
+
+class SetBasedBenchmark(SetBasedMixin, TestCase):
+    """Set-based and iterative implementations on 1k and 10k vertices lines"""
+
+    @benchmark
+    def test_set_based(self):
+        results = []
+        for vertices in (1000, 10000):
+            geom = self.zigzag(vertices).ewkt
+            for name in ('drape_line', 'smooth_line', 'elevation_infos'):
+                for set_based in (True, False):
+                    seconds = duration(self.cur.execute, getattr(self, name), {'geom': geom, 'set_based': set_based})
+                    results.append(('{} {} vertices{}'.format(name, vertices, ' set-based' if set_based else ''),
+                                    seconds))
+        report(self.id(), results)
+
+
 class SamplingTest(TestCase):
 
     step = settings.ALTIMETRIC_PROFILE_PRECISION
@@ -330,6 +516,30 @@ class CommandLoadDemTest(TestCase):
         self.assertAlmostEqual(cur.fetchone()[0], 343.600006103516)
         cur.execute('DROP TABLE mnt;')
 
+    def test_success_with_overviews(self):
+        output_stdout = StringIO()
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'elevation.tif')
+        call_command('loaddem', filename, '--replace', '--tile-size', '50x50', '--overviews', '2',
+                     verbosity=2, stdout=output_stdout)
+        self.assertIn('DEM successfully loaded.', output_stdout.getvalue())
+        self.assertIn('MB/s', output_stdout.getvalue())
+        conn = connections[DEFAULT_DB_ALIAS]
+        cur = conn.cursor()
+        cur.execute('SELECT ST_Width(rast), ST_Height(rast) FROM mnt ORDER BY rid LIMIT 1;')
+        self.assertEqual(cur.fetchone(), (50, 50))
+        cur.execute('SELECT overview_factor FROM raster_overviews WHERE r_table_name = \'mnt\';')
+        self.assertEqual(cur.fetchone()[0], 2)
+        # Overviews are replaced too
+        call_command('loaddem', filename, '--replace', '--overviews', '2', verbosity=0)
+        cur.execute('DROP TABLE o_2_mnt;')
+        cur.execute('DROP TABLE mnt;')
+
+    def test_fail_tile_size(self):
+        filename = os.path.join(os.path.dirname(__file__), 'data', 'elevation.tif')
+        with self.assertRaises(CommandError) as e:
+            call_command('loaddem', filename, '--tile-size', '100', verbosity=0)
+        self.assertEqual('Tile size should be given as WIDTHxHEIGHT (ex: 100x100).', e.exception.message)
+
     def test_fail_table_mnt(self):
         """
         The table mnt already exist
@@ -411,3 +621,12 @@ class CommandLoadDemTest(TestCase):
         with self.assertRaises(CommandError) as e:
             call_command('loaddem', filename, '--replace', verbosity=0)
         self.assertEqual('DEM extent is unknown.', e.exception.message)
+
+
+class CommandPrepareElevationChartsTest(TestCase):
+    def test_benchmark(self):
+        Path.objects.create(geom=LineString((78, 117), (3, 17)))
+        output = StringIO()
+        call_command('prepare_elevation_charts', benchmark=1, stdout=output, verbosity=0)
+        self.assertIn('1 charts: rendered in', output.getvalue())
+        self.assertIn('converted by convertit in', output.getvalue())
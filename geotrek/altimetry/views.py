@@ -1,7 +1,7 @@
 import os
 
 from django.views.generic.edit import BaseDetailView
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
@@ -11,10 +11,11 @@ from django.conf import settings
 from django.views import static
 
 from mapentity.decorators import view_cache_response_content
-from mapentity.views import JSONResponseMixin, LastModifiedMixin
+from mapentity.views import JSONResponseMixin, LastModifiedMixin, HttpJSONResponse
 
 from geotrek.common.views import PublicOrReadPermMixin
 
+from .helpers import AltimetryHelper, BINARY_AREA_CONTENT_TYPE
 from .models import AltimetryMixin
 
 
@@ -26,6 +27,14 @@ class HttpSVGResponse(HttpResponse):
         super(HttpSVGResponse, self).__init__(content, **kwargs)
 
 
+class HttpBinaryAreaResponse(HttpResponse):
+    content_type = BINARY_AREA_CONTENT_TYPE
+
+    def __init__(self, content='', **kwargs):
+        kwargs['content_type'] = self.content_type
+        super(HttpBinaryAreaResponse, self).__init__(content, **kwargs)
+
+
 class ElevationChart(LastModifiedMixin, BaseDetailView):
 
     @method_decorator(login_required)
@@ -57,13 +66,34 @@ class ElevationProfile(LastModifiedMixin, JSONResponseMixin,
 
 class ElevationArea(LastModifiedMixin, JSONResponseMixin, PublicOrReadPermMixin,
                     BaseDetailView):
-    """Extract elevation profile on an area and return it as JSON"""
+    """Extract elevation profile on an area and return it as JSON.
+
+    With ``?_format=binary``, the area is returned with a compact encoding
+    (see ``AltimetryHelper.elevation_area_binary``), and ``&_compression=zlib``
+    compresses its altitudes. Parameters are prefixed with ``_`` for the
+    response to be cached (see ``view_cache_response_content``).
+    """
+
+    @property
+    def binary(self):
+        return self.request.GET.get('_format') == 'binary'
+
+    @property
+    def response_class(self):
+        """Also used by the ``view_cache_response_content`` decorator.
+        """
+        return HttpBinaryAreaResponse if self.binary else HttpJSONResponse
 
     def view_cache_key(self):
         """Used by the ``view_cache_response_content`` decorator.
         """
         obj = self.get_object()
-        return 'altimetry_dem_area_%s' % obj.pk
+        if not self.binary:
+            return 'altimetry_dem_area_%s' % obj.pk
+        compression = self.request.GET.get('_compression')
+        if compression not in (None, 'zlib'):
+            return None  # Do not cache errors
+        return 'altimetry_dem_area_%s_binary_%s' % (obj.pk, compression)
 
     @view_cache_response_content()
     def dispatch(self, *args, **kwargs):
@@ -72,6 +102,15 @@ class ElevationArea(LastModifiedMixin, JSONResponseMixin, PublicOrReadPermMixin,
     def get_context_data(self, **kwargs):
         return self.object.get_elevation_area()
 
+    def render_to_response(self, context, **response_kwargs):
+        if not self.binary:
+            return super(ElevationArea, self).render_to_response(context, **response_kwargs)
+        try:
+            content = AltimetryHelper.elevation_area_binary(context, self.request.GET.get('_compression'))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        return self.response_class(content, **response_kwargs)
+
 
 def serve_elevation_chart(request, model_name, pk, from_command=False):
     model = get_object_or_404(ContentType, model=model_name).model_class()
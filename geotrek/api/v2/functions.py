@@ -26,6 +26,36 @@ def GeometryType(geom):
     return Func(geom, function='GeometryType', output_field=CharField())
 
 
+def StartPoint(geom):
+    """
+    ST_StartPoint postgis function
+    """
+    return Func(geom, function='ST_StartPoint', output_field=GeometryField())
+
+
+def EndPoint(geom):
+    """
+    ST_EndPoint postgis function
+    """
+    return Func(geom, function='ST_EndPoint', output_field=GeometryField())
+
+
+class X(Func):
+    """
+    ST_X postgis function
+    """
+    function = 'ST_X'
+    output_field = FloatField()
+
+
+class Y(Func):
+    """
+    ST_Y postgis function
+    """
+    function = 'ST_Y'
+    output_field = FloatField()
+
+
 class Length(Func):
     """
     ST_LENGTH postgis function
@@ -0,0 +1,67 @@
+# -*- encoding: utf-8 -*-
+"""
+Benchmarks are long: they are skipped, unless ``GEOTREK_BENCHMARK``
+environment variable is set. For example::
+
+    GEOTREK_BENCHMARK=1 ./bin/django test geotrek.core.tests.test_graph
+
+Results are written on standard error.
+"""
+import os
+import resource
+import sys
+import time
+from multiprocessing import Process, Queue
+from unittest import skipUnless
+
+from django.db import connections
+
+
+benchmark = skipUnless(os.environ.get('GEOTREK_BENCHMARK'), "Set GEOTREK_BENCHMARK to run benchmarks")
+
+
+def duration(function, *args, **kwargs):
+    """Runs ``function``, returns its duration in seconds"""
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+
+def measure(function, *args, **kwargs):
+    """
+    Runs ``function`` in a child process, returns its duration in seconds
+    and the growth of resident memory it caused, in MB. The child process has
+    its own database connection: data has to be committed to be seen
+    (``TransactionTestCase``).
+    """
+    # The child process must not share the database connection
+    connections.close_all()
+    queue = Queue()
+
+    def run():
+        try:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            seconds = duration(function, *args, **kwargs)
+            queue.put((seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.0))
+        except Exception as e:
+            queue.put(e)
+        finally:
+            connections.close_all()
+
+    process = Process(target=run)
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def report(title, results):
+    """Writes ``(variant, duration[, memory])`` results of a benchmark"""
+    sys.stderr.write(u"\n{}\n".format(title))
+    for result in results:
+        line = u"  {:<40} {:>9.3f}s".format(result[0], result[1])
+        if len(result) > 2:
+            line += u" {:>9.1f}MB".format(result[2])
+        sys.stderr.write(line + u"\n")
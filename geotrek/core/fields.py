@@ -9,6 +9,7 @@ from django.conf import settings
 from django.contrib.gis.forms.fields import LineStringField
 from django.contrib.gis.geos import fromstr, Point, LineString
 
+from .helpers import PathHelper
 from .models import Topology, Path
 from .widgets import PointLineTopologyWidget, SnappedLineStringWidget
 
@@ -80,14 +81,13 @@ class SnappedLineStringField(LineStringField):
             snaplist = value.get('snap', [])
             if geom.num_coords != len(snaplist):
                 raise ValueError("Snap list length != %s (%s)" % (geom.num_coords, snaplist))
-            paths = [Path.objects.get(pk=pk) if pk is not None else None
-                     for pk in snaplist]
             coords = list(geom.coords)
-            for i, (vertex, path) in enumerate(zip(coords, paths)):
-                if path:
-                    # Snap vertex on path
-                    snap = path.snap(Point(*vertex, srid=geom.srid))
-                    coords[i] = snap.coords
+            snapped = [i for i, pk in enumerate(snaplist) if pk is not None]
+            # Snap vertices on paths
+            points = PathHelper.snap_many([int(snaplist[i]) for i in snapped],
+                                          [Point(*coords[i], srid=geom.srid) for i in snapped])
+            for i, point in zip(snapped, points):
+                coords[i] = point.coords
             return LineString(*coords, srid=settings.SRID)
         except (TypeError, Path.DoesNotExist, ValueError) as e:
             logger.warning("User input error: %s" % e)
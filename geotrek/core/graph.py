@@ -1,10 +1,48 @@
 import math
+import struct
+import sys
+import time
+from array import array
 from collections import defaultdict
 
+from django.db.models import Count, Max
 
-def path_modifier(path):
-    length = 0.0 if math.isnan(path.length) else path.length
-    return {"id": path.pk, "length": length}
+from geotrek.api.v2.functions import StartPoint, EndPoint, X, Y
+
+
+BINARY_GRAPH_MAGIC = b'GTG1'
+BINARY_GRAPH_CONTENT_TYPE = 'application/octet-stream'
+
+
+def path_modifier(pk, length):
+    length = 0.0 if length is None or math.isnan(length) else length
+    return {"id": pk, "length": length}
+
+
+def path_extremities(qs, *fields):
+    """
+    Stream ``(pk, start point, end point, *fields)`` tuples of paths from
+    ``qs``, where points are coordinates tuples.
+
+    Extremities are computed by the database and rows are fetched through a
+    server-side cursor, so that neither model instances nor whole geometries
+    are loaded in memory.
+    """
+    qs = qs.annotate(start_x=X(StartPoint('geom')), start_y=Y(StartPoint('geom')),
+                     end_x=X(EndPoint('geom')), end_y=Y(EndPoint('geom')))
+    rows = qs.values_list('pk', 'start_x', 'start_y', 'end_x', 'end_y', *fields)
+    for row in rows.iterator():
+        yield (row[0], (row[1], row[2]), (row[3], row[4])) + tuple(row[5:])
+
+
+def paths_state(qs):
+    """
+    ``(latest update, number of paths)`` of ``qs``. Deleting a path does not
+    change the latest update (unless it was the latest updated path), but
+    changes the number of paths.
+    """
+    state = qs.aggregate(latest=Max('date_update'), count=Count('pk'))
+    return state['latest'], state['count']
 
 
 def get_key_optimizer():
@@ -38,12 +76,10 @@ def graph_edges_nodes_of_qs(qs):
     edges = defaultdict(dict)
     nodes = defaultdict(dict)
 
-    for path in qs:
-        coords = path.geom.coords
-        start_point, end_point = coords[0], coords[-1]
+    for pk, start_point, end_point, length in path_extremities(qs, 'length'):
         k_start_point, k_end_point = key_modifier(start_point), key_modifier(end_point)
 
-        v_path = value_modifier(path)
+        v_path = value_modifier(pk, length)
         v_path['nodes_id'] = [k_start_point, k_end_point]
         edge_id = v_path['id']
 
@@ -55,3 +91,139 @@ def graph_edges_nodes_of_qs(qs):
         'edges': dict(edges),
         'nodes': dict(nodes),
     }
+
+
+def graph_binary(graph):
+    """
+    Compact encoding of a graph (as returned by ``graph_edges_nodes_of_qs``),
+    as an edge list. Everything is little-endian:
+
+    * header: magic ``GTG1``, number of edges (uint32)
+    * source node ids (int32 array)
+    * target node ids (int32 array)
+    * path ids (int32 array)
+    * lengths (float32 array)
+
+    Nodes adjacency is not included since it can be rebuilt from edges.
+    """
+    edges = sorted(graph['edges'].values(), key=lambda edge: edge['id'])
+    arrays = [
+        array('i', [edge['nodes_id'][0] for edge in edges]),
+        array('i', [edge['nodes_id'][1] for edge in edges]),
+        array('i', [edge['id'] for edge in edges]),
+        array('f', [edge['length'] for edge in edges]),
+    ]
+    if sys.byteorder == 'big':
+        for values in arrays:
+            values.byteswap()
+    header = struct.pack('<4sI', BINARY_GRAPH_MAGIC, len(edges))
+    return header + b''.join(values.tostring() for values in arrays)
+
+
+class GraphStore(object):
+    """
+    Path graph (in the same form as ``graph_edges_nodes_of_qs``) maintained
+    incrementally: only paths changed or deleted since the last refresh are
+    applied. Every refresh bringing changes increments the version, so that
+    clients can fetch the delta since the version they already have.
+    """
+    def __init__(self):
+        # Versions are based on creation time, so that they keep increasing
+        # even if the store is lost and rebuilt from scratch.
+        self.base = int(time.time() * 1000)
+        self.version = self.base
+        self.latest = None
+        self.count = None
+        self.node_keys = {}
+        self.edges = {}
+        self.nodes = defaultdict(dict)
+        self.incident = defaultdict(set)
+        self.edge_versions = {}
+        self.node_versions = {}
+        self.deleted = {}
+
+    def node_key(self, point):
+        if point not in self.node_keys:
+            self.node_keys[point] = len(self.node_keys) + 1
+        return self.node_keys[point]
+
+    def link(self, a, b):
+        """ (Re)compute adjacency between nodes ``a`` and ``b`` """
+        for node, other in ((a, b), (b, a)):
+            candidates = [pk for pk in self.incident[node] if other in self.edges[pk]['nodes_id']]
+            if candidates:
+                self.nodes[node][other] = max(candidates)
+            else:
+                self.nodes[node].pop(other, None)
+                if not self.nodes[node]:
+                    del self.nodes[node]
+            self.node_versions[node] = self.version
+
+    def remove_edge(self, pk):
+        edge = self.edges.pop(pk)
+        a, b = edge['nodes_id']
+        self.incident[a].discard(pk)
+        self.incident[b].discard(pk)
+        self.link(a, b)
+        self.edge_versions.pop(pk, None)
+
+    def add_edge(self, pk, start, end, length):
+        a, b = self.node_key(start), self.node_key(end)
+        edge = path_modifier(pk, length)
+        edge['nodes_id'] = [a, b]
+        if self.edges.get(edge['id']) == edge:
+            return
+        if edge['id'] in self.edges:
+            self.remove_edge(edge['id'])
+        self.edges[edge['id']] = edge
+        self.incident[a].add(edge['id'])
+        self.incident[b].add(edge['id'])
+        self.link(a, b)
+        self.edge_versions[edge['id']] = self.version
+        self.deleted.pop(edge['id'], None)
+
+    def refresh(self, qs):
+        """
+        Apply changes of paths from ``qs``.
+        Returns True if the graph has changed.
+        """
+        latest, count = paths_state(qs)
+        # Stores cached before the number of paths was tracked have no ``count``
+        if self.version > self.base and (latest, count) == (self.latest, getattr(self, 'count', None)):
+            return False
+        self.version += 1
+        existing = set(qs.values_list('pk', flat=True))
+        for pk in set(self.edges) - existing:
+            self.remove_edge(pk)
+            self.deleted[pk] = self.version
+        changed = qs
+        if self.latest:
+            # Paths updated at the same time as the previous refresh may not have been seen
+            changed = qs.filter(date_update__gte=self.latest)
+        for row in path_extremities(changed, 'length'):
+            self.add_edge(*row)
+        self.latest = latest
+        self.count = count
+        return True
+
+    def as_dict(self):
+        return {
+            'edges': dict(self.edges),
+            'nodes': dict((node, dict(adjacency)) for node, adjacency in self.nodes.items()),
+        }
+
+    def delta(self, since):
+        """
+        Changes since the specified version: added or modified edges, ids of
+        deleted edges and whole adjacency of nodes that changed (empty if the
+        node does not exist anymore).
+        Returns None if this version is unknown to the store.
+        """
+        if since < self.base or since > self.version:
+            return None
+        return {
+            'edges': dict((pk, self.edges[pk]) for pk, version in self.edge_versions.items() if version > since),
+            'deleted': [pk for pk, version in self.deleted.items() if version > since],
+            'nodes': dict((node, dict(self.nodes.get(node, {})))
+                          for node, version in self.node_versions.items() if version > since),
+        }
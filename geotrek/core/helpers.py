@@ -1,10 +1,12 @@
 import json
 import logging
+from contextlib import contextmanager
 
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.contrib.gis.geos import Point
 from django.db.models.query import QuerySet
+from django.db.models.sql.constants import INNER
 
 from geotrek.common.utils import sqlfunction, uniquify
 
@@ -12,6 +14,67 @@ from geotrek.common.utils import sqlfunction, uniquify
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def topology_geometry_mode(mode):
+    """
+    Change how topologies geometries are computed when their path
+    aggregations are modified, for the current transaction:
+
+    * ``immediate``: by triggers, for each modified aggregation or path (default)
+    * ``deferred``: modified topologies are queued, and their geometry is
+      computed only once, when leaving the block
+    * ``manual``: not at all, neither when aggregations nor when paths
+      geometries are modified (the latter used to be computed anyway),
+      ``update_geometry_of_evenement()`` has to be called explicitly afterwards
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT ft_topology_geometry_mode()")
+            previous = cursor.fetchone()[0]
+            cursor.execute("SELECT set_config('geotrek.topology_geometry', %s, true)", [mode])
+        yield
+        with connection.cursor() as cursor:
+            if mode == 'deferred':
+                # Process queue now rather than at commit
+                cursor.execute("SET CONSTRAINTS geotrek.e_t_evenement_geom_queue_tgr IMMEDIATE")
+                cursor.execute("SET CONSTRAINTS geotrek.e_t_evenement_geom_queue_tgr DEFERRED")
+            cursor.execute("SELECT set_config('geotrek.topology_geometry', %s, true)", [previous])
+
+
+class RankJoin(object):
+    """
+    Joins the rank of each primary key in a list to a query, as a
+    ``Query.alias_map`` entry (see ``django.db.models.sql.datastructures.Join``).
+    Ranks are joined once, rather than looked up in the list for each row.
+    """
+    alias = 'overlapping_rank'
+    table_name = alias
+    table_alias = alias
+    join_type = INNER
+    nullable = False
+
+    def __init__(self, pk_list, parent_alias, pk_column):
+        self.pk_list = pk_list
+        self.parent_alias = parent_alias
+        self.pk_column = pk_column
+
+    def as_sql(self, compiler, connection):
+        sql = """INNER JOIN (SELECT unnest(%%s::integer[]) AS id, generate_subscripts(%%s::integer[], 1) AS rank) %s
+                 ON (%s.%s = %s.id)""" % (self.alias, compiler.quote_name_unless_alias(self.parent_alias),
+                                          connection.ops.quote_name(self.pk_column), self.alias)
+        return sql, [self.pk_list, self.pk_list]
+
+    def relabeled_clone(self, change_map):
+        # Own alias is kept: it is referenced by the ordering of the query
+        return self.__class__(self.pk_list, change_map.get(self.parent_alias, self.parent_alias), self.pk_column)
+
+    def demote(self):
+        return self
+
+    def promote(self):
+        return self
+
+
 class TopologyHelper(object):
     @classmethod
     def deserialize(cls, serialized):
@@ -87,76 +150,111 @@ class TopologyHelper(object):
 
         kind = objdict[0].get('kind')
         offset = objdict[0].get('offset', 0.0)
-        topology = TopologyFactory.create(no_path=True, kind=kind, offset=offset)
-        # Remove all existing path aggregation (WTF: created from factory ?)
-        PathAggregation.objects.filter(topo_object=topology).delete()
 
+        # Validate the whole structure before writing anything
         try:
-            counter = 0
-            for j, subtopology in enumerate(objdict):
-                last_topo = j == len(objdict) - 1
-                positions = subtopology.get('positions', {})
-                paths = subtopology['paths']
-                # Create path aggregations
-                for i, path in enumerate(paths):
-                    last_path = i == len(paths) - 1
-                    # Javascript hash keys are parsed as a string
-                    idx = str(i)
-                    start_position, end_position = positions.get(idx, (0.0, 1.0))
-                    path = Path.objects.get(pk=path)
-                    topology.add_path(path, start=start_position, end=end_position, order=counter, reload=False)
-                    if not last_topo and last_path:
-                        counter += 1
-                        # Intermediary marker.
-                        # make sure pos will be [X, X]
-                        # [0, X] or [X, 1] or [X, 0] or [1, X] --> X
-                        # [0.0, 0.0] --> 0.0  : marker at beginning of path
-                        # [1.0, 1.0] --> 1.0  : marker at end of path
-                        pos = -1
-                        if start_position == end_position:
-                            pos = start_position
-                        if start_position == 0.0:
-                            pos = end_position
-                        elif start_position == 1.0:
-                            pos = end_position
-                        elif end_position == 0.0:
-                            pos = start_position
-                        elif end_position == 1.0:
-                            pos = start_position
-                        elif len(paths) == 1:
-                            pos = end_position
-                        assert pos >= 0, "Invalid position (%s, %s)." % (start_position, end_position)
-                        topology.add_path(path, start=pos, end=pos, order=counter, reload=False)
-                    counter += 1
-        except (AssertionError, ValueError, KeyError, Path.DoesNotExist) as e:
+            aggregations = cls._deserialize_aggregations(objdict)
+            paths = Path.objects.in_bulk(uniquify([path for path, start, end, order in aggregations]))
+            missing = [path for path, start, end, order in aggregations if path not in paths]
+            if missing:
+                raise Path.DoesNotExist("Unknown paths %s" % uniquify(missing))
+        except (AssertionError, ValueError, KeyError, TypeError, Path.DoesNotExist) as e:
             raise ValueError("Invalid serialized topology : %s" % e)
-        topology.save()
+
+        with transaction.atomic():
+            topology = TopologyFactory.create(no_path=True, kind=kind, offset=offset)
+            # Remove all existing path aggregation (WTF: created from factory ?)
+            PathAggregation.objects.filter(topo_object=topology).delete()
+
+            # Insert all aggregations at once, and compute geometry only once
+            with topology_geometry_mode('manual'):
+                PathAggregation.objects.bulk_create([
+                    PathAggregation(topo_object=topology, path=paths[path],
+                                    start_position=start, end_position=end, order=order)
+                    for path, start, end, order in aggregations
+                ])
+            sqlfunction('SELECT update_geometry_of_evenement', str(topology.pk))
+            topology.save()
         return topology
 
+    @classmethod
+    def _deserialize_aggregations(cls, objdict):
+        """
+        Returns the list of ``(path pk, start position, end position, order)``
+        described by sub-topologies of a serialized linear topology.
+        """
+        aggregations = []
+        counter = 0
+        for j, subtopology in enumerate(objdict):
+            last_topo = j == len(objdict) - 1
+            positions = subtopology.get('positions', {})
+            paths = subtopology['paths']
+            # Create path aggregations
+            for i, path in enumerate(paths):
+                last_path = i == len(paths) - 1
+                # Javascript hash keys are parsed as a string
+                idx = str(i)
+                start_position, end_position = positions.get(idx, (0.0, 1.0))
+                path = int(path)
+                aggregations.append((path, start_position, end_position, counter))
+                if not last_topo and last_path:
+                    counter += 1
+                    # Intermediary marker.
+                    # make sure pos will be [X, X]
+                    # [0, X] or [X, 1] or [X, 0] or [1, X] --> X
+                    # [0.0, 0.0] --> 0.0  : marker at beginning of path
+                    # [1.0, 1.0] --> 1.0  : marker at end of path
+                    pos = -1
+                    if start_position == end_position:
+                        pos = start_position
+                    if start_position == 0.0:
+                        pos = end_position
+                    elif start_position == 1.0:
+                        pos = end_position
+                    elif end_position == 0.0:
+                        pos = start_position
+                    elif end_position == 1.0:
+                        pos = start_position
+                    elif len(paths) == 1:
+                        pos = end_position
+                    assert pos >= 0, "Invalid position (%s, %s)." % (start_position, end_position)
+                    aggregations.append((path, pos, pos, counter))
+                counter += 1
+        return aggregations
+
     @classmethod
     def _topologypoint(cls, lng, lat, kind=None, snap=None):
         """
         Receives a point (lng, lat) with API_SRID, and returns
         a topology objects with a computed path aggregation.
         """
-        from .models import Path, PathAggregation
-        from .factories import TopologyFactory
+        from .models import Path
         # Find closest path
         point = Point(lng, lat, srid=settings.API_SRID)
         point.transform(settings.SRID)
         if snap is None:
-            closest = Path.closest(point)
-            position, offset = closest.interpolate(point)
+            location = PathHelper.locate([point])[0]
         else:
             closest = Path.objects.get(pk=snap)
             position, offset = closest.interpolate(point)
-            offset = 0
+            location = (closest.pk, position, 0)
+        return cls.topologypoint(point, location, kind)
+
+    @classmethod
+    def topologypoint(cls, point, location, kind=None):
+        """
+        Returns a point topology at ``location``, as returned by
+        ``PathHelper.locate()``.
+        """
+        from .models import PathAggregation
+        from .factories import TopologyFactory
+        path, position, offset = location
         # We can now instantiante a Topology object
         topology = TopologyFactory.create(no_path=True, kind=kind, offset=offset)
         aggrobj = PathAggregation(topo_object=topology,
                                   start_position=position,
                                   end_position=position,
-                                  path=closest)
+                                  path_id=path)
         aggrobj.save()
         point = Point(point.x, point.y, srid=settings.SRID)
         topology.geom = point
@@ -201,59 +299,80 @@ class TopologyHelper(object):
         return json.dumps(objdict)
 
     @classmethod
-    def overlapping(cls, klass, queryset):
-        from .models import Path, Topology, PathAggregation
+    def _overlapping_ranks(cls, klass, topology_pks):
+        """
+        Returns ``(topology pk, overlapping pk, rank)`` rows, where rank is the
+        position of the first overlap along the topology, ordered by topology
+        and rank.
+        """
+        from .models import Topology
 
+        sql = """
+        WITH topologies AS (SELECT unnest(%(topologies)s::integer[]) AS id),
+        -- Concerned paths along with (start, end)
+             paths_aggr AS (SELECT t.id AS topology, a.troncon, a.pk_debut AS start, a.pk_fin AS end,
+                                   a.ordre AS order
+                            FROM e_r_evenement_troncon a
+                            JOIN topologies t ON a.evenement = t.id)
+        -- Retrieve primary keys, with position of first overlap
+        SELECT pa.topology, e.id,
+               min(pa.order + CASE WHEN pa.start > pa.end THEN (1 - a.pk_debut) ELSE a.pk_debut END) AS rank
+        FROM e_t_evenement e
+        JOIN e_r_evenement_troncon a ON a.evenement = e.id
+        JOIN paths_aggr pa ON a.troncon = pa.troncon
+        WHERE least(a.pk_debut, a.pk_fin) <= greatest(pa.start, pa.end)
+          AND greatest(a.pk_debut, a.pk_fin) >= least(pa.start, pa.end)
+          AND NOT e.supprime
+          AND (%(kind)s::varchar IS NULL OR e.kind = %(kind)s)
+        GROUP BY pa.topology, e.id
+        ORDER BY pa.topology, rank, e.id
+        """
+        kind = None if klass.KIND == Topology.KIND else klass.KIND
+        cursor = connection.cursor()
+        cursor.execute(sql, {'topologies': list(topology_pks), 'kind': kind})
+        return cursor.fetchall()
+
+    @classmethod
+    def overlapping(cls, klass, queryset):
         all_objects = klass.objects.existing()
-        is_generic = klass.KIND == Topology.KIND
-        single_input = isinstance(queryset, QuerySet)
 
-        if single_input:
-            topology_pks = [str(pk) for pk in queryset.values_list('pk', flat=True)]
+        if isinstance(queryset, QuerySet):
+            topology_pks = list(queryset.values_list('pk', flat=True))
         else:
-            topology_pks = [str(queryset.pk)]
+            topology_pks = [queryset.pk]
 
         if len(topology_pks) == 0:
             return all_objects.filter(pk__in=[])
 
-        sql = """
-        WITH topologies AS (SELECT id FROM %(topology_table)s WHERE id IN (%(topology_list)s)),
-        -- Concerned aggregations
-             aggregations AS (SELECT * FROM %(aggregations_table)s a, topologies t
-                              WHERE a.evenement = t.id),
-        -- Concerned paths along with (start, end)
-             paths_aggr AS (SELECT a.pk_debut AS start, a.pk_fin AS end, p.id, a.ordre AS order
-                            FROM %(paths_table)s p, aggregations a
-                            WHERE a.troncon = p.id
-                            ORDER BY a.ordre)
-        -- Retrieve primary keys
-        SELECT t.id
-        FROM %(topology_table)s t, %(aggregations_table)s a, paths_aggr pa
-        WHERE a.troncon = pa.id AND a.evenement = t.id
-          AND least(a.pk_debut, a.pk_fin) <= greatest(pa.start, pa.end)
-          AND greatest(a.pk_debut, a.pk_fin) >= least(pa.start, pa.end)
-          AND %(extra_condition)s
-        ORDER BY (pa.order + CASE WHEN pa.start > pa.end THEN (1 - a.pk_debut) ELSE a.pk_debut END);
-        """ % {
-            'topology_table': Topology._meta.db_table,
-            'aggregations_table': PathAggregation._meta.db_table,
-            'paths_table': Path._meta.db_table,
-            'topology_list': ','.join(topology_pks),
-            'extra_condition': 'true' if is_generic else "kind = '%s'" % klass.KIND
-        }
-
-        cursor = connection.cursor()
-        cursor.execute(sql)
-        result = cursor.fetchall()
-        pk_list = uniquify([row[0] for row in result])
+        # Keep first overlap of each object, along any of the topologies
+        ranks = {}
+        for topology, pk, rank in cls._overlapping_ranks(klass, topology_pks):
+            ranks[pk] = min(rank, ranks.get(pk, rank))
+        pk_list = sorted(ranks, key=lambda pk: (ranks[pk], pk))
 
         # Return a QuerySet and preserve pk list order
-        # http://stackoverflow.com/a/1310188/141895
-        ordering = 'CASE %s END' % ' '.join(['WHEN %s.id=%s THEN %s' % (Topology._meta.db_table, id_, i)
-                                             for i, id_ in enumerate(pk_list)])
-        queryset = all_objects.filter(pk__in=pk_list).extra(
-            select={'ordering': ordering}, order_by=('ordering',))
-        return queryset
+        queryset = all_objects.all()
+        query = queryset.query
+        query.alias_map[RankJoin.alias] = RankJoin(pk_list, query.get_initial_alias(), klass._meta.pk.column)
+        query.alias_refcount[RankJoin.alias] = 1
+        query.table_map[RankJoin.alias] = [RankJoin.alias]
+        return queryset.extra(select={'ordering': '%s.rank' % RankJoin.alias}, order_by=('ordering',))
+
+    @classmethod
+    def overlapping_bulk(cls, klass, topologies):
+        """
+        Returns objects of ``klass`` overlapping each of the specified
+        topologies, as a dict of lists (by topology pk) ordered like
+        ``overlapping()``. Overlaps of all topologies are computed at once.
+        """
+        result = dict((topology.pk, []) for topology in topologies)
+        if not result:
+            return result
+        ranks = cls._overlapping_ranks(klass, result.keys())
+        objects = klass.objects.existing().in_bulk(uniquify([pk for topology, pk, rank in ranks]))
+        for topology, pk, rank in ranks:
+            result[topology].append(objects[pk])
+        return result
 
 
 class PathHelper(object):
@@ -293,6 +412,80 @@ class PathHelper(object):
         result = cursor.fetchall()
         return result[0]
 
+    @classmethod
+    def locate(cls, points, exclude=None):
+        """
+        Returns the closest path of each point, with position ([0.0-1.0]) and
+        offset (distance) of the point along it, as a list of
+        ``(path pk, position, offset)``.
+
+        All points are located with a single query, using the spatial index
+        (KNN) to find closest paths candidates.
+        Will fail if no path in database.
+        """
+        if not points:
+            return []
+        points = [point if point.srid == settings.SRID else point.transform(settings.SRID, clone=True)
+                  for point in points]
+        cursor = connection.cursor()
+        sql = """
+        WITH points AS (SELECT i, (%(points)s::geometry[])[i] AS geom
+                        FROM generate_subscripts(%(points)s::geometry[], 1) AS i)
+        SELECT closest.id, interpolated.position, interpolated.distance
+        FROM points
+        JOIN LATERAL (SELECT candidates.id, candidates.geom
+                      FROM (SELECT t.id, t.geom
+                            FROM l_t_troncon t
+                            WHERE t.brouillon = FALSE AND t.visible = TRUE
+                              AND NOT (t.id = ANY(%(exclude)s))
+                            ORDER BY t.geom <-> points.geom
+                            LIMIT 10) AS candidates
+                      ORDER BY ST_Distance(candidates.geom, points.geom), candidates.id
+                      LIMIT 1) AS closest ON TRUE
+        CROSS JOIN LATERAL ST_InterpolateAlong(closest.geom, points.geom)
+                           AS interpolated(position FLOAT, distance FLOAT)
+        ORDER BY points.i
+        """
+        cursor.execute(sql, {'points': [point.ewkt for point in points],
+                             'exclude': [path.pk for path in exclude or []]})
+        result = cursor.fetchall()
+        if len(result) != len(points):
+            raise IndexError("No path to locate points on")
+        return result
+
+    @classmethod
+    def snap_many(cls, paths, points):
+        """
+        Returns the points snapped on the specified paths (as pks), computed
+        with a single query.
+        """
+        if not points:
+            return []
+        points = [point if point.srid == settings.SRID else point.transform(settings.SRID, clone=True)
+                  for point in points]
+        cursor = connection.cursor()
+        sql = """
+        SELECT ST_X(p.geom), ST_Y(p.geom)
+        FROM (SELECT i, ST_ClosestPoint(t.geom, (%(points)s::geometry[])[i]) AS geom
+              FROM generate_subscripts(%(points)s::geometry[], 1) AS i
+              JOIN l_t_troncon t ON t.id = (%(paths)s::integer[])[i]) AS p
+        ORDER BY p.i
+        """
+        cursor.execute(sql, {'points': [point.ewkt for point in points], 'paths': list(paths)})
+        result = cursor.fetchall()
+        if len(result) != len(points):
+            raise ValueError("Unknown path in %s" % list(paths))
+        return [Point(x, y, srid=settings.SRID) for x, y in result]
+
+    @classmethod
+    def reattach_points(cls, path):
+        """
+        Moves all point topologies of ``path`` to the closest other path,
+        keeping their geometry, with a single query.
+        Returns the number of moved topologies.
+        """
+        return sqlfunction('SELECT reattach_point_evenements', str(path.pk))[0]
+
     @classmethod
     def disjoint(cls, geom, pk):
         """
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import os.path
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.gdal.error import GDALException
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from geotrek.authent.models import default_structure
+from geotrek.authent.models import Structure
+from geotrek.core.helpers import topology_geometry_mode
+
+
+# Set-wise snapping of extremities of staged paths, with the same rules as
+# ``troncons_snap_extremities()`` trigger: on the closest vertex if any within
+# snapping distance, otherwise on the closest point of the closest path.
+# Staged paths are snapped on existing paths and on previous staged paths,
+# as if they had been inserted one by one.
+SNAP_SQL = """
+    WITH extremities AS (
+        SELECT id, {index} AS idx, {point}(geom) AS point
+        FROM loadpaths_staging
+    ), snapped AS (
+        SELECT e.id, e.idx, COALESCE(vertex.geom, closest.point) AS point
+        FROM extremities e
+        JOIN LATERAL (
+            SELECT ST_ClosestPoint(other.geom, e.point) AS point, other.geom
+            FROM (SELECT t.geom FROM l_t_troncon t
+                  WHERE ST_DWithin(t.geom, e.point, %(distance)s)
+                  UNION ALL
+                  SELECT s.geom FROM loadpaths_staging s
+                  WHERE s.id < e.id AND ST_DWithin(s.geom, e.point, %(distance)s)) AS other
+            ORDER BY ST_Distance(other.geom, e.point)
+            LIMIT 1
+        ) AS closest ON true
+        LEFT JOIN LATERAL (
+            SELECT dp.geom
+            FROM ST_DumpPoints(closest.geom) AS dp
+            WHERE ST_DWithin(dp.geom, closest.point, %(distance)s)
+            ORDER BY ST_Distance(dp.geom, closest.point)
+            LIMIT 1
+        ) AS vertex ON true
+    )
+    UPDATE loadpaths_staging s
+    SET geom = ST_SetPoint(s.geom, snapped.idx, snapped.point)
+    FROM snapped
+    WHERE s.id = snapped.id AND NOT ST_Equals({point}(s.geom), snapped.point)
+"""
+
+# Set-wise noding of staged paths: each staged path is cut where it crosses
+# or touches other staged paths. Crossings are computed once per pair of
+# paths, so that both get the very same vertex.
+NODE_SQL = """
+    WITH crossings AS (
+        SELECT s.id, ST_LineLocatePoint(s.geom, p.geom) AS fraction, p.geom AS point
+        FROM loadpaths_staging s
+        JOIN loadpaths_staging o ON o.id != s.id AND ST_Intersects(s.geom, o.geom)
+        CROSS JOIN LATERAL ST_Dump(ST_Intersection(CASE WHEN s.id < o.id THEN s.geom ELSE o.geom END,
+                                                   CASE WHEN s.id < o.id THEN o.geom ELSE s.geom END)) AS p
+        WHERE GeometryType(p.geom) = 'POINT'
+    ), cuts AS (
+        SELECT id, 0.0::float AS fraction, ST_StartPoint(geom) AS point FROM loadpaths_staging
+        UNION ALL
+        SELECT id, 1.0::float, ST_EndPoint(geom) FROM loadpaths_staging
+        UNION ALL
+        SELECT id, fraction, point FROM crossings WHERE fraction > 0.0 AND fraction < 1.0
+    ), segments AS (
+        SELECT id, fraction, point,
+               lead(fraction) OVER w AS next_fraction,
+               lead(point) OVER w AS next_point
+        FROM (SELECT DISTINCT ON (id, fraction) * FROM cuts ORDER BY id, fraction) AS c
+        WINDOW w AS (PARTITION BY id ORDER BY fraction)
+    )
+    INSERT INTO loadpaths_noded (staged, geom)
+    SELECT s.id, ST_SetPoint(ST_SetPoint(segment, 0, g.point), ST_NPoints(segment) - 1, g.next_point)
+    FROM segments g
+    JOIN loadpaths_staging s ON s.id = g.id
+    CROSS JOIN LATERAL ST_LineSubstring(s.geom, g.fraction, g.next_fraction) AS segment
+    WHERE g.next_fraction IS NOT NULL
+    ORDER BY s.id, g.fraction
+"""
+
+# Noded paths touching or crossing existing paths. They are left to snapping
+# and splitting triggers, which also split the existing paths.
+TOUCH_SQL = """
+    UPDATE loadpaths_noded n
+    SET existing = true
+    WHERE EXISTS (SELECT 1 FROM l_t_troncon t WHERE ST_DWithin(t.geom, n.geom, 0))
+"""
+
+INSERT_SQL = """
+    INSERT INTO l_t_troncon (structure, valide, visible, nom, remarques, id_externe, depart, arrivee, brouillon, geom)
+    SELECT %(structure)s, true, true, s.name, s.comments, s.eid, '', '', false, n.geom
+    FROM loadpaths_noded n
+    JOIN loadpaths_staging s ON s.id = n.staged
+    WHERE n.id > %(start)s AND n.id <= %(end)s AND n.existing = %(existing)s
+    ORDER BY n.id
+"""
+
+
+def copy_value(value):
+    """ Escape value for PostgreSQL COPY text format """
+    if value is None:
+        return u'\\N'
+    value = unicode(value)
+    for char, escaped in ((u'\\', u'\\\\'), (u'\t', u'\\t'), (u'\n', u'\\n'), (u'\r', u'\\r')):
+        value = value.replace(char, escaped)
+    return value
+
+
+class Command(BaseCommand):
+    help = ('Bulk load a layer with line geometries as paths, snapping and splitting them all at once. '
+            'Paths touching or crossing existing paths are still snapped and split one by one by triggers, '
+            'each one querying the paths around it, so their loading is as slow as a single path creation.\n')
+    can_import_settings = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('path_layer')
+        parser.add_argument('--encoding', '-e', action='store', dest='encoding', default='utf-8',
+                            help='File encoding, default utf-8')
+        parser.add_argument('--name-field', '-n', action='store', dest='name_field', help='Name field')
+        parser.add_argument('--comments-field', '-c', action='store', dest='comments_field', help='Comments field')
+        parser.add_argument('--eid-field', action='store', dest='eid_field', help='External ID field')
+        parser.add_argument('--structure-default', action='store', dest='structure_default',
+                            help='Structure of created paths, default structure if not set')
+        parser.add_argument('--batch-size', action='store', dest='batch_size', type=int, default=1000,
+                            help='Number of paths per batch, default 1000')
+
+    def progress(self, message, *args):
+        if self.verbosity > 0:
+            self.stdout.write(message.format(*args))
+
+    def phase(self, name, start):
+        self.progress(u"{} done in {:.1f}s", name, time.time() - start)
+        return time.time()
+
+    def handle(self, *args, **options):
+        self.verbosity = options.get('verbosity')
+        filename = options['path_layer']
+        batch_size = options['batch_size']
+
+        if not os.path.exists(filename):
+            raise CommandError('File does not exists at: %s' % filename)
+        if batch_size < 1:
+            raise CommandError('Batch size must be positive')
+
+        data_source = DataSource(filename, encoding=options.get('encoding'))
+
+        structure_default = options.get('structure_default')
+        if structure_default:
+            try:
+                structure = Structure.objects.get(name=structure_default)
+            except Structure.DoesNotExist:
+                raise CommandError(u"Structure {} set in options doesn't exist".format(structure_default))
+        else:
+            structure = default_structure()
+
+        fields = [options.get('name_field'), options.get('comments_field'), options.get('eid_field')]
+        for layer in data_source:
+            for field in fields:
+                if field and field not in layer.fields:
+                    raise CommandError(u"Field '{}' not found in layer '{}'.".format(field, layer.name))
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            start = time.time()
+            cursor.execute("""
+                CREATE TEMPORARY TABLE loadpaths_staging (
+                    id serial PRIMARY KEY,
+                    name varchar(20),
+                    comments text,
+                    eid varchar(1024),
+                    geom geometry(LineString, %s)
+                ) ON COMMIT DROP""", [settings.SRID])
+            cursor.execute("""
+                CREATE TEMPORARY TABLE loadpaths_noded (
+                    id serial PRIMARY KEY,
+                    staged integer,
+                    existing boolean NOT NULL DEFAULT false,
+                    geom geometry(LineString, %s)
+                ) ON COMMIT DROP""", [settings.SRID])
+
+            staged = self.stage(cursor, data_source, fields, batch_size)
+            if not staged:
+                cursor.execute("DROP TABLE loadpaths_staging, loadpaths_noded")
+                self.progress(u"No path to load.")
+                return
+            cursor.execute("CREATE INDEX ON loadpaths_staging USING gist(geom)")
+            cursor.execute("ANALYZE loadpaths_staging")
+            start = self.phase(u"Staging of {} paths".format(staged), start)
+
+            distance = settings.PATH_SNAPPING_DISTANCE
+            for index, point in (('0', 'ST_StartPoint'), ('ST_NPoints(geom) - 1', 'ST_EndPoint')):
+                cursor.execute(SNAP_SQL.format(index=index, point=point), {'distance': distance})
+            start = self.phase(u"Snapping", start)
+
+            cursor.execute(NODE_SQL)
+            cursor.execute("SELECT count(*) FROM loadpaths_noded")
+            total = cursor.fetchone()[0]
+            start = self.phase(u"Splitting into {} paths".format(total), start)
+
+            cursor.execute(TOUCH_SQL)
+            touching = cursor.rowcount
+            start = self.phase(u"Search of {} paths touching existing ones".format(touching), start)
+
+            # Paths apart from existing ones are already snapped and split: snapping
+            # and splitting triggers are skipped for them. Paths touching existing
+            # ones are still snapped and split by triggers, one by one. Topologies
+            # on split paths are then updated once for all.
+            created = 0
+            with topology_geometry_mode('deferred'):
+                for existing in (False, True):
+                    cursor.execute("SELECT set_config('geotrek.path_snap_split', %s, true)",
+                                   ['on' if existing else 'off'])
+                    for offset in range(0, total, batch_size):
+                        cursor.execute(INSERT_SQL, {'structure': structure.pk, 'start': offset,
+                                                    'end': offset + batch_size, 'existing': existing})
+                        if cursor.rowcount:
+                            created += cursor.rowcount
+                            self.progress(u"{}/{} paths created", created, total)
+            self.phase(u"Creation", start)
+            cursor.execute("DROP TABLE loadpaths_staging, loadpaths_noded")
+
+        self.progress(u"{} paths loaded.", total)
+
+    def stage(self, cursor, data_source, fields, batch_size):
+        """
+        Copy line geometries of all layers into staging table, by batches.
+        Returns the number of staged lines.
+        """
+        total = sum(layer.num_feat for layer in data_source)
+        buffer = StringIO()
+        staged = 0
+        pending = 0
+        done = 0
+        for layer in data_source:
+            self.progress(u"- Layer '{}' with {} objects found", layer.name, layer.num_feat)
+            for feature in layer:
+                done += 1
+                try:
+                    geom = feature.geom.transform(settings.SRID, clone=True)
+                except GDALException as e:
+                    self.stdout.write(self.style.ERROR(u"Feature {} ignored: {}".format(feature.fid, e)))
+                    continue
+                geom.coord_dim = 2
+                if geom.geom_type == 'LineString':
+                    lines = [geom]
+                elif geom.geom_type == 'MultiLineString':
+                    lines = list(geom)
+                else:
+                    self.stdout.write(self.style.ERROR(
+                        u"Feature {} ignored: {} geometry".format(feature.fid, geom.geom_type)))
+                    continue
+                name, comments, eid = [feature.get(field) if field else None for field in fields]
+                if name is not None:
+                    name = unicode(name)[:20]
+                for line in lines:
+                    line = line.geos
+                    if line.num_points < 2 or line.length == 0:
+                        continue
+                    line.srid = settings.SRID
+                    values = [name, comments, eid, line.hexewkb]
+                    buffer.write(u'\t'.join(copy_value(value) for value in values).encode('utf-8') + '\n')
+                    pending += 1
+                if pending >= batch_size:
+                    self.copy(cursor, buffer)
+                    staged += pending
+                    buffer, pending = StringIO(), 0
+                    self.progress(u"{}/{} features staged", done, total)
+        self.copy(cursor, buffer)
+        return staged + pending
+
+    def copy(self, cursor, buffer):
+        buffer.seek(0)
+        cursor.copy_expert("COPY loadpaths_staging (name, comments, eid, geom) FROM STDIN", buffer)
@@ -21,8 +21,6 @@ from geotrek.altimetry.models import AltimetryMixin
 from .helpers import PathHelper, TopologyHelper
 from django.db import connections, DEFAULT_DB_ALIAS
 
-from django.contrib.gis.geos import Point
-
 logger = logging.getLogger(__name__)
 
 
@@ -137,10 +135,8 @@ class Path(AddPropertyMixin, MapEntityMixin, AltimetryMixin,
         # TODO: move to custom manager
         if point.srid != settings.SRID:
             point = point.transform(settings.SRID, clone=True)
-        qs = cls.objects.exclude(draft=True)
-        if exclude:
-            qs = qs.exclude(pk=exclude.pk)
-        return qs.exclude(visible=False).distance(point).order_by('distance')[0]
+        pk, position, offset = PathHelper.locate([point], exclude=[exclude] if exclude else [])[0]
+        return cls.objects.get(pk=pk)
 
     def is_overlap(self):
         return not PathHelper.disjoint(self.geom, self.pk)
@@ -190,27 +186,9 @@ class Path(AddPropertyMixin, MapEntityMixin, AltimetryMixin,
         self.reload()
 
     def delete(self, *args, **kwargs):
-        topologies = list(self.topology_set.filter())
-        r = super(Path, self).delete(*args, **kwargs)
-        if not Path.objects.exists():
-            return r
-        for topology in topologies:
-            if isinstance(topology.geom, Point):
-                closest = self.closest(topology.geom, self)
-                position, offset = closest.interpolate(topology.geom)
-                new_topology = Topology.objects.create()
-                aggrobj = PathAggregation(topo_object=new_topology,
-                                          start_position=position,
-                                          end_position=position,
-                                          path=closest)
-                aggrobj.save()
-                point = Point(topology.geom.x, topology.geom.y, srid=settings.SRID)
-                new_topology.geom = point
-                new_topology.offset = offset
-                new_topology.position = position
-                new_topology.save()
-                topology.mutate(new_topology)
-        return r
+        # Point topologies are moved to the closest remaining path, all at once
+        PathHelper.reattach_points(self)
+        return super(Path, self).delete(*args, **kwargs)
 
     @property
     def name_display(self):
@@ -394,6 +372,12 @@ class Topology(AddPropertyMixin, AltimetryMixin, TimeStampedModelMixin, NoDelete
         """
         return TopologyHelper.overlapping(cls, topologies)
 
+    @classmethod
+    def overlapping_bulk(cls, topologies):
+        """ Return the list of objects overlapping each topology, as a dict by topology pk.
+        """
+        return TopologyHelper.overlapping_bulk(cls, topologies)
+
     def mutate(self, other, delete=True):
         """
         Take alls attributes of the other topology specified and
@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import math
+from collections import defaultdict
+
+from django.conf import settings
+
+from .graph import path_extremities
+
+
+ORIGIN = 'origin'
+GOAL = 'goal'
+
+
+class PathRouter(object):
+    """
+    In-memory adjacency structure of the path network, used to compute
+    routes server-side instead of shipping the whole graph to the browser.
+
+    Nodes are path extremities (coordinates tuples), edges are paths.
+    Points along the network are given as anchors ``(path pk, position)``,
+    where position is a fraction of the path length (see ``Path.interpolate``).
+    """
+    COSTS = ('length', 'ascent')
+
+    def __init__(self, edges):
+        """
+        :edges: iterable of ``(pk, start point, end point, length, ascent, descent)``
+        """
+        self.edges = {}
+        self.nodes = defaultdict(list)
+        for pk, start, end, length, ascent, descent in edges:
+            length = 0.0 if length is None or math.isnan(length) else length
+            self.edges[pk] = (start, end, length, ascent or 0, abs(descent or 0))
+            self.nodes[start].append((end, pk, True))
+            self.nodes[end].append((start, pk, False))
+
+    @classmethod
+    def from_queryset(cls, qs):
+        return cls(path_extremities(qs, 'length', 'ascent', 'descent'))
+
+    def cost(self, pk, start=0.0, end=1.0, cost='length'):
+        """
+        Cost of walking along path ``pk`` from ``start`` to ``end`` positions.
+        With ``ascent`` cost, climbing is penalized by ``ROUTING_ASCENT_FACTOR``.
+        """
+        length, ascent, descent = self.edges[pk][2:]
+        fraction = abs(end - start)
+        weight = length * fraction
+        if cost == 'ascent':
+            climb = ascent if end >= start else descent
+            weight += settings.ROUTING_ASCENT_FACTOR * climb * fraction
+        return weight
+
+    def shortest(self, origin, destination, cost='length'):
+        """
+        Shortest way between two anchors, using A* with straight line
+        distance to the destination path extremities as heuristic.
+
+        Returns a list of ``(path pk, start position, end position)`` steps.
+        """
+        opk, opos = origin
+        dpk, dpos = destination
+        if opk not in self.edges or dpk not in self.edges:
+            raise ValueError("Unknown path %s" % (opk if opk not in self.edges else dpk))
+        ostart, oend = self.edges[opk][:2]
+        dstart, dend = self.edges[dpk][:2]
+
+        # Steps that finish the route from destination path extremities
+        exits = defaultdict(list)
+        exits[dstart].append((dpk, 0.0, dpos))
+        exits[dend].append((dpk, 1.0, dpos))
+
+        def heuristic(node):
+            return min(math.hypot(node[0] - x, node[1] - y) for x, y in (dstart, dend))
+
+        tiebreak = itertools.count()
+        heap = []
+
+        def push(g, node, parent, step):
+            h = 0.0 if node == GOAL else heuristic(node)
+            heapq.heappush(heap, (g + h, g, next(tiebreak), node, parent, step))
+
+        if opk == dpk:
+            push(self.cost(opk, opos, dpos, cost), GOAL, ORIGIN, (opk, opos, dpos))
+        push(self.cost(opk, opos, 0.0, cost), ostart, ORIGIN, (opk, opos, 0.0))
+        push(self.cost(opk, opos, 1.0, cost), oend, ORIGIN, (opk, opos, 1.0))
+
+        parents = {}
+        while heap:
+            f, g, _, node, parent, step = heapq.heappop(heap)
+            if node in parents:
+                continue
+            parents[node] = (parent, step)
+            if node == GOAL:
+                break
+            for step in exits.get(node, []):
+                push(g + self.cost(*step, cost=cost), GOAL, node, step)
+            for neighbour, pk, forward in self.nodes[node]:
+                if neighbour in parents:
+                    continue
+                step = (pk, 0.0, 1.0) if forward else (pk, 1.0, 0.0)
+                push(g + self.cost(*step, cost=cost), neighbour, node, step)
+
+        if GOAL not in parents:
+            raise ValueError("No route found between paths %s and %s" % (opk, dpk))
+
+        steps = []
+        node = GOAL
+        while node != ORIGIN:
+            node, step = parents[node]
+            steps.insert(0, step)
+        # Walking zero distance on origin or destination paths is not a step
+        return [(pk, start, end) for pk, start, end in steps if start != end] or steps[:1]
+
+    def route(self, anchors, cost='length'):
+        """
+        Shortest route passing through all anchors, serialized as expected by
+        ``TopologyHelper.deserialize``: one sub-topology per pair of markers.
+        """
+        if cost not in self.COSTS:
+            raise ValueError("Unknown cost %s" % cost)
+        if len(anchors) < 2:
+            raise ValueError("At least two points are required")
+        subtopologies = []
+        for origin, destination in zip(anchors[:-1], anchors[1:]):
+            steps = self.shortest(origin, destination, cost)
+            subtopologies.append({
+                'offset': 0,
+                'paths': [pk for pk, start, end in steps],
+                'positions': dict((str(i), (start, end)) for i, (pk, start, end) in enumerate(steps)),
+            })
+        return subtopologies
+
+
+_router_cache = {}
+
+
+def get_router():
+    """
+    Router over the whole non-draft network, kept in process memory and
+    rebuilt only when paths have changed (see ``paths_state``).
+    """
+    from .graph import paths_state
+    from .models import Path
+
+    paths = Path.objects.exclude(draft=True)
+    state = paths_state(paths)
+    if _router_cache.get('state') != state or 'router' not in _router_cache:
+        _router_cache['router'] = PathRouter.from_queryset(paths)
+        _router_cache['state'] = state
+    return _router_cache['router']
@@ -131,3 +131,31 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+
+-------------------------------------------------------------------------------
+-- How topologies geometries are computed (see core.helpers.topology_geometry_mode)
+-------------------------------------------------------------------------------
+
+CREATE OR REPLACE FUNCTION geotrek.ft_topology_geometry_mode() RETURNS text AS $$
+BEGIN
+    -- Custom setting, only defined if changed during session
+    RETURN COALESCE(NULLIF(current_setting('geotrek.topology_geometry'), ''), 'immediate');
+EXCEPTION WHEN undefined_object THEN
+    RETURN 'immediate';
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+-------------------------------------------------------------------------------
+-- Whether paths are snapped and split by triggers (turned off by loadpaths
+-- command for paths already snapped and split in bulk)
+-------------------------------------------------------------------------------
+
+CREATE OR REPLACE FUNCTION geotrek.ft_path_snap_split() RETURNS boolean AS $$
+BEGIN
+    -- Custom setting, only defined if changed during session
+    RETURN COALESCE(NULLIF(current_setting('geotrek.path_snap_split'), ''), 'on') = 'on';
+EXCEPTION WHEN undefined_object THEN
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql STABLE;
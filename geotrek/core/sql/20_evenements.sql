@@ -152,6 +152,46 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-------------------------------------------------------------------------------
+-- Deferred update of geometry of "evenements" (see ft_topology_geometry_mode)
+-------------------------------------------------------------------------------
+
+-- Topologies whose geometry has to be computed at the end of transaction
+CREATE UNLOGGED TABLE IF NOT EXISTS geotrek.e_t_evenement_geom_queue (
+    txid bigint NOT NULL,
+    evenement integer NOT NULL,
+    PRIMARY KEY (txid, evenement)
+);
+
+CREATE OR REPLACE FUNCTION geotrek.defer_geometry_of_evenement(eid integer) RETURNS void AS $$
+BEGIN
+    -- Queue each topology only once per transaction
+    INSERT INTO e_t_evenement_geom_queue (txid, evenement)
+    SELECT txid_current(), eid
+    WHERE NOT EXISTS (
+        SELECT 1 FROM e_t_evenement_geom_queue WHERE txid = txid_current() AND evenement = eid
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS e_t_evenement_geom_queue_tgr ON e_t_evenement_geom_queue;
+
+CREATE OR REPLACE FUNCTION geotrek.flush_geometry_of_evenement() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM e_t_evenement_geom_queue WHERE txid = NEW.txid AND evenement = NEW.evenement;
+    IF FOUND THEN
+        PERFORM update_geometry_of_evenement(NEW.evenement);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Fired at commit, or when constraints are set IMMEDIATE (see core.helpers.topology_geometry_mode)
+CREATE CONSTRAINT TRIGGER e_t_evenement_geom_queue_tgr
+AFTER INSERT ON e_t_evenement_geom_queue
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW EXECUTE PROCEDURE flush_geometry_of_evenement();
+
 
 -------------------------------------------------------------------------------
 -- Update geometry when offset change
@@ -206,3 +246,33 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER e_t_evenement_geom_iu_tgr
 BEFORE INSERT OR UPDATE OF geom ON e_t_evenement
 FOR EACH ROW EXECUTE PROCEDURE evenement_elevation_iu();
+
+-- Recompute elevation of given topologies at once (e.g. after DEM change),
+-- from their paths (whose elevation should be up-to-date) or from their own geometry.
+CREATE OR REPLACE FUNCTION geotrek.redrape_evenements(ids integer[]) RETURNS integer AS $$
+DECLARE
+    updated integer;
+BEGIN
+    IF {{TREKKING_TOPOLOGY_ENABLED}} THEN
+        PERFORM update_geometry_of_evenement(e.id)
+            FROM e_t_evenement e
+            WHERE e.id = ANY(ids) AND NOT e.supprime;
+    ELSE
+        UPDATE e_t_evenement t
+            SET geom_3d = e.draped,
+                longueur = ST_3DLength(e.draped),
+                pente = e.slope,
+                altitude_minimum = e.min_elevation,
+                altitude_maximum = e.max_elevation,
+                denivelee_positive = e.positive_gain,
+                denivelee_negative = e.negative_gain
+            FROM (SELECT ev.id, elevation.*
+                  FROM e_t_evenement ev,
+                       LATERAL ft_elevation_infos(ev.geom, {{ALTIMETRIC_PROFILE_STEP}}) AS elevation
+                  WHERE ev.id = ANY(ids) AND NOT ev.supprime) AS e
+            WHERE t.id = e.id;
+    END IF;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
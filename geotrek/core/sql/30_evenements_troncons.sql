@@ -49,7 +49,14 @@ CREATE OR REPLACE FUNCTION geotrek.ft_evenements_troncons_geometry() RETURNS tri
 DECLARE
     eid integer;
     eids integer[];
+    mode text;
 BEGIN
+    -- Geometry will be computed explicitly (e.g. after bulk insert)
+    mode := ft_topology_geometry_mode();
+    IF mode = 'manual' THEN
+        RETURN NULL;
+    END IF;
+
     IF TG_OP = 'INSERT' THEN
         eids := array_append(eids, NEW.evenement);
     ELSE
@@ -62,7 +69,11 @@ BEGIN
     END IF;
 
     FOREACH eid IN ARRAY eids LOOP
-        PERFORM update_geometry_of_evenement(eid);
+        IF mode = 'deferred' THEN
+            PERFORM defer_geometry_of_evenement(eid);
+        ELSE
+            PERFORM update_geometry_of_evenement(eid);
+        END IF;
     END LOOP;
 
     RETURN NULL;
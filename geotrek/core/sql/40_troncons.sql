@@ -95,7 +95,10 @@ DECLARE
     egeom geometry;
     linear_offset float;
     side_offset float;
+    mode text;
 BEGIN
+    mode := ft_topology_geometry_mode();
+
     -- Geometry of linear topologies are always updated
     -- Geometry of point topologies are updated if offset = 0
     FOR eid IN SELECT e.id
@@ -104,7 +107,11 @@ BEGIN
                GROUP BY e.id, e.decallage
                HAVING BOOL_OR(et.pk_debut != et.pk_fin) OR e.decallage = 0.0
     LOOP
-        PERFORM update_geometry_of_evenement(eid);
+        IF mode = 'deferred' THEN
+            PERFORM defer_geometry_of_evenement(eid);
+        ELSIF mode != 'manual' THEN
+            PERFORM update_geometry_of_evenement(eid);
+        END IF;
     END LOOP;
 
     -- Special case of point geometries with offset != 0
@@ -170,6 +177,30 @@ CREATE TRIGGER l_t_troncon_10_elevation_iu_tgr
 BEFORE INSERT OR UPDATE OF geom ON l_t_troncon
 FOR EACH ROW EXECUTE PROCEDURE elevation_troncon_iu();
 
+-- Recompute elevation of given paths at once (e.g. after DEM change).
+-- Geometry is left untouched, so that topologies are not updated.
+CREATE OR REPLACE FUNCTION geotrek.redrape_troncons(ids integer[]) RETURNS integer AS $$
+DECLARE
+    updated integer;
+BEGIN
+    UPDATE l_t_troncon t
+        SET geom_3d = e.draped,
+            longueur = ST_3DLength(e.draped),
+            pente = e.slope,
+            altitude_minimum = e.min_elevation,
+            altitude_maximum = e.max_elevation,
+            denivelee_positive = e.positive_gain,
+            denivelee_negative = e.negative_gain
+        FROM (SELECT p.id, elevation.*
+              FROM l_t_troncon p,
+                   LATERAL ft_elevation_infos(p.geom, {{ALTIMETRIC_PROFILE_STEP}}) AS elevation
+              WHERE p.id = ANY(ids)) AS e
+        WHERE t.id = e.id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$ LANGUAGE plpgsql;
+
 
 -------------------------------------------------------------------------------
 -- Change status of related objects when paths are deleted
@@ -198,6 +229,59 @@ BEFORE DELETE ON l_t_troncon
 FOR EACH ROW EXECUTE PROCEDURE troncons_related_objects_d();
 
 
+-------------------------------------------------------------------------------
+-- Move point topologies of a path to the closest other path (before deletion)
+-------------------------------------------------------------------------------
+
+CREATE OR REPLACE FUNCTION geotrek.reattach_point_evenements(tid integer) RETURNS integer AS $$
+DECLARE
+    previous_mode text;
+    t_count integer;
+BEGIN
+    -- Aggregations changes are not taken into account, geometries are computed
+    -- once per topology when offsets are updated (see e_t_evenement_offset_u_tgr)
+    previous_mode := ft_topology_geometry_mode();
+    PERFORM set_config('geotrek.topology_geometry', 'manual', true);
+
+    WITH points AS (
+        SELECT DISTINCT e.id, e.geom
+        FROM e_t_evenement e
+        JOIN e_r_evenement_troncon et ON et.evenement = e.id
+        WHERE et.troncon = tid AND NOT e.supprime AND GeometryType(e.geom) = 'POINT'
+    ), located AS (
+        SELECT points.id, points.geom, closest.id AS troncon, interpolated.position, interpolated.distance
+        FROM points
+        JOIN LATERAL (SELECT candidates.id, candidates.geom
+                      FROM (SELECT t.id, t.geom
+                            FROM l_t_troncon t
+                            WHERE t.id != tid AND t.brouillon = FALSE AND t.visible = TRUE
+                            ORDER BY t.geom <-> points.geom
+                            LIMIT 10) AS candidates
+                      ORDER BY ST_Distance(candidates.geom, points.geom), candidates.id
+                      LIMIT 1) AS closest ON TRUE
+        CROSS JOIN LATERAL ST_InterpolateAlong(closest.geom, points.geom)
+                           AS interpolated(position FLOAT, distance FLOAT)
+    ), removed AS (
+        DELETE FROM e_r_evenement_troncon et
+        USING located
+        WHERE et.evenement = located.id
+    ), added AS (
+        INSERT INTO e_r_evenement_troncon (troncon, evenement, pk_debut, pk_fin, ordre)
+        SELECT located.troncon, located.id, located.position, located.position, 0
+        FROM located
+    )
+    UPDATE e_t_evenement e
+        SET decallage = located.distance, geom = located.geom, supprime = FALSE
+        FROM located
+        WHERE e.id = located.id;
+    GET DIAGNOSTICS t_count = ROW_COUNT;
+
+    PERFORM set_config('geotrek.topology_geometry', previous_mode, true);
+    RETURN t_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
 ---------------------------------------------------------------------
 -- Make sure cache key (base on lastest updated) is refresh on DELETE
 ---------------------------------------------------------------------
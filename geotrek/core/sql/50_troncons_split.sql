@@ -12,6 +12,10 @@ DECLARE
 
     DISTANCE float8;
 BEGIN
+    IF NOT ft_path_snap_split() THEN
+        RETURN NEW;
+    END IF;
+
     DISTANCE := {{PATH_SNAPPING_DISTANCE}};
 
     linestart := ST_StartPoint(NEW.geom);
@@ -108,6 +112,9 @@ DECLARE
     intersections_on_new float8[];
     intersections_on_current float8[];
 BEGIN
+    IF NOT ft_path_snap_split() THEN
+        RETURN NULL;
+    END IF;
 
     -- Copy original geometry
     newgeom := NEW.geom;
@@ -1,9 +1,13 @@
+import os
 from StringIO import StringIO
 
 from django.contrib.gis.geos import LineString
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
+from geotrek.authent.factories import StructureFactory
+from geotrek.core.factories import PathFactory
 from geotrek.core.models import Path
 from geotrek.trekking.factories import POIFactory
 
@@ -61,3 +65,42 @@ class RemoveDuplicatePathTest(TestCase):
                       output.getvalue())
         self.assertIn("duplicate paths have been deleted",
                       output.getvalue())
+
+
+class LoadPathsTest(TestCase):
+    """
+    A and B cross each other, C starts less than a meter from the end of A.
+    """
+    def setUp(self):
+        self.filename = os.path.join(os.path.dirname(__file__), 'data', 'paths.geojson')
+
+    def test_load_paths(self):
+        output = StringIO()
+        structure = StructureFactory.create(name='structure')
+        call_command('loadpaths', self.filename, name_field='name', comments_field='comments',
+                     structure_default='structure', verbosity=1, stdout=output)
+        self.assertEqual(Path.objects.filter(name='A').count(), 2)
+        self.assertEqual(Path.objects.filter(name='B').count(), 2)
+        self.assertEqual(Path.objects.filter(name='C').count(), 1)
+        self.assertEqual(Path.objects.filter(structure=structure).count(), 5)
+        self.assertEqual(Path.objects.get(name='C').comments, 'Snapped on A')
+        self.assertEqual(Path.objects.get(name='C').geom.coords[0], (700100, 6600000))
+        # A and B share the crossing node
+        for path in Path.objects.filter(name__in=['A', 'B']):
+            self.assertIn((700050, 6600000), (path.geom.coords[0], path.geom.coords[-1]))
+        self.assertIn('Search of 0 paths touching existing ones', output.getvalue())
+        self.assertIn('5 paths loaded.', output.getvalue())
+
+    def test_load_paths_crossing_existing(self):
+        PathFactory.create(name='D', geom=LineString((700150, 6599950), (700150, 6600050)))
+        output = StringIO()
+        call_command('loadpaths', self.filename, name_field='name', verbosity=1, stdout=output)
+        # Only C is left to splitting triggers
+        self.assertIn('Search of 1 paths touching existing ones', output.getvalue())
+        self.assertEqual(Path.objects.filter(name='C').count(), 2)
+        self.assertEqual(Path.objects.filter(name='D').count(), 2)
+
+    def test_load_paths_unknown_field(self):
+        with self.assertRaises(CommandError):
+            call_command('loadpaths', self.filename, name_field='nom', verbosity=0)
+        self.assertEqual(Path.objects.count(), 0)
@@ -1,13 +1,22 @@
 import json
+import math
+import struct
 
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.contrib.auth.models import User
-from django.contrib.gis.geos import LineString
+from django.contrib.gis.geos import LineString, Point
 from django.core.urlresolvers import reverse
 
+from geotrek.authent.models import default_structure
+from geotrek.common.tests.benchmark import benchmark, measure, report
 from geotrek.core.factories import PathFactory
-from geotrek.core.graph import graph_edges_nodes_of_qs
+from geotrek.core.graph import graph_edges_nodes_of_qs, path_extremities, GraphStore
+from geotrek.core.helpers import TopologyHelper
 from geotrek.core.models import Path
+from geotrek.core.routing import PathRouter, get_router
 
 
 class SimpleGraph(TestCase):
@@ -55,6 +64,11 @@ class SimpleGraph(TestCase):
         computed_graph = graph_edges_nodes_of_qs(Path.objects.order_by('id'))
         self.assertDictEqual(computed_graph, graph)
 
+    def test_path_extremities(self):
+        path = PathFactory(geom=LineString((1, 1), (2, 5), (3, 3)))
+        rows = list(path_extremities(Path.objects.all(), 'length'))
+        self.assertEqual(rows, [(path.pk, (1.0, 1.0), (3.0, 3.0), path.length)])
+
     def test_json_graph_empty(self):
 
         response = self.client.get(self.url)
@@ -77,3 +91,220 @@ class SimpleGraph(TestCase):
         PathFactory(geom=LineString((0, 0), (1, 1)))
         response = self.client.get(self.url)
         self.assertNotEqual(response['Cache-Control'], None)
+        self.assertIn('X-Graph-Version', response)
+
+    def test_json_graph_unknown_version(self):
+        path = PathFactory(geom=LineString((0, 0), (1, 1)))
+        response = self.client.get(self.url, {'since': '0'})
+        self.assertEqual(response.status_code, 200)
+        graph = json.loads(response.content)
+        self.assertEqual(graph['edges'].keys(), [str(path.pk)])
+        self.assertNotIn('deleted', graph)
+
+    def test_binary_graph(self):
+        ab = PathFactory(geom=LineString((0, 0), (1, 0)))
+        bc = PathFactory(geom=LineString((1, 0), (2, 0)))
+        response = self.client.get(self.url, {'format': 'binary'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        magic, count = struct.unpack('<4sI', response.content[:8])
+        self.assertEqual(magic, 'GTG1')
+        self.assertEqual(count, 2)
+        self.assertEqual(len(response.content), 8 + 2 * 16)
+        sources, targets, ids = [struct.unpack('<2i', response.content[8 + i * 8:16 + i * 8]) for i in range(3)]
+        lengths = struct.unpack('<2f', response.content[32:40])
+        self.assertEqual(ids, (ab.pk, bc.pk))
+        self.assertEqual(sources, (1, 2))
+        self.assertEqual(targets, (2, 3))
+        self.assertAlmostEqual(lengths[0], 1.0)
+
+    def test_binary_graph_negotiated(self):
+        PathFactory(geom=LineString((0, 0), (1, 0)))
+        response = self.client.get(self.url, HTTP_ACCEPT='application/octet-stream')
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertIn('Accept', response['Vary'])
+
+
+class GraphStoreTest(TestCase):
+    def setUp(self):
+        self.ab = PathFactory(geom=LineString((0, 0), (1, 0)))
+        self.bc = PathFactory(geom=LineString((1, 0), (2, 0)))
+        self.store = GraphStore()
+        self.refresh()
+
+    def refresh(self):
+        return self.store.refresh(Path.objects.exclude(draft=True))
+
+    def test_initial_graph(self):
+        self.assertDictEqual(self.store.as_dict(), graph_edges_nodes_of_qs(Path.objects.order_by('id')))
+
+    def test_refresh_without_change(self):
+        version = self.store.version
+        self.assertFalse(self.refresh())
+        self.assertEqual(self.store.version, version)
+        self.assertEqual(self.store.delta(version), {'edges': {}, 'deleted': [], 'nodes': {}})
+
+    def test_delta_of_new_path(self):
+        version = self.store.version
+        cd = PathFactory(geom=LineString((2, 0), (3, 0)))
+        self.assertTrue(self.refresh())
+        self.assertTrue(self.store.version > version)
+        delta = self.store.delta(version)
+        self.assertEqual(delta['edges'].keys(), [cd.pk])
+        self.assertEqual(delta['edges'][cd.pk]['nodes_id'], [3, 4])
+        self.assertEqual(delta['deleted'], [])
+        self.assertDictEqual(delta['nodes'], {3: {2: self.bc.pk, 4: cd.pk}, 4: {3: cd.pk}})
+
+    def test_delta_of_deleted_path(self):
+        version = self.store.version
+        self.bc.delete()
+        self.refresh()
+        delta = self.store.delta(version)
+        self.assertEqual(delta['edges'], {})
+        self.assertEqual(delta['deleted'], [self.bc.pk])
+        self.assertDictEqual(delta['nodes'], {2: {1: self.ab.pk}, 3: {}})
+        self.assertEqual(self.store.as_dict()['edges'].keys(), [self.ab.pk])
+
+    def test_delta_of_deleted_older_path(self):
+        version = self.store.version
+        self.ab.delete()
+        self.assertTrue(self.refresh())
+        delta = self.store.delta(version)
+        self.assertEqual(delta['deleted'], [self.ab.pk])
+        self.assertEqual(self.store.as_dict()['edges'].keys(), [self.bc.pk])
+
+    def test_draft_path_is_removed(self):
+        version = self.store.version
+        self.bc.draft = True
+        self.bc.save()
+        self.refresh()
+        self.assertEqual(self.store.delta(version)['deleted'], [self.bc.pk])
+
+    def test_unknown_version(self):
+        self.assertIsNone(self.store.delta(self.store.base - 1))
+        self.assertIsNone(self.store.delta(self.store.version + 1))
+
+
+class PathRouterTest(TestCase):
+    def setUp(self):
+        self.ab = PathFactory(geom=LineString((0, 0), (100, 0)))
+        self.bc = PathFactory(geom=LineString((100, 0), (200, 0)))
+        self.bd = PathFactory(geom=LineString((100, 0), (100, 100)))
+        self.dc = PathFactory(geom=LineString((100, 100), (200, 100), (200, 0)))
+        self.router = PathRouter.from_queryset(Path.objects.all())
+
+    def test_router_rebuilt_when_older_path_deleted(self):
+        router = get_router()
+        self.assertIs(get_router(), router)
+        self.ab.delete()
+        self.assertIsNot(get_router(), router)
+
+    def test_route_between_two_paths(self):
+        route = self.router.route([(self.ab.pk, 0.5), (self.bc.pk, 0.5)])
+        self.assertEqual(route, [{'offset': 0,
+                                  'paths': [self.ab.pk, self.bc.pk],
+                                  'positions': {'0': (0.5, 1.0), '1': (0.0, 0.5)}}])
+
+    def test_route_along_same_path(self):
+        route = self.router.route([(self.ab.pk, 0.8), (self.ab.pk, 0.2)])
+        self.assertEqual(route, [{'offset': 0,
+                                  'paths': [self.ab.pk],
+                                  'positions': {'0': (0.8, 0.2)}}])
+
+    def test_route_through_via_point(self):
+        route = self.router.route([(self.ab.pk, 0.25), (self.bd.pk, 0.5), (self.bc.pk, 0.5)])
+        self.assertEqual(route[0]['paths'], [self.ab.pk, self.bd.pk])
+        self.assertEqual(route[0]['positions'], {'0': (0.25, 1.0), '1': (0.0, 0.5)})
+        self.assertEqual(route[1]['paths'], [self.bd.pk, self.bc.pk])
+        self.assertEqual(route[1]['positions'], {'0': (0.5, 0.0), '1': (0.0, 0.5)})
+
+    def test_route_is_deserializable(self):
+        route = self.router.route([(self.ab.pk, 0.5), (self.bc.pk, 0.5)])
+        topology = TopologyHelper.deserialize(route)
+        self.assertEqual([a.path for a in topology.aggregations.all()], [self.ab, self.bc])
+        self.assertAlmostEqual(topology.geom.length, 100)
+
+    def test_no_route_between_disconnected_paths(self):
+        other = PathFactory(geom=LineString((0, 500), (100, 500)))
+        router = PathRouter.from_queryset(Path.objects.all())
+        with self.assertRaises(ValueError):
+            router.route([(self.ab.pk, 0.5), (other.pk, 0.5)])
+
+    @override_settings(ROUTING_ASCENT_FACTOR=10)
+    def test_ascent_cost_avoids_climbing(self):
+        router = PathRouter([(1, (0, 0), (100, 0), 100, 50, 0),
+                             (2, (0, 0), (50, 50), 80, 0, 0),
+                             (3, (50, 50), (100, 0), 80, 0, 0)])
+        self.assertEqual(router.route([(1, 0.0), (1, 1.0)])[0]['paths'], [1])
+        self.assertEqual(router.route([(1, 0.0), (1, 1.0)], cost='ascent')[0]['paths'], [2, 3])
+        self.assertEqual(router.route([(1, 1.0), (1, 0.0)], cost='ascent')[0]['paths'], [1])
+
+
+class RouteViewTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('homer', 'h@s.com', 'dooh')
+        success = self.client.login(username=user.username, password='dooh')
+        self.assertTrue(success)
+        self.url = reverse('core:path_json_route')
+        self.ab = PathFactory(geom=LineString((0, 0), (100, 0)))
+        self.bc = PathFactory(geom=LineString((100, 0), (200, 0)))
+
+    def lnglat(self, x, y):
+        point = Point(x, y, srid=settings.SRID).transform(settings.API_SRID, clone=True)
+        return '%s,%s' % (point.x, point.y)
+
+    def test_route_json(self):
+        response = self.client.get(self.url, {'start': self.lnglat(50, 0), 'end': self.lnglat(150, 0)})
+        self.assertEqual(response.status_code, 200)
+        route = json.loads(response.content)
+        self.assertEqual(len(route), 1)
+        self.assertEqual(route[0]['paths'], [self.ab.pk, self.bc.pk])
+        self.assertAlmostEqual(route[0]['positions']['0'][0], 0.5)
+        self.assertAlmostEqual(route[0]['positions']['1'][1], 0.5)
+
+    def test_route_json_bad_parameters(self):
+        response = self.client.get(self.url, {'start': self.lnglat(50, 0)})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'start': 'foo', 'end': self.lnglat(150, 0)})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'start': self.lnglat(50, 0), 'end': self.lnglat(150, 0),
+                                              'cost': 'foo'})
+        self.assertEqual(response.status_code, 400)
+
+
+def graph_of_instances(qs):
+    """Graph built from Path instances, as before paths extremities were streamed"""
+    edges, nodes = {}, {}
+    for path in qs:
+        coords = path.geom.coords
+        start_point, end_point = coords[0], coords[-1]
+        edges[path.pk] = {'id': path.pk, 'length': path.length, 'nodes_id': [start_point, end_point]}
+        nodes.setdefault(start_point, {})[end_point] = path.pk
+        nodes.setdefault(end_point, {})[start_point] = path.pk
+    return {'edges': edges, 'nodes': nodes}
+
+
+class GraphBenchmark(TransactionTestCase):
+    count = 100000
+
+    def setUp(self):
+        # Grid of paths touching at their extremities, neither snapped nor split
+        width = int(math.sqrt(self.count))
+        structure = default_structure()
+        with transaction.atomic():
+            connection.cursor().execute("SELECT set_config('geotrek.path_snap_split', 'off', true)")
+            for offset in range(0, self.count, 1000):
+                paths = []
+                for i in range(offset, min(offset + 1000, self.count)):
+                    x, y = 700000 + (i % width) * 10, 6600000 + (i // width) * 10
+                    paths.append(PathFactory.build(geom=LineString((x, y), (x + 10, y), srid=settings.SRID),
+                                                   structure=structure, comfort=None, source=None, stake=None))
+                Path.objects.bulk_create(paths)
+
+    @benchmark
+    def test_graph_of_100k_paths(self):
+        qs = Path.objects.exclude(draft=True)
+        report("Graph of {} paths".format(self.count), [
+            ("Path instances", ) + measure(graph_of_instances, qs),
+            ("Streamed extremities", ) + measure(graph_edges_nodes_of_qs, qs),
+        ])
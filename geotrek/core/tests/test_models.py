@@ -2,13 +2,15 @@
 import math
 
 from django.test import TestCase
-from django.contrib.gis.geos import LineString
+from django.conf import settings
+from django.contrib.gis.geos import LineString, Point
 from django.db import IntegrityError
 
 from geotrek.common.utils import dbnow
 from geotrek.authent.factories import UserFactory
 from geotrek.authent.models import Structure
 from geotrek.core.factories import (PathFactory, StakeFactory, TrailFactory)
+from geotrek.core.helpers import PathHelper
 from geotrek.core.models import Path
 
 
@@ -194,3 +196,39 @@ class PathGeometryTest(TestCase):
         path_snapped.geom = old_geom
         path_snapped.save()
         self.assertEqual(path_snapped.geom.coords, old_geom.coords)
+
+
+class PathHelperTest(TestCase):
+    def setUp(self):
+        self.ab = PathFactory.create(geom=LineString((0, 0), (10, 0)))
+        self.cd = PathFactory.create(geom=LineString((0, 10), (10, 10)))
+
+    def test_locate_points(self):
+        points = [Point(5, 1, srid=settings.SRID), Point(2, 9, srid=settings.SRID), Point(10, 0, srid=settings.SRID)]
+        locations = PathHelper.locate(points)
+        self.assertEqual([pk for pk, position, offset in locations], [self.ab.pk, self.cd.pk, self.ab.pk])
+        self.assertEqual([position for pk, position, offset in locations], [0.5, 0.2, 1.0])
+        self.assertEqual([abs(offset) for pk, position, offset in locations], [1, 1, 0])
+
+    def test_locate_same_as_closest_and_interpolate(self):
+        point = Point(7, 3, srid=settings.SRID)
+        closest = Path.closest(point)
+        self.assertEqual(PathHelper.locate([point]), [(closest.pk,) + tuple(closest.interpolate(point))])
+
+    def test_locate_ignores_draft_and_excluded_paths(self):
+        PathFactory.create(geom=LineString((0, 1), (10, 1)), draft=True)
+        point = Point(5, 2, srid=settings.SRID)
+        self.assertEqual(PathHelper.locate([point])[0][0], self.ab.pk)
+        self.assertEqual(PathHelper.locate([point], exclude=[self.ab])[0][0], self.cd.pk)
+
+    def test_locate_without_path(self):
+        self.assertEqual(PathHelper.locate([]), [])
+        with self.assertRaises(IndexError):
+            PathHelper.locate([Point(5, 2, srid=settings.SRID)], exclude=[self.ab, self.cd])
+
+    def test_snap_many(self):
+        points = PathHelper.snap_many([self.ab.pk, self.cd.pk], [Point(5, 1, srid=settings.SRID),
+                                                                 Point(2, 9, srid=settings.SRID)])
+        self.assertEqual([point.coords for point in points], [(5, 0), (2, 10)])
+        with self.assertRaises(ValueError):
+            PathHelper.snap_many([self.ab.pk + self.cd.pk], [Point(5, 1, srid=settings.SRID)])
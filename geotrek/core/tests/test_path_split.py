@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
+from django.db import connection
 from django.test import TestCase
 from django.contrib.gis.geos import LineString, Point
 from django.conf import settings
 
+from geotrek.common.tests.benchmark import benchmark, duration, report
 from geotrek.common.utils import almostequal
 
 from geotrek.core.factories import PathFactory, TopologyFactory, NetworkFactory, UsageFactory
+from geotrek.core.helpers import topology_geometry_mode
 from geotrek.core.models import Path, Topology
 
 
@@ -1531,3 +1534,127 @@ class SplitPathGenericTopologyTest(TestCase):
         # But topology resulting geometry did not change
         originalgeom = LineString((2.2071067811865470, 0), *originalgeom[1:], srid=settings.SRID)
         self.assertEqual(topology.geom, originalgeom)
+
+
+class SplitPathDeferredGeometryTest(TestCase):
+    """
+    Splitting paths while topologies geometries are computed once for all
+    gives the same result as computing them on every change.
+    """
+    def split_tee(self, mode, y, on_split=lambda: None):
+        ab = PathFactory.create(name="AB", geom=LineString((0, y), (4, y)))
+        line = TopologyFactory.create(no_path=True)
+        line.add_path(ab, start=0.25, end=0.75)
+        point = TopologyFactory.create(no_path=True)
+        point.add_path(ab, start=0.6, end=0.6)
+        on_split()
+        with topology_geometry_mode(mode):
+            PathFactory.create(name="CD", geom=LineString((2, y), (2, y + 2)))
+            PathFactory.create(name="EF", geom=LineString((3, y - 1), (3, y + 1)))
+        line.reload()
+        point.reload()
+        return line, point
+
+    def test_split_tee(self):
+        line, point = self.split_tee('immediate', 0)
+        deferred_line, deferred_point = self.split_tee('deferred', 10)
+        self.assertEqual(len(deferred_line.paths.all()), len(line.paths.all()))
+        self.assertEqual(deferred_line.geom.coords[0], (1, 10))
+        self.assertEqual(deferred_line.geom.coords[-1], (3, 10))
+        self.assertEqual(deferred_line.length, line.length)
+        self.assertEqual(deferred_point.geom.coords, (point.geom.x, point.geom.y + 10))
+
+    def count_geometry_updates(self):
+        """Records topologies whose geometry is updated, from now on"""
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS test_geometry_updates CASCADE")
+            cursor.execute("CREATE TABLE test_geometry_updates (evenement integer)")
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION test_count_geometry_update() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO test_geometry_updates VALUES (NEW.id);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            """)
+            cursor.execute("DROP TRIGGER IF EXISTS test_count_geometry_update_tgr ON e_t_evenement")
+            cursor.execute("""
+                CREATE TRIGGER test_count_geometry_update_tgr AFTER UPDATE OF geom ON e_t_evenement
+                FOR EACH ROW EXECUTE PROCEDURE test_count_geometry_update()
+            """)
+
+    def geometry_updates(self, *topologies):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT evenement FROM test_geometry_updates")
+            updates = [row[0] for row in cursor.fetchall()]
+        return [updates.count(topology.pk) for topology in topologies]
+
+    def test_geometry_is_computed_once_per_topology(self):
+        line, point = self.split_tee('immediate', 0, on_split=self.count_geometry_updates)
+        self.assertGreater(self.geometry_updates(line)[0], 1)
+        line, point = self.split_tee('deferred', 10, on_split=self.count_geometry_updates)
+        self.assertEqual(self.geometry_updates(line, point), [1, 1])
+
+    def test_geometry_is_computed_when_leaving_block(self):
+        ab = PathFactory.create(name="AB", geom=LineString((0, 0), (4, 0)))
+        topology = TopologyFactory.create(no_path=True)
+        topology.add_path(ab, start=0.0, end=1.0)
+        with topology_geometry_mode('deferred'):
+            ab.geom = LineString((0, 0), (8, 0))
+            ab.save()
+            topology.reload()
+            self.assertEqual(topology.length, 4)
+        topology.reload()
+        self.assertEqual(topology.length, 8)
+
+
+class SplitPathBenchmark(TestCase):
+    """Splitting and editing a path carrying many topologies, with topologies
+    geometries computed immediately or deferred"""
+    count = 300
+
+    def setUp(self):
+        self.results = []
+
+    def tearDown(self):
+        report(self.id(), self.results)
+
+    def create_topologies(self, y):
+        ab = PathFactory.create(name="AB", geom=LineString((0, y), (4, y)))
+        for i in range(self.count):
+            topology = TopologyFactory.create(no_path=True)
+            topology.add_path(ab, start=0.1, end=0.9)
+            point = TopologyFactory.create(no_path=True)
+            point.add_path(ab, start=0.5, end=0.5)
+        return ab
+
+    def run_modes(self, scenario):
+        for y, mode in ((0, 'immediate'), (100, 'deferred')):
+            path = self.create_topologies(y)
+
+            def run():
+                with topology_geometry_mode(mode):
+                    scenario(path, y)
+            self.results.append((mode, duration(run)))
+
+    @benchmark
+    def test_split_tee(self):
+        def scenario(ab, y):
+            PathFactory.create(name="CD", geom=LineString((2, y), (2, y + 2)))
+            PathFactory.create(name="EF", geom=LineString((3, y - 1), (3, y + 1)))
+        self.run_modes(scenario)
+
+    @benchmark
+    def test_split_cross(self):
+        def scenario(ab, y):
+            PathFactory.create(name="CD", geom=LineString((1, y - 1), (1, y + 1)))
+            PathFactory.create(name="EF", geom=LineString((2, y - 1), (2, y + 1)))
+            PathFactory.create(name="GH", geom=LineString((3, y - 1), (3, y + 1)))
+        self.run_modes(scenario)
+
+    @benchmark
+    def test_edit_geometry(self):
+        def scenario(ab, y):
+            ab.geom = LineString((0, y), (2, y + 1), (4, y))
+            ab.save()
+        self.run_modes(scenario)
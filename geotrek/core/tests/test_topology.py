@@ -6,11 +6,12 @@ from django.conf import settings
 from django.db import connections, DEFAULT_DB_ALIAS
 from django.contrib.gis.geos import Point, LineString
 
+from geotrek.common.tests.benchmark import benchmark, duration, report
 from geotrek.common.utils import dbnow, almostequal
 from geotrek.core.factories import (PathFactory, PathAggregationFactory,
                                     TopologyFactory)
 from geotrek.core.models import Path, Topology, PathAggregation
-from geotrek.core.helpers import TopologyHelper
+from geotrek.core.helpers import PathHelper, TopologyHelper, topology_geometry_mode
 
 
 def dictfetchall(cursor):
@@ -183,6 +184,67 @@ class TopologyDeletionTest(TestCase):
         topology.reload()
         self.assertTrue(topology.deleted)
 
+    def test_points_moved_to_closest_path_when_path_deleted(self):
+        path = PathFactory.create(geom=LineString((0, 0), (10, 0)))
+        near = PathFactory.create(geom=LineString((0, 5), (10, 5)))
+        PathFactory.create(geom=LineString((0, 20), (10, 20)))
+        points = [TopologyHelper.topologypoint(Point(x, 0, srid=settings.SRID), (path.pk, x / 10.0, 0))
+                  for x in range(1, 10)]
+        point = Point(4, 2, srid=settings.SRID)
+        topology = TopologyHelper.topologypoint(point, PathHelper.locate([point])[0])
+        self.assertEqual(topology.paths.get(), path)
+
+        path.delete()
+
+        topology.reload()
+        self.assertFalse(topology.deleted)
+        self.assertEqual(topology.paths.get(), near)
+        self.assertEqual(topology.geom.coords, (4, 2))
+        self.assertAlmostEqual(abs(topology.offset), 3)
+        self.assertAlmostEqual(topology.aggregations.get().start_position, 0.4)
+        for x, topology in enumerate(points, 1):
+            topology.reload()
+            self.assertFalse(topology.deleted)
+            self.assertEqual(topology.paths.get(), near)
+            self.assertEqual(topology.geom.coords, (x, 0))
+
+
+def delete_path_and_reattach_instances(path):
+    """Former ``Path.delete()``, re-attaching point topologies one by one (baseline of benchmark)"""
+    topologies = list(path.topology_set.filter())
+    super(Path, path).delete()
+    topologies = [topology for topology in topologies if isinstance(topology.geom, Point)]
+    locations = PathHelper.locate([topology.geom for topology in topologies])
+    for topology, (closest, position, offset) in zip(topologies, locations):
+        new_topology = Topology.objects.create()
+        PathAggregation.objects.create(topo_object=new_topology, start_position=position,
+                                       end_position=position, path_id=closest)
+        new_topology.geom = Point(topology.geom.x, topology.geom.y, srid=settings.SRID)
+        new_topology.offset = offset
+        new_topology.position = position
+        new_topology.save()
+        topology.mutate(new_topology)
+
+
+class TopologyDeletionBenchmark(TestCase):
+    count = 1000
+
+    def create_points(self, y):
+        path = PathFactory.create(geom=LineString((0, y), (1000, y)))
+        PathFactory.create(geom=LineString((0, y + 5), (1000, y + 5)))
+        for i in range(self.count):
+            x = i * 1000.0 / self.count
+            TopologyHelper.topologypoint(Point(x, y + 1, srid=settings.SRID), (path.pk, x / 1000.0, 1))
+        return path
+
+    @benchmark
+    def test_delete_path_with_1k_points(self):
+        path = self.create_points(0)
+        results = [('one by one', duration(delete_path_and_reattach_instances, path))]
+        path = self.create_points(100)
+        results.append(('reattach_point_evenements()', duration(path.delete)))
+        report(self.id(), results)
+
 
 class TopologyMutateTest(TestCase):
 
@@ -869,6 +931,24 @@ class TopologyDerialization(TestCase):
         self.assertEqual(topology.aggregations.all()[2].start_position, 0.0)
         self.assertEqual(topology.aggregations.all()[2].end_position, 0.7)
 
+    def test_deserialize_computes_geometry(self):
+        p1 = PathFactory.create(geom=LineString((0, 0), (2, 0)))
+        p2 = PathFactory.create(geom=LineString((2, 0), (2, 2)))
+        serialized = [{"paths": [p1.pk, p2.pk], "positions": {"0": [0.5, 1.0], "1": [0.0, 0.5]}, "offset": 0}]
+        topology = Topology.deserialize(json.dumps(serialized))
+        self.assertEqual(topology.geom.coords[0], (1, 0))
+        self.assertEqual(topology.geom.coords[-1], (2, 1))
+        self.assertEqual(topology.length, 2)
+        self.assertFalse(topology.deleted)
+
+    def test_deserialize_unknown_path(self):
+        path = PathFactory.create()
+        count = Topology.objects.count()
+        serialized = [{"paths": [path.pk, path.pk + 1000], "offset": 0}]
+        with self.assertRaises(ValueError):
+            Topology.deserialize(json.dumps(serialized))
+        self.assertEqual(Topology.objects.count(), count)
+
     def test_deserialize_point(self):
         PathFactory.create()
         # Take a point
@@ -902,6 +982,19 @@ class TopologyDerialization(TestCase):
         self.assertTrue(almostequal(end_before, end_after), '%s != %s' % (end_before, end_after))
 
 
+class TopologyGeometryModeTest(TestCase):
+
+    def test_manual_mode_does_not_compute_geometry(self):
+        path = PathFactory.create(geom=LineString((0, 0), (10, 0)))
+        topology = TopologyFactory.create(no_path=True)
+        with topology_geometry_mode('manual'):
+            topology.add_path(path, start=0.0, end=0.5)
+        self.assertEqual(topology.geom.coords, (0, 0))
+        # Back to default mode
+        topology.add_path(path, start=0.5, end=1.0, order=1)
+        self.assertEqual(topology.length, 10)
+
+
 class TopologyOverlappingTest(TestCase):
 
     def setUp(self):
@@ -936,6 +1029,8 @@ class TopologyOverlappingTest(TestCase):
         overlaps = Topology.overlapping(self.topo1)
         overlaps = overlaps.filter(pk__in=[self.point1.pk, self.point2.pk])
         self.assertEqual(len(overlaps), 2)
+        self.assertEqual(overlaps.count(), 2)
+        self.assertEqual(Topology.objects.filter(pk__in=overlaps.values('pk')).count(), 2)
 
     def test_overlapping_return_sharing_path(self):
         overlaps = Topology.overlapping(self.topo1)
@@ -952,6 +1047,14 @@ class TopologyOverlappingTest(TestCase):
         self.assertEqual(list(overlaps), [self.topo1,
                                           self.point2, self.point3, self.point1, self.topo2])
 
+    def test_overlapping_bulk(self):
+        overlaps = Topology.overlapping_bulk([self.topo1, self.topo2, self.point1])
+        self.assertEqual(overlaps[self.topo1.pk], [self.topo1,
+                                                   self.point2, self.point3, self.point1, self.topo2])
+        self.assertEqual(overlaps[self.topo2.pk], [self.topo2,
+                                                   self.point1, self.point3, self.point2, self.topo1])
+        self.assertEqual(overlaps[self.point1.pk], [self.topo2, self.point1, self.topo1])
+
     def test_overlapping_does_not_fail_if_no_records(self):
         from geotrek.trekking.models import Trek
         overlaps = Topology.overlapping(Trek.objects.all())
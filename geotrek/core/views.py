@@ -7,10 +7,12 @@ from collections import defaultdict
 from django.contrib.auth.decorators import permission_required
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.contrib.gis.geos import Point
 from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
-from django.views.decorators.http import last_modified as cache_last_modified
+from django.views.decorators.http import etag
 from django.views.decorators.cache import cache_control
+from django.utils.cache import patch_vary_headers
 from django.views.generic import View, TemplateView
 from django.utils.translation import ugettext as _
 from django.core.cache import caches
@@ -28,10 +30,12 @@ from geotrek.common.utils import classproperty
 from geotrek.common.views import PublicOrReadPermMixin
 from geotrek.core.models import AltimetryMixin
 
+from .helpers import PathHelper
 from .models import Path, Trail, Topology
 from .forms import PathForm, TrailForm
 from .filters import PathFilterSet, TrailFilterSet
 from . import graph as graph_lib
+from .routing import get_router
 from django.http.response import HttpResponse, JsonResponse
 from django.contrib import messages
 from django.db.models import Sum
@@ -258,27 +262,74 @@ class PathDelete(MapEntityDelete):
 
 @login_required
 @cache_control(max_age=0, must_revalidate=True)
-@cache_last_modified(lambda x: Path.latest_updated())
+@etag(lambda request: '%s-%s' % graph_lib.paths_state(Path.objects.all()))
 def get_graph_json(request):
+    """
+    Graph of the path network. The ``X-Graph-Version`` header gives its version.
+    With ``?since=<version>``, only the changes since this version are returned
+    (see ``GraphStore.delta``), unless it is unknown: the whole graph is then returned.
+    With ``?format=binary`` (or ``Accept: application/octet-stream``), the whole
+    graph is returned as a compact edge list (see ``graph_binary``).
+    """
     cache = caches['fat']
-    key = 'path_graph_json'
+    key = 'path_graph_store'
 
-    result = cache.get(key)
-    latest = Path.latest_updated()
+    # Apply changes since last request to the cached graph
+    store = cache.get(key) or graph_lib.GraphStore()
+    if store.refresh(Path.objects.exclude(draft=True)):
+        cache.set(key, store)
+
+    delta = None
+    since = request.GET.get('since')
+    if since:
+        try:
+            delta = store.delta(int(since))
+        except ValueError:
+            pass
+    if delta is not None:
+        response = HttpJSONResponse(json.dumps(delta))
+        response['X-Graph-Version'] = store.version
+        return response
 
-    if result and latest:
-        cache_latest, json_graph = result
-        # Not empty and still valid
-        if cache_latest and cache_latest >= latest:
-            return HttpJSONResponse(json_graph)
+    # Compact binary encoding, if requested (see ``graph_binary``)
+    accept = request.META.get('HTTP_ACCEPT', '')
+    binary = request.GET.get('format') == 'binary' or graph_lib.BINARY_GRAPH_CONTENT_TYPE in accept
+    key, encode = ('path_graph_binary', graph_lib.graph_binary) if binary else ('path_graph_json', json.dumps)
+
+    result = cache.get(key)
+    if result and result[0] == store.version:
+        content = result[1]
+    else:
+        content = encode(store.as_dict())
+        cache.set(key, (store.version, content))
+    if binary:
+        response = HttpResponse(content, content_type=graph_lib.BINARY_GRAPH_CONTENT_TYPE)
+    else:
+        response = HttpJSONResponse(content)
+    response['X-Graph-Version'] = store.version
+    patch_vary_headers(response, ['Accept'])
+    return response
 
-    # cache does not exist or is not up to date
-    # rebuild the graph and cache the json
-    graph = graph_lib.graph_edges_nodes_of_qs(Path.objects.exclude(draft=True))
-    json_graph = json.dumps(graph)
 
-    cache.set(key, (latest, json_graph))
-    return HttpJSONResponse(json_graph)
+@login_required
+@cache_control(max_age=0, must_revalidate=True)
+def get_route_json(request):
+    """
+    Shortest route on the path network between ``start`` and ``end`` points,
+    passing through optional ``via`` points (given as ``lng,lat``).
+    Returns the topology serialized as in ``TopologyHelper.deserialize``.
+    """
+    try:
+        coords = [request.GET['start']] + request.GET.getlist('via') + [request.GET['end']]
+        points = []
+        for coord in coords:
+            lng, lat = [float(v) for v in coord.split(',')]
+            points.append(Point(lng, lat, srid=settings.API_SRID).transform(settings.SRID, clone=True))
+        anchors = [(pk, position) for pk, position, offset in PathHelper.locate(points)]
+        topology = get_router().route(anchors, cost=request.GET.get('cost', 'length'))
+    except (KeyError, ValueError, IndexError) as exc:
+        return JsonResponse({u'error': u'%s' % exc}, status=400)
+    return HttpJSONResponse(json.dumps(topology))
 
 
 class TrailLayer(MapEntityLayer):
@@ -3,12 +3,13 @@
 import os.path
 
 from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import Point
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
 from geotrek.authent.models import default_structure
 from geotrek.authent.models import Structure
-from geotrek.core.helpers import TopologyHelper
+from geotrek.core.helpers import TopologyHelper, PathHelper
 from geotrek.infrastructure.models import (InfrastructureType,
                                            InfrastructureCondition, Infrastructure)
 from django.conf import settings
@@ -126,6 +127,7 @@ class Command(BaseCommand):
                         u"Change your --eid-field option"))
                     break
 
+                features = []
                 for feature in layer:
                     feature_geom = feature.geom.transform(settings.API_SRID, clone=True)
                     feature_geom.coord_dim = 2
@@ -148,8 +150,13 @@ class Command(BaseCommand):
                         field_implantation_year).isdigit() else options.get('year_default')
                     eid = feature.get(field_eid) if field_eid in available_fields else None
 
-                    self.create_infrastructure(feature_geom, name, type, condition, structure, description, year,
-                                               verbosity, eid)
+                    features.append((feature_geom, name, type, condition, structure, description, year,
+                                     verbosity, eid))
+
+                # Locate all points on paths at once
+                locations = PathHelper.locate([self.point(values[0]) for values in features])
+                for values, location in zip(features, locations):
+                    self.create_infrastructure(*values, location=location)
 
             transaction.savepoint_commit(sid)
             if verbosity >= 2:
@@ -160,8 +167,11 @@ class Command(BaseCommand):
             transaction.savepoint_rollback(sid)
             raise
 
+    def point(self, geometry):
+        return Point(geometry.x, geometry.y, srid=settings.API_SRID).transform(settings.SRID, clone=True)
+
     def create_infrastructure(self, geometry, name, type,
-                              condition, structure, description, year, verbosity, eid):
+                              condition, structure, description, year, verbosity, eid, location=None):
 
         infra_type, created = InfrastructureType.objects.get_or_create(label=type, type='B', structure=None)
         if created and verbosity:
@@ -194,8 +204,10 @@ class Command(BaseCommand):
             else:
                 infra = Infrastructure.objects.create(**fields_without_eid)
 
-        serialized = '{"lng": %s, "lat": %s}' % (geometry.x, geometry.y)
-        topology = TopologyHelper.deserialize(serialized)
+        point = self.point(geometry)
+        if location is None:
+            location = PathHelper.locate([point])[0]
+        topology = TopologyHelper.topologypoint(point, location)
         infra.mutate(topology)
 
         self.counter += 1
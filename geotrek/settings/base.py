@@ -417,10 +417,12 @@ PATHS_LINE_MARKER = 'dotL'
 PATH_SNAPPING_DISTANCE = 1  # Distance of path snapping in meters
 SNAP_DISTANCE = 30  # Distance of snapping in pixels
 PATH_MERGE_SNAPPING_DISTANCE = 2  # minimum distance to merge paths
+ROUTING_ASCENT_FACTOR = 10  # Length (in meters) equivalent to one meter of ascent in routing
 
 ALTIMETRIC_PROFILE_PRECISION = 25  # Sampling precision in meters
 ALTIMETRIC_PROFILE_AVERAGE = 2  # nb of points for altimetry moving average
 ALTIMETRIC_PROFILE_STEP = 1  # Step min precision for positive / negative altimetry gain
+ALTIMETRIC_SET_BASED_SQL = True  # Drape and smooth lines with set-based queries instead of loops
 ALTIMETRIC_PROFILE_BACKGROUND = 'white'
 ALTIMETRIC_PROFILE_COLOR = '#F77E00'
 ALTIMETRIC_PROFILE_HEIGHT = 400
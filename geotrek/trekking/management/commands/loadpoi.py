@@ -1,9 +1,10 @@
 import os.path
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import GEOSGeometry, Point
 
-from geotrek.core.helpers import TopologyHelper
+from geotrek.core.helpers import TopologyHelper, PathHelper
 from geotrek.trekking.models import POI, POIType
 
 
@@ -35,6 +36,7 @@ class Command(BaseCommand):
         if options['verbosity'] >= 1:
             self.stdout.write('%s objects found' % count)
 
+        features = []
         for i in range(count):
             feature = layer.GetFeature(i)
             featureGeom = feature.GetGeometryRef()
@@ -45,15 +47,25 @@ class Command(BaseCommand):
             poitype = feature.GetFieldAsString(self.field_poitype)
             if poitype:
                 poitype = poitype.decode('utf-8')
-            self.create_poi(geometry, name, poitype)
+            features.append((geometry, name, poitype))
 
-    def create_poi(self, geometry, name, poitype):
+        # Locate all points on paths at once
+        locations = PathHelper.locate([self.point(values[0]) for values in features])
+        for values, location in zip(features, locations):
+            self.create_poi(*values, location=location)
+
+    def point(self, geometry):
+        return Point(geometry.x, geometry.y, srid=settings.API_SRID).transform(settings.SRID, clone=True)
+
+    def create_poi(self, geometry, name, poitype, location=None):
         poitype, created = POIType.objects.get_or_create(label=poitype)
         poi = POI.objects.create(name=name, type=poitype)
         # Use existing topology helpers to transform a Point(x, y)
         # to a path aggregation (topology)
-        serialized = '{"lng": %s, "lat": %s}' % (geometry.x, geometry.y)
-        topology = TopologyHelper.deserialize(serialized)
+        point = self.point(geometry)
+        if location is None:
+            location = PathHelper.locate([point])[0]
+        topology = TopologyHelper.topologypoint(point, location)
         # Move deserialization aggregations to the POI
         poi.mutate(topology)
         return poi
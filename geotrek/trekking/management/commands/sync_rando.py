@@ -1,16 +1,26 @@
 # -*- encoding: UTF-8 -
 
+import errno
+import hashlib
+import json
 import logging
-import filecmp
+import math
+import multiprocessing
 import os
 import re
 import shutil
-from time import sleep
+import tempfile
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from time import sleep, time
 from zipfile import ZipFile
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.core.management.base import BaseCommand, CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import Polygon
+from django.core.management.base import BaseCommand, CommandError, OutputWrapper
+from django.db import connections
 from django.db.models import Q
 from django.http import StreamingHttpResponse
 from django.test.client import RequestFactory
@@ -19,6 +29,7 @@ from django.utils.translation import ugettext as _
 from landez import TilesManager
 from landez.sources import DownloadError
 from geotrek.common.models import FileType  # NOQA
+from geotrek.altimetry.helpers import AltimetryHelper
 from geotrek.altimetry.views import ElevationProfile, ElevationArea, serve_elevation_chart
 from geotrek.common import models as common_models
 from geotrek.common.views import ThemeViewSet
@@ -47,22 +58,211 @@ from geotrek.tourism import urls  # NOQA
 
 logger = logging.getLogger(__name__)
 
+# Fingerprints and files of synced treks, used by ``--incremental``
+MANIFEST = 'sync_rando.json'
 
-class ZipTilesBuilder(object):
-    def __init__(self, filepath, close_zip, **builder_args):
+
+def mkdirs(name):
+    dirname = os.path.dirname(name)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            # Created meanwhile by another process
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def fix_2028(chunks):
+    """Replaces escaped unicode characters 2028 and 2029, that make
+    Geotrek-mobile crash, by escaped newlines in a stream of chunks.
+    """
+    tail = b''
+    for chunk in chunks:
+        chunk = (tail + chunk).replace(b'\\u2028', b'\\n').replace(b'\\u2029', b'\\n')
+        # Keep the end, which may be the beginning of an escaped character
+        tail = chunk[-5:]
+        yield chunk[:-5]
+    yield tail
+
+
+class ContentStore(object):
+    """Content-addressed store of synced files: each content is stored once,
+    under its SHA-1 digest, and hard linked wherever it is synced. Identical
+    files are then links to the same stored file.
+    """
+    # Temporary files older than this (in seconds) were left by interrupted syncs
+    tmp_max_age = 24 * 3600
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+        if not os.path.exists(self.tmp):
+            os.makedirs(self.tmp)
+        # Temporary files are created 0600, give them the mode open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def add(self, chunks):
+        """Stores content, given as chunks written while hashed, unless already
+        stored. Returns the stored file path.
+        """
+        sha1 = hashlib.sha1()
+        f = tempfile.NamedTemporaryFile(dir=self.tmp, delete=False)
+        try:
+            for chunk in chunks:
+                sha1.update(chunk)
+                f.write(chunk)
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+        f.close()
+        path = self.path(sha1.hexdigest())
+        if os.path.exists(path):
+            os.unlink(f.name)
+        else:
+            os.chmod(f.name, self.mode)
+            mkdirs(path)
+            os.rename(f.name, path)
+        return path
+
+    def add_file(self, filename, digest):
+        """Stores a file under the given digest, unless already stored, and
+        replaces it by a link to the stored file. Returns the stored file path.
+        """
+        path = self.path(digest)
+        mkdirs(path)
+        try:
+            os.link(filename, path)
+        except OSError as e:
+            # Already stored
+            if e.errno != errno.EEXIST:
+                raise
+            os.unlink(filename)
+            os.link(path, filename)
+        return path
+
+    def prune(self):
+        """Removes stored files which are not linked anywhere anymore, and
+        temporary files left by interrupted syncs. Temporary files of syncs
+        running in the same store are kept.
+        """
+        if not os.path.exists(self.root):
+            return
+        expired = time() - self.tmp_max_age
+        for name in os.listdir(self.tmp):
+            path = os.path.join(self.tmp, name)
+            if os.stat(path).st_mtime < expired:
+                os.unlink(path)
+        for dirname in os.listdir(self.root):
+            dirpath = os.path.join(self.root, dirname)
+            if dirpath == self.tmp or not os.path.isdir(dirpath):
+                continue
+            for name in os.listdir(dirpath):
+                path = os.path.join(dirpath, name)
+                if os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+
+
+class ZipMembers(object):
+    """Stands for a zip file in worker processes: records the files to be
+    zipped, so that the main process adds them to the real zip file.
+    """
+    def __init__(self):
+        self.members = []
+
+    def write(self, filename, arcname):
+        self.members.append((filename, arcname))
+
+    def namelist(self):
+        return [arcname for filename, arcname in self.members]
+
+
+def init_sync_worker(command):
+    global sync_command
+    sync_command = command
+
+
+def sync_trek_worker(task):
+    """Syncs one trek, given as ``(language, pk)``, in a worker process.
+    Returns output, followed by the result of ``Command.sync_trek_unit()``.
+    """
+    lang, pk = task
+    command = sync_command
+    command.stdout = OutputWrapper(StringIO())
+    translation.activate(lang)
+    try:
+        result = command.sync_trek_unit(lang, trekking_models.Trek.objects.get(pk=pk))
+    finally:
+        translation.deactivate()
+    return (command.stdout._out.getvalue(), ) + result
+
+
+def lnglat_tile(lng, lat, z):
+    """Returns the (x, y) coordinates, in XYZ scheme, of the tile containing
+    a WGS84 position at zoom level z.
+    """
+    n = 2 ** z
+    lat = math.radians(max(min(lat, 85.0511), -85.0511))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bbox(z, x, y):
+    """Returns the WGS84 bbox of a tile in XYZ scheme.
+    """
+    n = 2.0 ** z
+
+    def tile_lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (x / n * 360.0 - 180.0, tile_lat(y + 1), (x + 1) / n * 360.0 - 180.0, tile_lat(y))
+
+
+def polygon_tiles(polygon, zoomlevels, tile_scheme='wmts'):
+    """Returns the set of tiles (z, x, y) intersecting a WGS84 polygon at
+    the specified zoom levels.
+    """
+    tiles = set()
+    west, south, east, north = polygon.extent
+    prepared = polygon.prepared
+    for z in zoomlevels:
+        xmin, ymin = lnglat_tile(west, north, z)
+        xmax, ymax = lnglat_tile(east, south, z)
+        for x in range(xmin, xmax + 1):
+            for y in range(ymin, ymax + 1):
+                if prepared.intersects(Polygon.from_bbox(tile_bbox(z, x, y))):
+                    tiles.add((z, x, (2 ** z - 1) - y if tile_scheme == 'tms' else y))
+    return tiles
+
+
+class TilesFetcher(object):
+    """Fetches tiles into the local tiles cache, with a pool of threads.
+    The cache is shared by all tiles zip files, and tiles already in cache
+    are not fetched again, so that an interrupted sync is resumed.
+    """
+    def __init__(self, jobs=1, **builder_args):
         builder_args['tile_format'] = self.format_from_url(builder_args['tiles_url'])
-        self.close_zip = close_zip
-        self.zipfile = ZipFile(filepath, 'w')
         self.tm = TilesManager(**builder_args)
 
         if not isinstance(settings.MOBILE_TILES_URL, str) and len(settings.MOBILE_TILES_URL) > 1:
             for url in settings.MOBILE_TILES_URL[1:]:
-                args = builder_args
+                args = dict(builder_args)
                 args['tiles_url'] = url
                 args['tile_format'] = self.format_from_url(args['tiles_url'])
                 self.tm.add_layer(TilesManager(**args), opacity=1)
 
-        self.tiles = set()
+        # Tiles are written complete or not at all, interrupted syncs then never leave truncated tiles in cache
+        self.tm.cache.save = self.save_tile
+
+        self.jobs = jobs
+        self.pool = None
 
     def format_from_url(self, url):
         """
@@ -75,19 +275,93 @@ class ZipTilesBuilder(object):
             return m.group(1)
         return url.rsplit('.')[-1]
 
-    def add_coverage(self, bbox, zoomlevels):
-        self.tiles |= set(self.tm.tileslist(bbox, zoomlevels))
+    @property
+    def extension(self):
+        return self.tm._tile_extension
 
-    def run(self):
-        for tile in self.tiles:
-            name = '{0}/{1}/{2}{ext}'.format(*tile, ext=settings.MOBILE_TILES_EXTENSION or self.tm._tile_extension)
+    def tileslist(self, bbox, zoomlevels):
+        return set(self.tm.tileslist(bbox, zoomlevels))
+
+    def polygon_tiles(self, polygon, zoomlevels):
+        return polygon_tiles(polygon, zoomlevels, self.tm.tile_scheme)
+
+    def fetch(self, tiles):
+        """Fetches the tiles which are not in cache yet.
+        """
+        columns = {}
+        for tile in tiles:
+            path = self.tm.cache.tile_fullpath(tile)
+            if os.path.exists(path):
+                if os.path.getsize(path) > 0:
+                    continue
+                # Empty tile left by an interrupted sync of a previous version
+                os.remove(path)
+            columns.setdefault(tile[:2], []).append(tile)
+        # Tiles of a column are fetched by the same thread, since they share the same cache directory
+        if self.jobs > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.jobs)
+            self.pool.map(self.fetch_column, columns.values())
+        else:
+            for column in columns.values():
+                self.fetch_column(column)
+
+    def fetch_column(self, tiles):
+        for tile in tiles:
             try:
-                data = self.tm.tile(tile)
+                self.tm.tile(tile)
             except DownloadError:
-                logger.warning("Failed to download tile %s" % name)
-            else:
-                self.zipfile.writestr(name, data)
-        self.close_zip(self.zipfile)
+                logger.warning("Failed to download tile %s" % '/'.join(map(str, tile)))
+
+    def save_tile(self, body, tile):
+        """Saves tile data in cache through a temporary file, renamed once written.
+        """
+        path = self.tm.cache.tile_fullpath(tile)
+        mkdirs(path)
+        f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False)
+        try:
+            f.write(body)
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+        f.close()
+        os.rename(f.name, path)
+
+    def tile(self, tile):
+        """Returns tile data from cache, or ``None`` if it could not be fetched.
+        """
+        return self.tm.cache.read(tile)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class ZipTilesBuilder(object):
+    def __init__(self, filepath, close_zip, fetcher):
+        self.filepath = filepath
+        self.close_zip = close_zip
+        self.fetcher = fetcher
+        self.tiles = set()
+
+    def add_coverage(self, bbox, zoomlevels):
+        self.tiles |= self.fetcher.tileslist(bbox, zoomlevels)
+
+    def add_polygon_coverage(self, polygon, zoomlevels):
+        self.tiles |= self.fetcher.polygon_tiles(polygon, zoomlevels)
+
+    def run(self):
+        self.fetcher.fetch(self.tiles)
+        zipfile = ZipFile(self.filepath, 'w')
+        for tile in sorted(self.tiles):
+            name = '{0}/{1}/{2}{ext}'.format(*tile, ext=settings.MOBILE_TILES_EXTENSION or self.fetcher.extension)
+            data = self.fetcher.tile(tile)
+            if data is not None:
+                zipfile.writestr(name, data)
+        self.close_zip(zipfile)
 
 
 class Command(BaseCommand):
@@ -104,6 +378,9 @@ class Command(BaseCommand):
                             help='Skip generation of zip tiles files')
         parser.add_argument('--skip-dem', '-d', action='store_true', dest='skip_dem', default=False,
                             help='Skip generation of DEM files for 3D')
+        parser.add_argument('--dem-format', dest='dem_format', choices=('json', 'binary'), default='json',
+                            help='Format of DEM files for 3D: json (dem.json) or '
+                            'compact binary (dem.bin), default json')
         parser.add_argument('--skip-profile-png', '-e', action='store_true', dest='skip_profile_png', default=False,
                             help='Skip generation of PNG elevation profile'),
         parser.add_argument('--languages', '-l', dest='languages', default='', help='Languages to sync')
@@ -116,11 +393,15 @@ class Command(BaseCommand):
                             help='include signages')
         parser.add_argument('--with-infrastructures', '-i', action='store_true', dest='with_infrastructures',
                             default=False, help='include infrastructures')
+        parser.add_argument('--jobs', '-j', action='store', dest='jobs', type=int, default=1,
+                            help='Number of parallel processes syncing treks, default 1')
+        parser.add_argument('--tiles-jobs', '-T', action='store', dest='tiles_jobs', type=int, default=1,
+                            help='Number of tiles downloaded in parallel, default 1')
+        parser.add_argument('--incremental', '-I', action='store_true', dest='incremental', default=False,
+                            help='Do not generate again files of treks unchanged since previous sync')
 
     def mkdirs(self, name):
-        dirname = os.path.dirname(name)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        mkdirs(name)
 
     def sync_global_tiles(self):
         """ Creates a tiles file on the global extent.
@@ -142,7 +423,7 @@ class Command(BaseCommand):
         def close_zip(zipfile):
             return self.close_zip(zipfile, zipname)
 
-        tiles = ZipTilesBuilder(global_file, close_zip, **self.builder_args)
+        tiles = ZipTilesBuilder(global_file, close_zip, self.tiles_fetcher)
         tiles.add_coverage(bbox=global_extent,
                            zoomlevels=settings.MOBILE_TILES_GLOBAL_ZOOMS)
         tiles.run()
@@ -158,27 +439,18 @@ class Command(BaseCommand):
 
         trek_file = os.path.join(self.tmp_root, zipname)
 
-        def _radius2bbox(lng, lat, radius):
-            return (lng - radius, lat - radius,
-                    lng + radius, lat + radius)
-
         self.mkdirs(trek_file)
 
         def close_zip(zipfile):
             return self.close_zip(zipfile, zipname)
 
-        tiles = ZipTilesBuilder(trek_file, close_zip, **self.builder_args)
+        tiles = ZipTilesBuilder(trek_file, close_zip, self.tiles_fetcher)
 
-        geom = trek.geom
-        if geom.geom_type == 'MultiLineString':
-            geom = geom[0]  # FIXME
-        geom.transform(4326)
-
-        for (lng, lat) in geom.coords:
-            large = _radius2bbox(lng, lat, settings.MOBILE_TILES_RADIUS_LARGE)
-            small = _radius2bbox(lng, lat, settings.MOBILE_TILES_RADIUS_SMALL)
-            tiles.add_coverage(bbox=large, zoomlevels=settings.MOBILE_TILES_LOW_ZOOMS)
-            tiles.add_coverage(bbox=small, zoomlevels=settings.MOBILE_TILES_HIGH_ZOOMS)
+        geom = trek.geom.transform(4326, clone=True)
+        tiles.add_polygon_coverage(geom.buffer(settings.MOBILE_TILES_RADIUS_LARGE),
+                                   zoomlevels=settings.MOBILE_TILES_LOW_ZOOMS)
+        tiles.add_polygon_coverage(geom.buffer(settings.MOBILE_TILES_RADIUS_SMALL),
+                                   zoomlevels=settings.MOBILE_TILES_HIGH_ZOOMS)
 
         tiles.run()
 
@@ -205,27 +477,26 @@ class Command(BaseCommand):
             if self.verbosity == 2:
                 self.stdout.write(u"\x1b[3D\x1b[31;1mfailed (HTTP {code})\x1b[0m".format(code=response.status_code))
             return
-        f = open(fullname, 'w')
         if isinstance(response, StreamingHttpResponse):
-            content = b''.join(response.streaming_content)
+            content = response.streaming_content
         else:
-            content = response.content
-        # Fix strange unicode characters 2028 and 2029 that make Geotrek-mobile crash
+            content = [response.content]
         if fix2028:
-            content = content.replace('\\u2028', '\\n')
-            content = content.replace('\\u2029', '\\n')
-        f.write(content)
-        f.close()
-        oldfilename = os.path.join(self.dst_root, name)
-        # If new file is identical to old one, don't recreate it. This will help backup
-        if os.path.isfile(oldfilename) and filecmp.cmp(fullname, oldfilename):
+            content = fix_2028(content)
+        path = self.store.add(content)
+        if os.path.exists(fullname):
             os.unlink(fullname)
-            os.link(oldfilename, fullname)
+        os.link(path, fullname)
+        oldfilename = os.path.join(self.dst_root, name)
+        # If new file is identical to old one, both are links to the same stored file. This will help backup
+        if os.path.isfile(oldfilename) and os.path.samefile(oldfilename, path):
             if self.verbosity == 2:
                 self.stdout.write(u"\x1b[3D\x1b[32munchanged\x1b[0m")
         else:
             if self.verbosity == 2:
                 self.stdout.write(u"\x1b[3D\x1b[32mgenerated\x1b[0m")
+        if self.written is not None:
+            self.written.append(name)
         # FixMe: Find why there are duplicate files.
         if zipfile:
             if name not in zipfile.namelist():
@@ -319,7 +590,11 @@ class Command(BaseCommand):
         if self.skip_dem:
             return
         view = ElevationArea.as_view(model=type(obj))
-        self.sync_object_view(lang, obj, view, 'dem.json')
+        if self.dem_format == 'binary':
+            params = {'_format': 'binary', '_compression': 'zlib'}
+            self.sync_object_view(lang, obj, view, 'dem.bin', params=params)
+        else:
+            self.sync_object_view(lang, obj, view, 'dem.json')
 
     def sync_gpx(self, lang, obj):
         self.sync_object_view(lang, obj, TrekGPXDetail.as_view(), '{obj.slug}.gpx')
@@ -351,7 +626,14 @@ class Command(BaseCommand):
         dst = os.path.join(self.tmp_root, url, name)
         self.mkdirs(dst)
         if not os.path.isfile(dst):
-            os.link(src, dst)
+            try:
+                os.link(src, dst)
+            except OSError as e:
+                # Linked meanwhile by another process (media shared by treks)
+                if e.errno != errno.EEXIST:
+                    raise
+        if self.written is not None:
+            self.written.append(os.path.join(url, name))
         if zipfile:
             zipfile.write(dst, os.path.join(url, name))
         if self.verbosity == 2:
@@ -382,8 +664,6 @@ class Command(BaseCommand):
         self.mkdirs(zipfullname)
         self.trek_zipfile = ZipFile(zipfullname, 'w')
 
-        self.sync_json(lang, ParametersView, 'parameters', zipfile=self.zipfile)
-        self.sync_json(lang, ThemeViewSet, 'themes', as_view_args=[{'get': 'list'}], zipfile=self.zipfile)
         self.sync_trek_pois(lang, trek, zipfile=self.zipfile)
         if self.with_infrastructures:
             self.sync_trek_infrastructures(lang, trek)
@@ -424,24 +704,116 @@ class Command(BaseCommand):
                               ending="")
 
         self.close_zip(self.trek_zipfile, zipname)
+        if self.written is not None:
+            self.written.append(zipname)
+
+    def sync_trek_unit(self, lang, trek):
+        """Syncs one trek, recording the members of the language global zip
+        file instead of adding them. Files of a trek unchanged since previous
+        sync are linked instead with ``--incremental``. Returns success,
+        fingerprint, zip members and written files, with paths relative to
+        ``tmp_root``.
+        """
+        fingerprint = self.trek_fingerprint(trek)
+        entry = self.link_unchanged_trek(u'{}/{}'.format(lang, trek.pk), fingerprint) if self.incremental else None
+        if entry is not None:
+            if self.verbosity == 2:
+                self.stdout.write(u"\x1b[36m{lang}\x1b[0m \x1b[1mtrek {pk}\x1b[0m \x1b[32munchanged\x1b[0m".format(
+                    lang=lang, pk=trek.pk))
+            return True, fingerprint, entry['members'], entry['files']
+        global_zipfile, successfull = getattr(self, 'zipfile', None), self.successfull
+        self.zipfile, self.successfull, self.written = ZipMembers(), True, []
+        try:
+            self.sync_trek(lang, trek)
+            members = [(os.path.relpath(filename, self.tmp_root), arcname)
+                       for filename, arcname in self.zipfile.members]
+            return self.successfull, fingerprint, members, sorted(set(self.written))
+        finally:
+            self.zipfile, self.successfull, self.written = global_zipfile, successfull, None
+
+    def trek_fingerprint(self, trek):
+        """Fingerprint of the inputs of trek files: sync options, DEM version,
+        dates of update of the trek, of its related objects and of their
+        attachments, labels and pictograms of its lookups.
+        """
+        related = [trek] + list(trek.parents) + list(trek.children) + list(trek.published_pois) + list(trek.services)
+        if settings.ZIP_TOURISTIC_CONTENTS_AS_POI or self.categories:
+            related += list(trek.touristic_contents)
+        if self.with_events:
+            related += list(trek.touristic_events)
+        if self.with_infrastructures:
+            related += list(trek.infrastructures)
+        if self.with_signages:
+            related += list(trek.signages)
+        if 'geotrek.sensitivity' in settings.INSTALLED_APPS:
+            related += list(trek.published_sensitive_areas)
+        values = [self.options_fingerprint, AltimetryHelper.dem_version()]
+        values += [(obj._meta.model_name, obj.pk, obj.date_update) for obj in related]
+        lookups = [trek.difficulty, trek.practice, trek.route] + list(trek.themes.all()) + \
+            list(trek.networks.all()) + list(trek.accessibilities.all())
+        values += [(lookup._meta.model_name, lookup.pk, unicode(lookup), lookup.pictogram.name)
+                   for lookup in lookups if lookup is not None]
+        desks = trek.information_desks.order_by('pk').values_list()
+        values += [tuple(getattr(value, 'ewkt', value) for value in desk) for desk in desks]
+        by_model = {}
+        for obj in related:
+            by_model.setdefault(type(obj), []).append(obj.pk)
+        for model, pks in sorted(by_model.items(), key=lambda item: item[0]._meta.model_name):
+            attachments = common_models.Attachment.objects.filter(content_type=ContentType.objects.get_for_model(model),
+                                                                  object_id__in=pks)
+            values += list(attachments.order_by('pk').values_list('pk', 'object_id', 'date_update'))
+        return hashlib.md5(repr(values)).hexdigest()
+
+    def link_unchanged_trek(self, key, fingerprint):
+        """Hard links files of a trek from ``dst_root`` if its fingerprint did
+        not change since previous sync. Returns the manifest entry, or ``None``
+        if files have to be generated.
+        """
+        entry = self.previous_manifest.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        if not all(os.path.isfile(os.path.join(self.dst_root, name)) for name in entry['files']):
+            return None
+        for name in entry['files']:
+            fullname = os.path.join(self.tmp_root, name)
+            self.mkdirs(fullname)
+            try:
+                os.link(os.path.join(self.dst_root, name), fullname)
+            except OSError as e:
+                # Already synced, by another trek
+                if e.errno != errno.EEXIST:
+                    raise
+        return entry
+
+    def sync_treks(self, lang, treks):
+        """Syncs treks, in worker processes with ``--jobs``.
+        """
+        if self.pool:
+            results = self.pool.imap(sync_trek_worker, [(lang, trek.pk) for trek in treks])
+        else:
+            results = (('', ) + self.sync_trek_unit(lang, trek) for trek in treks)
+        for trek, (output, successfull, fingerprint, members, written) in zip(treks, results):
+            self.stdout.write(output, ending='')
+            self.add_trek_members(members)
+            if successfull:
+                key = u'{}/{}'.format(lang, trek.pk)
+                self.manifest[key] = {'fingerprint': fingerprint, 'files': written, 'members': members}
+            else:
+                self.successfull = False
+
+    def add_trek_members(self, members):
+        for filename, arcname in members:
+            if arcname not in self.zipfile.namelist():
+                self.zipfile.write(os.path.join(self.tmp_root, filename), arcname)
 
     def close_zip(self, zipfile, name):
         oldzipfilename = os.path.join(self.dst_root, name)
         zipfilename = os.path.join(self.tmp_root, name)
-        try:
-            oldzipfile = ZipFile(oldzipfilename, 'r')
-        except IOError:
-            uptodate = False
-        else:
-            old = set([(zi.filename, zi.CRC) for zi in oldzipfile.infolist()])
-            new = set([(zi.filename, zi.CRC) for zi in zipfile.infolist()])
-            uptodate = (old == new)
-            oldzipfile.close()
-
+        # Zip files with the same members are stored once, whatever their dates
+        members = sorted([(zi.filename, zi.CRC) for zi in zipfile.infolist()])
         zipfile.close()
-        if uptodate:
-            stat = os.stat(oldzipfilename)
-            os.utime(zipfilename, (stat.st_atime, stat.st_mtime))
+        path = self.store.add_file(zipfilename, hashlib.sha1(repr(members)).hexdigest())
+        uptodate = os.path.isfile(oldzipfilename) and os.path.samefile(oldzipfilename, path)
 
         if self.verbosity == 2:
             if uptodate:
@@ -467,6 +839,8 @@ class Command(BaseCommand):
         self.zipfile = ZipFile(zipfullname, 'w')
 
         self.sync_geojson(lang, TrekViewSet, 'treks.geojson', zipfile=self.zipfile)
+        self.sync_json(lang, ParametersView, 'parameters', zipfile=self.zipfile)
+        self.sync_json(lang, ThemeViewSet, 'themes', as_view_args=[{'get': 'list'}], zipfile=self.zipfile)
         self.sync_geojson(lang, POIViewSet, 'pois.geojson')
         if self.with_infrastructures:
             self.sync_geojson(lang, InfrastructureViewSet, 'infrastructures.geojson')
@@ -510,8 +884,7 @@ class Command(BaseCommand):
         if self.portal:
             treks = treks.filter(Q(portal__name__in=self.portal) | Q(portal=None))
 
-        for trek in treks:
-            self.sync_trek(lang, trek)
+        self.sync_treks(lang, treks)
 
         self.sync_tourism(lang)
         self.sync_meta(lang)
@@ -526,6 +899,7 @@ class Command(BaseCommand):
 
     def sync_tiles(self):
         if not self.skip_tiles:
+            self.tiles_fetcher = TilesFetcher(self.tiles_jobs, **self.builder_args)
 
             if self.celery_task:
                 self.celery_task.update_state(
@@ -562,6 +936,8 @@ class Command(BaseCommand):
                 if trek.any_published or any([parent.any_published for parent in trek.parents]):
                     self.sync_trek_tiles(trek)
 
+            self.tiles_fetcher.close()
+
             if self.celery_task:
                 self.celery_task.update_state(
                     state='PROGRESS',
@@ -716,6 +1092,34 @@ class Command(BaseCommand):
     def sync(self):
         self.sync_tiles()
 
+        self.previous_manifest = {}
+        if self.incremental and os.path.isfile(os.path.join(self.dst_root, MANIFEST)):
+            with open(os.path.join(self.dst_root, MANIFEST)) as f:
+                self.previous_manifest = json.load(f)
+        self.manifest = {}
+
+        self.pool = None
+        if self.jobs > 1:
+            # Worker processes must not share the database connection
+            connections.close_all()
+            self.pool = multiprocessing.Pool(self.jobs, initializer=init_sync_worker, initargs=(self, ))
+        try:
+            self.sync_languages()
+        finally:
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+
+        self.sync_static_file('**', 'tourism/touristicevent.svg')
+        self.sync_pictograms('**', tourism_models.InformationDeskType)
+        self.sync_pictograms('**', tourism_models.TouristicContentCategory)
+        self.sync_pictograms('**', tourism_models.TouristicContentType)
+        self.sync_pictograms('**', tourism_models.TouristicEventType)
+
+        with open(os.path.join(self.tmp_root, MANIFEST), 'w') as f:
+            json.dump(self.manifest, f)
+
+    def sync_languages(self):
         step_value = int(50 / len(settings.MODELTRANSLATION_LANGUAGES))
         current_value = 30
 
@@ -736,17 +1140,11 @@ class Command(BaseCommand):
             self.sync_trekking(lang)
             translation.deactivate()
 
-        self.sync_static_file('**', 'tourism/touristicevent.svg')
-        self.sync_pictograms('**', tourism_models.InformationDeskType)
-        self.sync_pictograms('**', tourism_models.TouristicContentCategory)
-        self.sync_pictograms('**', tourism_models.TouristicContentType)
-        self.sync_pictograms('**', tourism_models.TouristicEventType)
-
     def check_dst_root_is_empty(self):
         if not os.path.exists(self.dst_root):
             return
         existing = set([os.path.basename(p) for p in os.listdir(self.dst_root)])
-        remaining = existing - set(('api', 'media', 'meta', 'static', 'zip'))
+        remaining = existing - set(('api', 'media', 'meta', 'static', 'zip', MANIFEST))
         if remaining:
             raise CommandError(u"Destination directory contains extra data")
 
@@ -764,6 +1162,14 @@ class Command(BaseCommand):
         self.verbosity = options['verbosity']
         self.dst_root = options["path"].rstrip('/')
         self.check_dst_root_is_empty()
+        self.jobs = options.get('jobs', 1)
+        if self.jobs < 1:
+            raise CommandError('Number of jobs must be positive')
+        self.tiles_jobs = options.get('tiles_jobs', 1)
+        if self.tiles_jobs < 1:
+            raise CommandError('Number of tiles jobs must be positive')
+        self.incremental = options.get('incremental', False)
+        self.written = None
         if options['url'][:7] not in ('http://', 'https://'):
             raise CommandError('url parameter should start with http:// or https://')
         self.referer = options['url']
@@ -774,9 +1180,11 @@ class Command(BaseCommand):
         self.factory = RequestFactory()
         self.tmp_root = os.path.join(os.path.dirname(self.dst_root), 'tmp_sync_rando')
         os.mkdir(self.tmp_root)
+        self.store = ContentStore(os.path.join(os.path.dirname(self.dst_root), 'sync_rando_store'))
         self.skip_pdf = options['skip_pdf']
         self.skip_tiles = options['skip_tiles']
         self.skip_dem = options['skip_dem']
+        self.dem_format = options.get('dem_format', 'json')
         self.skip_profile_png = options['skip_profile_png']
         self.source = options['source']
         if options['languages']:
@@ -790,6 +1198,10 @@ class Command(BaseCommand):
         self.with_signages = options.get('with_signages', False)
         self.with_infrastructures = options.get('with_infrastructures', False)
         self.celery_task = options.get('task', None)
+        if self.celery_task and self.jobs > 1:
+            # Celery worker processes are daemonic, they are not allowed to have children
+            logger.warning("Option --jobs is ignored when synchronization is launched from the web interface")
+            self.jobs = 1
 
         if self.source is not None:
             self.source = self.source.split(',')
@@ -800,6 +1212,11 @@ class Command(BaseCommand):
         else:
             self.portal = []
 
+        self.options_fingerprint = repr((self.referer, self.rando_url, self.source, self.portal, self.skip_pdf,
+                                         self.skip_dem, self.dem_format, self.skip_profile_png, self.with_events,
+                                         self.categories, self.with_signages, self.with_infrastructures,
+                                         settings.ZIP_TOURISTIC_CONTENTS_AS_POI))
+
         if isinstance(settings.MOBILE_TILES_URL, str):
             tiles_url = settings.MOBILE_TILES_URL
         else:
@@ -827,6 +1244,7 @@ class Command(BaseCommand):
             raise
 
         self.rename_root()
+        self.store.prune()
 
         done_message = 'Done'
         if self.successfull:
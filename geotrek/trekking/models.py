@@ -207,6 +207,12 @@ class Trek(StructureRelated, PicturesMixin, PublishableMixin, MapEntityMixin, To
     def districts_display(self):
         return ', '.join([unicode(d) for d in self.districts])
 
+    @property
+    def pois_csv_display(self):
+        # POIs may have been fetched for many treks at once (see ``POI.treks_pois()``)
+        pois = getattr(self, '_pois', self.pois)
+        return ', '.join([unicode(p) for p in pois])
+
     @property
     def themes_display(self):
         return ', '.join([unicode(n) for n in self.themes.all()])
@@ -727,6 +733,15 @@ class POI(StructureRelated, PicturesMixin, PublishableMixin, MapEntityMixin, Top
         except Trek.DoesNotExist:
             return qs
 
+    @classmethod
+    def treks_pois(cls, treks):
+        """ POIs of each trek (as a dict by trek pk), computed all at once """
+        pois = cls.overlapping_bulk(treks)
+        excluded = Trek.pois_excluded.through.objects.filter(trek__in=pois.keys())
+        for trek, poi in excluded.values_list('trek', 'poi'):
+            pois[trek] = [p for p in pois[trek] if p.pk != poi]
+        return pois
+
     @property
     def extent(self):
         return self.geom.transform(settings.API_SRID, clone=True).extent if self.geom else None
@@ -12,7 +12,7 @@ from geotrek.core.factories import PathFactory
 from geotrek.zoning.factories import DistrictFactory, CityFactory
 from geotrek.trekking.factories import (POIFactory, TrekFactory,
                                         TrekWithPOIsFactory, ServiceFactory)
-from geotrek.trekking.models import Trek, OrderedTrekChild
+from geotrek.trekking.models import Trek, POI, OrderedTrekChild
 
 
 class TrekTest(TranslationResetMixin, TestCase):
@@ -262,6 +262,11 @@ class RelatedObjectsTest(TranslationResetMixin, TestCase):
         pois = self.trek_reverse.pois
         self.assertEqual([self.poi3, self.poi1, self.poi2], list(pois))
 
+        self.trek_reverse.pois_excluded.add(self.poi1)
+        pois = POI.treks_pois([self.trek, self.trek_reverse])
+        self.assertEqual(pois, {self.trek.pk: [self.poi2, self.poi1, self.poi3],
+                                self.trek_reverse.pk: [self.poi3, self.poi2]})
+
     def test_city_departure(self):
         trek = TrekFactory.create(no_path=True)
         p1 = PathFactory.create(geom=LineString((0, 0), (5, 5)))
@@ -1,12 +1,21 @@
 import os
 import json
 import mock
-from django.test import TestCase
+import shutil
+import tempfile
+from zipfile import ZipFile
+from django.test import TestCase, TransactionTestCase
 from django.core import management
 from django.conf import settings
-from geotrek.common.factories import RecordSourceFactory, TargetPortalFactory
+from django.contrib.gis.geos import LineString, Point
+from django.test.utils import override_settings
+from landez.sources import DownloadError
+from geotrek.altimetry.helpers import AltimetryHelper
+from geotrek.common.factories import RecordSourceFactory, TargetPortalFactory, ThemeFactory
+from geotrek.signage.factories import SignageFactory
 from geotrek.trekking.factories import TrekFactory
 from geotrek.trekking import models as trek_models
+from geotrek.trekking.management.commands.sync_rando import fix_2028, polygon_tiles, ContentStore, TilesFetcher
 
 
 class SyncTest(TestCase):
@@ -52,6 +61,29 @@ class SyncTest(TestCase):
                 # \u2028 is translated to \n
                 self.assertEquals(treks['features'][0]['properties']['description'], u'toto\ntata')
 
+    def test_sync_unchanged_files_are_stored_once(self):
+        def sync():
+            management.call_command('sync_rando', settings.SYNC_RANDO_ROOT, url='http://localhost:8000',
+                                    skip_tiles=True, skip_pdf=True, verbosity=0)
+            return [os.stat(os.path.join(settings.SYNC_RANDO_ROOT, *name)).st_ino for name in names]
+
+        names = [('api', 'en', 'treks.geojson'), ('zip', 'treks', 'en', 'global.zip')]
+        with mock.patch('geotrek.trekking.models.Trek.prepare_map_image'):
+            first = sync()
+            second = sync()
+        # Unchanged files are links to the same stored file
+        self.assertEqual(first, second)
+
+    def test_sync_stored_files_mode(self):
+        umask = os.umask(0)
+        os.umask(umask)
+        with mock.patch('geotrek.trekking.models.Trek.prepare_map_image'):
+            management.call_command('sync_rando', settings.SYNC_RANDO_ROOT, url='http://localhost:8000',
+                                    skip_tiles=True, skip_pdf=True, verbosity=0)
+        for name in [('api', 'en', 'treks.geojson'), ('zip', 'treks', 'en', 'global.zip')]:
+            mode = os.stat(os.path.join(settings.SYNC_RANDO_ROOT, *name)).st_mode
+            self.assertEqual(mode & 0o777, 0o666 & ~umask)
+
     def test_sync_filtering_sources(self):
         # source A only
         with mock.patch('geotrek.trekking.models.Trek.prepare_map_image'):
@@ -85,3 +117,193 @@ class SyncTest(TestCase):
 
                 # 4 treks have portal A or B or no portal
                 self.assertEquals(len(treks['features']), 4)
+
+
+class Fix2028Test(TestCase):
+    def test_fix_2028_in_chunks(self):
+        chunks = [b'toto\\u20', b'28tata\\', b'u2029', b'', b'titi\\u2029']
+        self.assertEqual(b''.join(fix_2028(chunks)), b'toto\\ntata\\ntiti\\n')
+
+
+class ContentStoreTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ContentStore(os.path.join(self.root, 'store'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_prune_removes_unlinked_files(self):
+        linked = self.store.add([b'linked'])
+        os.link(linked, os.path.join(self.root, 'linked'))
+        unlinked = self.store.add([b'unlinked'])
+        self.store.prune()
+        self.assertTrue(os.path.exists(linked))
+        self.assertFalse(os.path.exists(unlinked))
+
+    def test_prune_removes_temporary_files_left(self):
+        def chunks():
+            yield b'interrupted'
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.store.add(chunks())
+        left, = [os.path.join(self.store.tmp, name) for name in os.listdir(self.store.tmp)]
+        self.store.prune()
+        # May be written by another sync
+        self.assertTrue(os.path.exists(left))
+        os.utime(left, (0, 0))
+        self.store.prune()
+        self.assertFalse(os.path.exists(left))
+        self.assertEqual(os.listdir(self.store.root), ['tmp'])
+
+
+def local_tile(z, x, y):
+    """Stands for tiles downloads"""
+    if (z, x, y) == (13, 4221, 2972):
+        raise DownloadError()
+    return b'{}/{}/{}'.format(z, x, y)
+
+
+class TilesTest(TestCase):
+    def setUp(self):
+        self.tiles_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tiles_dir)
+
+    def fetcher(self, jobs=1):
+        return TilesFetcher(jobs, tiles_url='http://tiles.local/{z}/{x}/{y}.png', tiles_dir=self.tiles_dir)
+
+    def test_polygon_tiles(self):
+        polygon = Point(10, 10, srid=4326).buffer(0.1)
+        self.assertEqual(polygon_tiles(polygon, [1]), set([(1, 1, 0)]))
+        self.assertEqual(polygon_tiles(polygon, [1], 'tms'), set([(1, 1, 1)]))
+
+    def test_polygon_tiles_within_bbox(self):
+        polygon = LineString((5.5, 44.2), (5.6, 44.3), srid=4326).buffer(0.005)
+        tiles = polygon_tiles(polygon, [14])
+        bbox_tiles = self.fetcher().tileslist(polygon.extent, [14])
+        self.assertTrue(tiles < bbox_tiles)
+
+    def test_fetch_in_parallel_and_resume(self):
+        tiles = self.fetcher().tileslist((5.5, 44.2, 5.6, 44.3), [12, 13])
+        with mock.patch('landez.sources.TileDownloader.tile', side_effect=local_tile) as download:
+            fetcher = self.fetcher(jobs=4)
+            fetcher.fetch(tiles)
+            fetcher.close()
+            self.assertEqual(download.call_count, len(tiles))
+            self.assertEqual(fetcher.tile((12, 2110, 1486)), b'12/2110/1486')
+            self.assertIsNone(fetcher.tile((13, 4221, 2972)))
+            # Only the failed tile is fetched again
+            self.fetcher().fetch(tiles)
+            self.assertEqual(download.call_count, len(tiles) + 1)
+
+    def test_fetch_empty_tile_again(self):
+        fetcher = self.fetcher()
+        path = fetcher.tm.cache.tile_fullpath((12, 2110, 1486))
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        with mock.patch('landez.sources.TileDownloader.tile', side_effect=local_tile) as download:
+            fetcher.fetch([(12, 2110, 1486)])
+        self.assertEqual(download.call_count, 1)
+        self.assertEqual(fetcher.tile((12, 2110, 1486)), b'12/2110/1486')
+        # Tiles are renamed once written
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+
+class SyncParallelTest(TransactionTestCase):
+    """Worker processes have their own database connection: data must be committed"""
+    def setUp(self):
+        self.treks = [TrekFactory.create(published=True) for i in range(3)]
+
+    def sync(self, jobs):
+        with mock.patch('geotrek.trekking.models.Trek.prepare_map_image'):
+            management.call_command('sync_rando', settings.SYNC_RANDO_ROOT, url='http://localhost:8000',
+                                    skip_tiles=True, skip_pdf=True, skip_dem=True, verbosity=0, jobs=jobs)
+        with ZipFile(os.path.join(settings.SYNC_RANDO_ROOT, 'zip', 'treks', 'en', 'global.zip')) as zipfile:
+            return sorted(zipfile.namelist())
+
+    def test_sync_jobs(self):
+        sequential = self.sync(jobs=1)
+        parallel = self.sync(jobs=2)
+        self.assertEqual(parallel, sequential)
+        self.assertIn('api/en/parameters.json', parallel)
+        for trek in self.treks:
+            self.assertIn('api/en/treks/{}/pois.geojson'.format(trek.pk), parallel)
+            self.assertTrue(os.path.exists(os.path.join(settings.SYNC_RANDO_ROOT, 'zip', 'treks', 'en',
+                                                        '{}.zip'.format(trek.pk))))
+
+    def test_sync_jobs_ignored_in_celery_task(self):
+        with mock.patch('multiprocessing.Pool') as pool:
+            with mock.patch('geotrek.trekking.models.Trek.prepare_map_image'):
+                management.call_command('sync_rando', settings.SYNC_RANDO_ROOT, url='http://localhost:8000',
+                                        skip_tiles=True, skip_pdf=True, skip_dem=True, verbosity=0, jobs=2,
+                                        task=mock.MagicMock())
+        self.assertFalse(pool.called)
+
+
+class SyncIncrementalTest(TestCase):
+    def setUp(self):
+        self.trek = TrekFactory.create(published=True)
+
+    def sync(self, **options):
+        with mock.patch('geotrek.trekking.models.Trek.prepare_map_image'):
+            management.call_command('sync_rando', settings.SYNC_RANDO_ROOT, url='http://localhost:8000',
+                                    skip_tiles=True, skip_pdf=True, skip_dem=True, languages='en',
+                                    incremental=True, verbosity=0, **options)
+
+    def test_unchanged_trek_is_linked(self):
+        self.sync()
+        with mock.patch('geotrek.trekking.management.commands.sync_rando.Command.sync_trek') as sync_trek:
+            self.sync()
+        self.assertFalse(sync_trek.called)
+        pois = 'api/en/treks/{}/pois.geojson'.format(self.trek.pk)
+        self.assertTrue(os.path.exists(os.path.join(settings.SYNC_RANDO_ROOT, pois)))
+        with ZipFile(os.path.join(settings.SYNC_RANDO_ROOT, 'zip', 'treks', 'en', 'global.zip')) as zipfile:
+            self.assertIn(pois, zipfile.namelist())
+
+    def test_updated_trek_is_synced(self):
+        self.sync()
+        self.trek.name = u'Updated'
+        self.trek.save()
+        with mock.patch('geotrek.trekking.management.commands.sync_rando.Command.sync_trek') as sync_trek:
+            self.sync()
+        self.assertEqual(sync_trek.call_count, 1)
+
+    def test_trek_with_updated_signage_is_synced(self):
+        signage = SignageFactory.create(no_path=True, published=True)
+        signage.add_path(self.trek.paths.all()[0], start=0.5, end=0.5)
+        self.sync(with_signages=True)
+        signage.name = u'Updated'
+        signage.save()
+        with mock.patch('geotrek.trekking.management.commands.sync_rando.Command.sync_trek') as sync_trek:
+            self.sync(with_signages=True)
+        self.assertEqual(sync_trek.call_count, 1)
+
+    def test_trek_with_updated_difficulty_label_is_synced(self):
+        self.sync()
+        self.trek.difficulty.difficulty = u'Updated'
+        self.trek.difficulty.save()
+        with mock.patch('geotrek.trekking.management.commands.sync_rando.Command.sync_trek') as sync_trek:
+            self.sync()
+        self.assertEqual(sync_trek.call_count, 1)
+
+    def test_trek_with_updated_theme_pictogram_is_synced(self):
+        theme = ThemeFactory.create()
+        self.trek.themes.add(theme)
+        self.sync()
+        theme.pictogram = u'upload/updated.png'
+        theme.save()
+        with mock.patch('geotrek.trekking.management.commands.sync_rando.Command.sync_trek') as sync_trek:
+            self.sync()
+        self.assertEqual(sync_trek.call_count, 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                               'fat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_trek_is_synced_after_dem_changed(self):
+        self.sync()
+        AltimetryHelper.dem_changed()
+        with mock.patch('geotrek.trekking.management.commands.sync_rando.Command.sync_trek') as sync_trek:
+            self.sync()
+        self.assertEqual(sync_trek.call_count, 1)
@@ -287,6 +287,14 @@ class TrekViewsTest(CommonTest):
             response = self.client.get(self.model.get_format_list_url() + '?format=' + fmt)
             self.assertEqual(response.status_code, 200)
 
+    def test_format_fetches_treks_once(self):
+        self.login()
+        self.modelfactory.create()
+        with mock.patch.object(POI, 'treks_pois', wraps=POI.treks_pois) as treks_pois:
+            response = self.client.get(self.model.get_format_list_url() + '?format=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(treks_pois.call_count, 1)
+
     def test_no_pois_detached_in_create(self):
         self.login()
         response = self.client.get(self.model.get_add_url())
@@ -524,6 +532,28 @@ class TrekCustomPublicViewTests(TrekkingManagerTest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'application/json')
 
+    def test_elevation_area_binary(self):
+        trek = TrekFactory.create(published=True)
+        url = '/api/en/treks/{pk}/dem.json'.format(pk=trek.pk)
+        response = self.client.get(url, {'_format': 'binary', '_compression': 'zlib'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response.content[:4], 'GTD1')
+        response = self.client.get(url, {'_format': 'binary', '_compression': 'lzma'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                               'fat': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_elevation_area_binary_cached(self):
+        trek = TrekFactory.create(published=True)
+        url = '/api/en/treks/{pk}/dem.json'.format(pk=trek.pk)
+        response = self.client.get(url, {'_format': 'binary', '_compression': 'zlib'})
+        with mock.patch('geotrek.trekking.models.Trek.get_elevation_area') as get_elevation_area:
+            cached = self.client.get(url, {'_format': 'binary', '_compression': 'zlib'})
+        self.assertFalse(get_elevation_area.called)
+        self.assertEqual(cached['Content-Type'], 'application/octet-stream')
+        self.assertEqual(cached.content, response.content)
+
     def test_not_published_elevation_area_json(self):
         trek = TrekFactory.create(published=False)
         url = '/api/en/treks/{pk}/dem.json'.format(pk=trek.pk)
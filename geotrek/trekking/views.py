@@ -118,6 +118,19 @@ class TrekFormatList(MapEntityFormat, TrekList):
         'cities', 'districts', 'areas', 'source', 'portal', 'length_2d'
     ] + AltimetryMixin.COLUMNS
 
+    def get_queryset(self):
+        """ Fetch POIs of all treks at once, instead of once per trek.
+        Treks are fetched once per request, exports call this method again.
+        """
+        if not hasattr(self, '_treks'):
+            treks = list(super(TrekFormatList, self).get_queryset())
+            if settings.TREKKING_TOPOLOGY_ENABLED:
+                pois = POI.treks_pois(treks)
+                for trek in treks:
+                    trek._pois = pois[trek.pk]
+            self._treks = treks
+        return self._treks
+
 
 class TrekGPXDetail(LastModifiedMixin, PublicOrReadPermMixin, BaseDetailView):
     queryset = Trek.objects.existing()
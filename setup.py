@@ -23,6 +23,7 @@ setup(
         'easy-thumbnails',
         'simplekml',
         'pygal',
+        'CairoSVG',
         'django-extended-choices',
         'django-multiselectfield',
         'geojson',